@@ -25,7 +25,7 @@ var DEFAULT_SETTINGS = [ ['auth_key', '', '(Hidden cell) Secret value for secure
 			 ['cumulative_grade',   '', 'A:90%:4,B:80%:3,C:70%:2,D:60%:1,F:0%:0'], // Or A:180:4,B:160:3,...
 			 [],
 			 ['proxy_mod_time',  '', 'Stores time of last modification (not user configured)'],  
-			 ['proxy_update_cache', '', 'Used to cache response to last update request (not user configured)']
+			 ['proxy_update_cache', '', 'Used to cache responses to recent update requests (not user configured)']
 		       ];
 
 // Add settings of the form 'session_assignment' = '--pace=2 ...'
@@ -338,6 +338,22 @@ function loadSettings() {
     }
 }
 
+var PROXY_UPDATE_CACHE_MAX = 10;   // Max. no of cached responses to proxy update requests
+function getProxyCachedUpdate(requestId) {
+    // Return cached [requestId, refreshSheets, updateErrors] for update request (or null)
+    // If requestId is omitted, return list of all cached responses (most recent first)
+    var cachedUpdates = Settings['proxy_update_cache'] || [];
+    if (cachedUpdates.length && !Array.isArray(cachedUpdates[0]))
+	cachedUpdates = [cachedUpdates];   // Single response (older format)
+    if (!requestId)
+	return cachedUpdates;
+    for (var j=0; j<cachedUpdates.length; j++) {
+	if (cachedUpdates[j][0] == requestId)
+	    return cachedUpdates[j];
+    }
+    return null;
+}
+
 var protectedSettings = {'proxy_mod_time': 1, 'proxy_update_cache': 1};
 function updateSettings(settingsData) {
     var settingsSheet = getSheet(SETTINGS_SHEET);
@@ -563,11 +579,13 @@ function sheetAction(params) {
     // [1] http://googleappsdeveloper.blogspot.co.uk/2011/10/concurrency-and-google-apps-script.html
     // we want a public lock, one that locks for all invocations
     var lock = LockService.getPublicLock();
-    lock.waitLock(30000);  // wait 30 seconds before conceding defeat.
+    if (!lock.tryLock(30000))  // wait 30 seconds before conceding defeat.
+	return {"result":"error", "error": 'Error:LOCK_TIMEOUT:Timed out waiting for lock', "value": null,
+		"info": {version: VERSION}, "messages": ''};
 
     var returnValues = null;
     var returnHeaders = null;
-    var returnInfo = {version: VERSION};
+    var returnInfo = {version: VERSION, proxyEncodings: ['gzip']};
     var returnMessages = [];
     var completeActions = [];
     try {
@@ -830,20 +848,20 @@ function sheetAction(params) {
 	    }
 	    returnValues = [];
 
-	} else if (proxy && params.allupdates && params.requestid && Settings['proxy_update_cache'] && Settings['proxy_update_cache'][0] == params.requestid) {
+	} else if (proxy && params.allupdates && params.requestid && getProxyCachedUpdate(params.requestid)) {
 	    // Proxy update request already handled; return cached response
+	    var cachedUpdate = getProxyCachedUpdate(params.requestid);
 	    returnValues = [];
-	    returnInfo.cachedResponse = Settings['proxy_update_cache'][0];
-	    returnInfo.refreshSheets = Settings['proxy_update_cache'][1];
-	    returnInfo.updateErrors = Settings['proxy_update_cache'][2];
+	    returnInfo.cachedResponse = cachedUpdate[0];
+	    returnInfo.refreshSheets = cachedUpdate[1];
+	    returnInfo.updateErrors = cachedUpdate[2];
 
 	} else if (proxy && params.allupdates) {
 	    // Update multiple sheets from proxy
-	    if (ProxyCacheRange) {
-		ProxyCacheRange.setValue('');
-	    }
+	    // (proxy may have several update requests in flight, for disjoint sets of sheets)
+	    var cachedUpdates = getProxyCachedUpdate();
 	    returnValues = [];
-	    var data = JSON.parse(params.data);
+	    var data = JSON.parse(decodeProxyData(params.data, params.encoding||''));
 	    ///startCallTracking(3, {}, 'PROXY');
 	    trackCall(1, 'handleProxyUpdates: params.data.length='+params.data.length);
 	    var retval = handleProxyUpdates(data, params.create, returnMessages);
@@ -851,7 +869,8 @@ function sheetAction(params) {
 	    returnInfo.updateErrors = retval[1];
 
 	    if (ProxyCacheRange) {
-		ProxyCacheRange.setValue( JSON.stringify([params.requestid || '', retval[0], retval[1]]) );
+		cachedUpdates.unshift([params.requestid || '', retval[0], retval[1]]);
+		ProxyCacheRange.setValue( JSON.stringify(cachedUpdates.slice(0, PROXY_UPDATE_CACHE_MAX)) );
 	    }
 	    if (ProxyModRange) {
 		ProxyModRange.setValue(curDate);
@@ -2232,6 +2251,16 @@ function adminPacedUpdate(sheetName, modSheet, numStickyRows, submitTimestamp) {
     }
 }
 
+function decodeProxyData(data, encoding) {
+    // Decode proxy update data (encoding=gzip: gzipped and URL-safe base64-encoded)
+    if (!encoding)
+	return data;
+    if (encoding != 'gzip')
+	throw('Error:PROXY_ENCODING:Unsupported proxy update encoding '+encoding);
+    var blob = Utilities.newBlob(Utilities.base64DecodeWebSafe(data), 'application/x-gzip');
+    return Utilities.ungzip(blob).getDataAsString();
+}
+
 function handleProxyUpdates(data, create, returnMessages) {
     var refreshSheets = []
     var updateErrors = [];
@@ -2578,11 +2607,19 @@ function handleProxyUpdates(data, create, returnMessages) {
 			    var modRow = modVals[mrow];
 			    var newRow = rowSel[mrow];
 
+			    // (Delta rows always include the id column offset, if within the block)
 			    if (checkIdOffset >= 0 && newRow[checkIdOffset] != modRow[idCol-pStartCol])
 				throw('Error:PROXY_PARTIAL_UPDATE: New id '+newRow[checkIdOffset]+' differs from old id '+modRow[idCol-pStartCol]+' in sheet '+updateSheetName);
 
-			    for (var mcol=0; mcol<nUpdateCols; mcol++) {
-				modRow[ rowCols[mcol]-pStartCol ] = newRow[mcol];
+			    if (!Array.isArray(newRow)) {
+				// Delta row: {colOffset: value} for modified cells only (other cells retain previous values)
+				for (var moffset in newRow)
+				    modRow[ rowCols[parseInt(moffset)]-pStartCol ] = newRow[moffset];
+
+			    } else {
+				for (var mcol=0; mcol<nUpdateCols; mcol++) {
+				    modRow[ rowCols[mcol]-pStartCol ] = newRow[mcol];
+				}
 			    }
 
 			    if (totalColFormulas) {
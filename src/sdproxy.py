@@ -35,6 +35,7 @@ import time
 import urllib
 import urllib2
 import uuid
+import zlib
 
 from collections import defaultdict, OrderedDict
 
@@ -43,6 +44,11 @@ from tornado.ioloop import IOLoop
 
 import sliauth
 
+try:
+    import numpy
+except ImportError:
+    numpy = None   # Batch scoring checks numeric tolerances without vectorization
+
 UPDATE_PARTIAL_ROWS = True
 
 scriptdir = os.path.dirname(os.path.realpath(__file__))
@@ -86,6 +92,14 @@ Settings = {
     'min_wait_sec': 0,    # Minimum time (sec) between successful Google Sheet requests
 
     'request_timeout': 75,   # Proxy update request timeout (sec)
+
+    'cache_max_mb': 0,    # Memory budget (MB) for cached sheets; least recently used clean sheets are evicted to stay within budget (0 for no limit)
+    'cache_max_rows': 0,  # Row budget for cached sheets (total rows in all sheets; 0 for no limit)
+
+    'compact_cache': False,  # Store cached sheet rows as immutable tuples of interned values (less memory, faster copies)
+    'compact_updates': False, # Send proxy updates gzip-compressed, with only modified cells in partial row updates
+
+    'journal_dir': '',    # Directory for write-ahead journal of cached sheet modifications (null string to disable)
     }
 
 COPY_FROM_CONFIG = ['gsheet_url', 'site_label', 'site_title', 'site_access',
@@ -96,7 +110,8 @@ COPY_FROM_CONFIG = ['gsheet_url', 'site_label', 'site_title', 'site_access',
     
 COPY_FROM_SERVER = ['auth_key', 'auth_type', 'site_name',  'server_url',
                     'debug', 'dry_run', 'email_addr', 'gapps_url', 'root_users',
-                    'lock_proxy_url', 'min_wait_sec', 'request_timeout',]
+                    'lock_proxy_url', 'min_wait_sec', 'request_timeout', 'cache_max_mb',
+                    'cache_max_rows', 'compact_cache', 'compact_updates', 'journal_dir',]
 
 # Site access:
 #  adminonly: Only admin/grader has access
@@ -121,6 +136,12 @@ MISS_RETRY_SEC = 1800           # Time period between attempts to access missed
 TIMED_GRACE_SEC = 15            # Grace period for timed submissions (usually about 15 seconds)
 
 PROXY_UPDATE_ROW_LIMIT = 200    # Max. no of rows per sheet, per proxy update request
+PROXY_UPDATE_SHARD_BYTES = 500000  # Approx. max request data size, when splitting updates into multiple requests (shards)
+DOWNLOAD_MAX_CONCURRENT = 4     # Max. no of concurrent sheet download requests (when filling cache or backing up)
+JOURNAL_MAX_RECORDS = 1000      # Max. no of journal records per sheet before writing compacted snapshot
+SESSION_CACHE_MAX = 500         # Max. no of decoded session_hidden values cached per sheet
+INTERN_MAX_LENGTH = 64          # Max. length of string values interned in compact rows (longer values are rarely shared)
+EXPORT_CHUNK_ROWS = 500         # No. of rows per chunk when streaming CSV export of sheet
 # (Set to 0 for no limit to update row count, approximating transactional behavior for databases,
 #  because remote cache updates occur between web requests, except when shutting down.)
 
@@ -200,6 +221,7 @@ Sheet_cache = {}    # Cache of sheets
 Miss_cache = {}     # For optional sheets that are missing
 Lock_cache = {}     # Locked sheets
 Lock_passthru = defaultdict(int)  # Count of passthru
+Discuss_index = {}  # Parsed discussion posts: (sheetName, discussNum) -> DiscussIndex
 
 Locked_proxy_sheets = set()  # Set of sheets locked on upstream proxy
 
@@ -209,36 +231,60 @@ Global.remoteVersions = set()
 Global.dryDeletedSheets = set()
 Global.shuttingDown = False
 Global.updatePartial = UPDATE_PARTIAL_ROWS
+Global.updateCompact = None    # Set when upstream reports whether it decodes compact updates
 
 Global.displayNameMap = {}
+Global.displayNameRevision = 0  # Incremented whenever displayNameMap is modified
+Global.displayNameCache = {}    # includeNonRoster -> (cache key, id->name map, id->short name map)
 
 Global.gradebookActive = False
 Global.accessCodeCallback = None
 Global.teamSetupCallback = None
 Global.discussPostCallback = None
+Global.responseTallyCallback = None
+Global.discussRevision = 0
 
 
 def mapDisplayName(userId, displayName):
     if displayName and (',' in displayName or userId not in Global.displayNameMap):
         # Comma-formatted names override
-        Global.displayNameMap[userId] = displayName
+        if Global.displayNameMap.get(userId) != displayName:
+            Global.displayNameMap[userId] = displayName
+            Global.displayNameRevision += 1
 
 def getDisplayNames(includeNonRoster=False):
     # Returns id->name mapping, sorted by name
+    nameMap, shortMap = getDisplayNameMaps(includeNonRoster=includeNonRoster)
+    return None if nameMap is None else OrderedDict(nameMap)
+
+def getDisplayNameMaps(includeNonRoster=False):
+    # Returns cached (id->name mapping sorted by name, id->short name mapping using first names)
+    # Maps are recomputed only when the roster sheet (or non-roster names) change, and should not be modified
+    rosterSheet = getSheet(ROSTER_SHEET)
+    cacheKey = (rosterSheet, rosterSheet.modTime if rosterSheet else None, Global.displayNameRevision if includeNonRoster else None)
+    cached = Global.displayNameCache.get(includeNonRoster)
+    if cached and cached[0] == cacheKey:
+        return cached[1:]
+
     rosterNameMap = lookupRoster('name')
     if rosterNameMap is None and not includeNonRoster:
-        return None
-    nameMap = Global.displayNameMap.copy() if includeNonRoster else {}
-    if rosterNameMap:
-        nameMap.update(rosterNameMap)
-    return OrderedDict(sorted(nameMap.items(), key=lambda x:x[1]))
+        nameMap = None
+    else:
+        nameMap = Global.displayNameMap.copy() if includeNonRoster else {}
+        if rosterNameMap:
+            nameMap.update(rosterNameMap)
+        nameMap = OrderedDict(sorted(nameMap.items(), key=lambda x:x[1]))
+    shortMap = makeShortNames(nameMap, first=True) if nameMap else {}
+    Global.displayNameCache[includeNonRoster] = (cacheKey, nameMap, shortMap)
+    return nameMap, shortMap
 
 
-def initProxy(gradebookActive=False, accessCodeCallback=None, teamSetupCallback=None, discussPostCallback=None):
+def initProxy(gradebookActive=False, accessCodeCallback=None, teamSetupCallback=None, discussPostCallback=None, responseTallyCallback=None):
     Global.gradebookActive = gradebookActive
     Global.accessCodeCallback = accessCodeCallback
     Global.teamSetupCallback = teamSetupCallback
     Global.discussPostCallback = discussPostCallback
+    Global.responseTallyCallback = responseTallyCallback
 
 def copySiteConfig(siteConfig):
     for key in COPY_FROM_CONFIG:
@@ -262,10 +308,16 @@ def split_list(list_str, sep=',', lower=False, keep_null=False):
 def delSheet(sheetName, deleteRemote=False):
     Sheet.relateSheet(sheetName, remove=True)
 
+    journalRemove(sheetName)
+
     for cache in (Sheet_cache, Miss_cache, Lock_cache, Lock_passthru):
         if sheetName in cache:
             del cache[sheetName]
 
+    for key in Discuss_index.keys():
+        if key[0] == sheetName:
+            del Discuss_index[key]
+
     if deleteRemote:
         if Settings['dry_run']:
             Global.dryDeletedSheets.add(sheetName)
@@ -285,8 +337,10 @@ def initCache():
     Miss_cache.clear()
     Lock_cache.clear()
     Lock_passthru.clear()
+    Discuss_index.clear()
 
-    Global.httpRequestId = ''
+    Global.updateShards = OrderedDict()  # requestId -> ProxyUpdater (for update requests in flight)
+    Global.sheetUpdateTimes = {}  # sheetName -> time of last completed update request for sheet
     Global.notifiedAdmin = ''
 
     Global.cacheResponseTime = 0
@@ -297,8 +351,14 @@ def initCache():
     Global.totalCacheResponseCount = 0
     Global.totalCacheRetryCount = 0
     Global.totalCacheRequestBytes = 0
+    Global.totalCacheRequestRawBytes = 0
     Global.totalCacheResponseBytes = 0
 
+    Global.cacheHits = 0
+    Global.cacheMisses = 0
+    Global.cacheEvictions = 0
+    Global.cacheExpirations = 0
+
     Global.cachePendingUpdate = None
     Global.suspended = ''
     Global.previewStatus = {}
@@ -328,6 +388,8 @@ def startTransactSession(sessionName):
     if not sessionSheet:
         raise Exception('Transact sheet %s not in cache' % sessionName)
     Global.transactSessions[sessionName] = sessionSheet.copy()
+    # Pause journaling until transaction ends (rollback discards changes)
+    journalClose(sessionSheet)
     if Settings['debug']:
         print("DEBUG:startTransactSession: %s " % sessionName, file=sys.stderr)
 
@@ -347,6 +409,8 @@ def endTransactSession(sessionName, noupdate=False):
     if sessionName not in Global.transactSessions:
         return
     del Global.transactSessions[sessionName]
+    if sessionName in Sheet_cache:
+        journalSnapshot(Sheet_cache[sessionName])
     if not noupdate:
         schedule_update(force=True)
     if Settings['debug']:
@@ -381,7 +445,7 @@ def startPreview(sessionName, rollingOver=False):
         if sessionSheet.get_updates() is not None:
             if Global.cacheUpdateError:
                 return 'Cache update error (%s); need to restart server' % Global.cacheUpdateError
-            return 'PENDING:Pending updates for session %s; retry preview after about 5 seconds (reqid=%s)' % (sessionName, Global.httpRequestId)
+            return 'PENDING:Pending updates for session %s; retry preview after about 5 seconds (reqid=%s)' % (sessionName, ','.join(Global.updateShards))
     else:
         sessionSheet = getSheet(sessionName)
 
@@ -392,9 +456,15 @@ def startPreview(sessionName, rollingOver=False):
     else:
         indexSheet = getSheet(INDEX_SHEET)
 
+    # (Copies are copy-on-write snapshots; rows are only duplicated when modified during preview)
     Global.previewStatus = {'sessionName': sessionName, 'sessionSheetOrig': sessionSheet.copy() if sessionSheet else None,
                             'indexSheetOrig': indexSheet.copy() if indexSheet else None}
 
+    # Pause journaling until preview ends (revert discards changes)
+    for sheet in (sessionSheet, indexSheet):
+        if sheet:
+            journalClose(sheet)
+
     if Settings['debug']:
         print("DEBUG:startPreview: %s " % sessionName, file=sys.stderr)
 
@@ -406,7 +476,11 @@ def endPreview(noupdate=False):
         return
     if Settings['debug']:
         print("DEBUG:endPreview: %s " % Global.previewStatus.get('sessionName'), file=sys.stderr)
+    sessionName = Global.previewStatus['sessionName']
     Global.previewStatus = {}
+    for sheetName in (sessionName, INDEX_SHEET):
+        if sheetName in Sheet_cache:
+            journalSnapshot(Sheet_cache[sheetName])
     if not noupdate:
         schedule_update(force=True)
 
@@ -456,15 +530,18 @@ def freezeCache(fill=False):
     if Global.suspended == 'freeze':
         return
     if fill:
-        # Fill cache
+        # Fill cache (downloading sheets concurrently)
         sessionNames = []
+        report = prefetchSheets(BACKUP_SHEETS)
         for sheetName in BACKUP_SHEETS:
             sheet = getSheet(sheetName)
             if sheet and sheetName == INDEX_SHEET:
                 sessionNames = getColumns('id', sheet)
 
+        report += prefetchSheets(sessionNames)
         for sheetName in sessionNames:
             sessionSheet = getSheet(sheetName)
+        print('sdproxy.freezeCache:', ' '.join(report), file=sys.stderr)
     suspend_cache('freeze')
 
 
@@ -478,32 +555,37 @@ def backupSheets(dirpath):
     if Settings['debug']:
         print("DEBUG:backupSheets: %s started %s" % (dirpath, datetime.datetime.now()), file=sys.stderr)
     errorList = []
+    report = []
     try:
         if not os.path.exists(dirpath):
             os.makedirs(dirpath)
 
         sessionAttributes = None
-        for sheetName in BACKUP_SHEETS:
-            rows = backupSheet(sheetName, dirpath, errorList, optional=True)
-            if sheetName == INDEX_SHEET and rows and 'id' in rows[0]:
-                try:
-                    idCol = rows[0].index('id')
-                    attributesCol = rows[0].index('attributes')
-                    sessionAttributes = [(row[idCol], json.loads(row[attributesCol])) for row in rows[1:]]
-                except Exception, excp:
-                    errorList.append('Error: Session attributes not loadable %s' % excp)
+        rows = backupSheetList(BACKUP_SHEETS, dirpath, errorList, report, optional=BACKUP_SHEETS).get(INDEX_SHEET)
+        if rows and 'id' in rows[0]:
+            try:
+                idCol = rows[0].index('id')
+                attributesCol = rows[0].index('attributes')
+                sessionAttributes = [(row[idCol], json.loads(row[attributesCol])) for row in rows[1:]]
+            except Exception, excp:
+                errorList.append('Error: Session attributes not loadable %s' % excp)
 
         if sessionAttributes is None and not errorList:
             errorList.append('Error: Session attributes not found in index sheet %s' % INDEX_SHEET)
 
+        sheetNames = []
+        optional = []
         for name, attributes in (sessionAttributes or []):
-            backupSheet(name, dirpath, errorList)
+            sheetNames.append(name)
             if attributes.get('discussSlides'):
-                backupSheet(name+'_discuss', dirpath, errorList, optional=True)
+                sheetNames.append(name+'_discuss')
+                optional.append(name+'_discuss')
+        backupSheetList(sheetNames, dirpath, errorList, report, optional=optional)
     except Exception, excp:
         errorList.append('Error in backup: '+str(excp))
 
     suspend_cache('')
+    print('sdproxy.backupSheets:', ' '.join(report), file=sys.stderr)
     return errorList
 
 
@@ -516,13 +598,46 @@ def backupCell(value):
         return value.encode('utf-8')
     return str(value)
 
+def csvChunks(rows, chunkRows=EXPORT_CHUNK_ROWS):
+    # Generator for CSV text of rows (iterable), in chunks of chunkRows rows
+    memfile = io.BytesIO()
+    writer = csv.writer(memfile)
+    for j, row in enumerate(rows):
+        writer.writerow([backupCell(x) for x in row])
+        if (j+1) % chunkRows == 0:
+            yield memfile.getvalue()
+            memfile.seek(0)
+            memfile.truncate()
+    if memfile.tell():
+        yield memfile.getvalue()
+    memfile.close()
+
+
+def backupSheetList(names, dirpath, errorList, report, optional=[]):
+    # Backup sheets, downloading uncached sheets concurrently (CSV files are written as downloads complete)
+    # Returns dict of rows for sheets that were backed up; appends progress/timing info to report
+    savedRows = {}
+    downloadNames = []
+    for name in names:
+        if not isFormulaSheet(name) and name in Sheet_cache:
+            savedRows[name] = backupSheet(name, dirpath, errorList)
+        else:
+            downloadNames.append(name)
+
+    def save_sheet(name, retval):
+        savedRows[name] = backupSheet(name, dirpath, errorList, optional=(name in optional), retval=retval)
+
+    report += downloadSheets(downloadNames, backup=True, callback=save_sheet)
+    return savedRows
 
-def backupSheet(name, dirpath, errorList, optional=False):
-    if not isFormulaSheet(name) and name in Sheet_cache:
+def backupSheet(name, dirpath, errorList, optional=False, retval=None):
+    # If retval, use already downloaded sheet values
+    if retval is None and not isFormulaSheet(name) and name in Sheet_cache:
         rows = Sheet_cache[name].xrows   # Not a copy
 
     else:
-        retval = downloadSheet(name, backup=True)
+        if retval is None:
+            retval = downloadSheet(name, backup=True)
 
         if retval['result'] != 'success':
             errorList.append('Error in downloading %s sheet %s: %s' % (Settings['site_name'], name, retval['error']))
@@ -606,6 +721,7 @@ def getSheet(sheetName, require=False, backup=False, display=False):
         check_if_locked(sheetName, get=True, backup=backup, cached=cached)
 
     if cached:
+        Global.cacheHits += 1
         return Sheet_cache[sheetName]
     elif not require and sheetName in Miss_cache:
         # Wait for minimum time before re-checking for sheet
@@ -623,6 +739,14 @@ def getSheet(sheetName, require=False, backup=False, display=False):
             raise Exception(errMsg)
         time.sleep(6)
 
+    Global.cacheMisses += 1
+    if Settings['journal_dir']:
+        # Restore sheet from journal, if available (instead of downloading it)
+        sheet = journalLoad(sheetName)
+        if sheet:
+            Sheet_cache[sheetName] = sheet
+            return sheet
+
     # Retrieve sheet
     if Settings['debug'] and not Settings['gsheet_url']:
         return None
@@ -639,19 +763,40 @@ def getSheet(sheetName, require=False, backup=False, display=False):
         Miss_cache[sheetName] = sliauth.epoch_ms()
         return None
 
-    Sheet_cache[sheetName] = Sheet(sheetName, rows, keyHeader=getKeyHeader(sheetName), updated=True,
+    return cacheDownloadedSheet(sheetName, retval)
+
+def cacheDownloadedSheet(sheetName, retval):
+    Sheet_cache[sheetName] = Sheet(sheetName, retval['value'], keyHeader=getKeyHeader(sheetName), updated=True,
                                    relatedSheets=retval.get('info',{}).get('sheetsAvailable',[]))
+    journalSnapshot(Sheet_cache[sheetName])
     return Sheet_cache[sheetName]
 
-def downloadSheet(sheetName, backup=False):
-    # Download sheet synchronously
-    # If backup, retrieve formulas rather than values
-    if Global.previewStatus.get('sessionName') == sheetName:
-        raise Exception('Cannot download when previewing session '+Global.previewStatus['sessionName'])
+def prefetchSheets(sheetNames):
+    # Download uncached sheets concurrently and add them to cache (getSheet handles any sheets not prefetched)
+    # Returns progress/timing report (list of strings)
+    fetchNames = []
+    for sheetName in sheetNames:
+        if sheetName in Sheet_cache or sheetName in Miss_cache or sheetName in Lock_cache or upstreamLockable(sheetName):
+            continue
+        if Settings['journal_dir'] and os.path.exists(journalPaths(sheetName)[0]):
+            continue
+        fetchNames.append(sheetName)
 
-    if Settings['dry_run'] and sheetName in Global.dryDeletedSheets:
-        return  {'result': 'success', 'value': []}
+    results = []
+    report = downloadSheets(fetchNames, callback=lambda sheetName, retval: results.append((sheetName, retval)))
+
+    # Create sheets after all downloads are complete (sheet creation may schedule cache updates)
+    for sheetName, retval in results:
+        if retval['result'] != 'success':
+            continue
+        if retval.get('value'):
+            cacheDownloadedSheet(sheetName, retval)
+        else:
+            Miss_cache[sheetName] = sliauth.epoch_ms()
+    return report
 
+def downloadParams(sheetName, backup=False):
+    # If backup, retrieve formulas rather than values
     user = ADMINUSER_ID
     userToken = gen_proxy_token(user, ADMIN_ROLE)
 
@@ -661,6 +806,30 @@ def downloadSheet(sheetName, backup=False):
 
     if parseNumber(Settings['log_call']) and parseNumber(Settings['log_call']) > 1:
         getParams['logcall'] = str(Settings['log_call'])
+    return getParams
+
+def checkRemoteVersion(retval):
+    remoteVersion = retval.get('info',{}).get('version','')
+    if sliauth.get_version(sub=1) != sliauth.sub_version(remoteVersion):
+        suspend_cache('version_mismatch')
+    Global.remoteVersions.add(remoteVersion)
+    checkRemoteEncodings(retval)
+
+def checkRemoteEncodings(retval):
+    # Enable compact updates only if upstream script reports that it can decode them (older scripts do not)
+    if Global.updateCompact is None and retval.get('info'):
+        Global.updateCompact = 'gzip' in retval['info'].get('proxyEncodings', [])
+
+def downloadSheet(sheetName, backup=False):
+    # Download sheet synchronously
+    # If backup, retrieve formulas rather than values
+    if Global.previewStatus.get('sessionName') == sheetName:
+        raise Exception('Cannot download when previewing session '+Global.previewStatus['sessionName'])
+
+    if Settings['dry_run'] and sheetName in Global.dryDeletedSheets:
+        return  {'result': 'success', 'value': []}
+
+    getParams = downloadParams(sheetName, backup=backup)
 
     ##if Settings['debug']:
     ##    print("DEBUG:downloadSheet", sheetName, getParams, file=sys.stderr)
@@ -673,13 +842,90 @@ def downloadSheet(sheetName, backup=False):
     if Settings['debug'] and Settings['dry_run']:
         print("DEBUG:downloadSheet", sheetName, retval['result'], retval.get('info',{}).get('version'), retval.get('bytes'), retval.get('messages'), file=sys.stderr)
 
-    remoteVersion = retval.get('info',{}).get('version','')
-    if sliauth.get_version(sub=1) != sliauth.sub_version(remoteVersion):
-        suspend_cache('version_mismatch')
-    Global.remoteVersions.add(remoteVersion)
+    checkRemoteVersion(retval)
 
     return retval
 
+def downloadSheets(sheetNames, backup=False, callback=None):
+    # Download sheets concurrently (synchronous; returns after all downloads are completed)
+    # At most DOWNLOAD_MAX_CONCURRENT requests are in flight, using a private IOLoop (like the synchronous HTTPClient).
+    # callback(sheetName, retval) is invoked as each download completes, overlapping with the remaining downloads,
+    # and must not schedule anything on the IOLoop.
+    # Returns progress/timing report (list of strings)
+    if not sheetNames:
+        return []
+
+    for sheetName in sheetNames:
+        if Global.previewStatus.get('sessionName') == sheetName:
+            raise Exception('Cannot download when previewing session '+Global.previewStatus['sessionName'])
+
+    pending = list(sheetNames)
+    status = {'active': 0, 'done': 0, 'bytes': 0, 'errors': 0, 'maxSec': 0.0}
+    responses = []
+    startTime = time.time()
+
+    ioloop = IOLoop()
+    http_client = tornado.httpclient.AsyncHTTPClient(io_loop=ioloop, force_instance=True, max_clients=DOWNLOAD_MAX_CONCURRENT)
+
+    def complete(sheetName, retval):
+        status['done'] += 1
+        if retval['result'] != 'success':
+            status['errors'] += 1
+        if callback:
+            try:
+                callback(sheetName, retval)
+            except Exception, excp:
+                print('sdproxy.downloadSheets: Error in processing sheet %s: %s' % (sheetName, excp), file=sys.stderr)
+                status['errors'] += 1
+
+    def fetch_next():
+        while pending and status['active'] < DOWNLOAD_MAX_CONCURRENT:
+            sheetName = pending.pop(0)
+            if Settings['dry_run'] and sheetName in Global.dryDeletedSheets:
+                complete(sheetName, {'result': 'success', 'value': []})
+            elif not Settings['gsheet_url']:
+                complete(sheetName, {'result': 'error', 'error': 'No Sheet URL'})
+            else:
+                status['active'] += 1
+                request = tornado.httpclient.HTTPRequest(Settings['gsheet_url'], method='POST', headers=None,
+                                                         body=urllib.urlencode(downloadParams(sheetName, backup=backup)),
+                                                         connect_timeout=20, request_timeout=Settings['request_timeout'])
+                http_client.fetch(request, functools.partial(handle_response, sheetName, time.time()))
+        if not status['active']:
+            ioloop.stop()
+
+    def handle_response(sheetName, requestTime, response):
+        status['active'] -= 1
+        status['maxSec'] = max(status['maxSec'], time.time()-requestTime)
+        if response.error:
+            retval = {'result': 'error', 'error': 'ERROR in accessing URL %s: %s' % (Settings['gsheet_url'], response.error)}
+        else:
+            status['bytes'] += len(response.body)
+            try:
+                retval = json.loads(response.body)
+                retval['bytes'] = len(response.body)
+                responses.append(retval)
+            except Exception, excp:
+                retval = {'result': 'error', 'error': 'Error in downloadSheets: result='+str(response.body)+': '+str(excp)}
+        if Settings['debug']:
+            print("DEBUG:downloadSheets: %s %s %.2fs (%d/%d)" % (sheetName, retval['result'], time.time()-requestTime, status['done']+1, len(sheetNames)), file=sys.stderr)
+        complete(sheetName, retval)
+        fetch_next()
+
+    try:
+        ioloop.add_callback(fetch_next)
+        ioloop.start()
+    finally:
+        http_client.close()
+        ioloop.close()
+
+    for retval in responses:
+        checkRemoteVersion(retval)
+
+    return ['Downloaded %d/%d sheets from %s (%dKB) in %.1fs (max %.1fs per sheet, %d concurrent, %d errors)' %
+            (status['done'], len(sheetNames), Settings['site_name'] or 'site', status['bytes']/1024, time.time()-startTime,
+             status['maxSec'], DOWNLOAD_MAX_CONCURRENT, status['errors'])]
+
 def createSheet(sheetName, headers, overwrite=False, rows=[]):
     # Overwrite should be true only for related sheets without original content (e.g., _answers, _correct, _stats)
     check_if_locked(sheetName)
@@ -702,9 +948,126 @@ def createSheet(sheetName, headers, overwrite=False, rows=[]):
 
     Sheet_cache[sheetName] = Sheet(sheetName, [headers]+rows, keyHeader=getKeyHeader(sheetName), modTime=sliauth.epoch_ms())
     Sheet_cache[sheetName].modifiedSheet()
+    journalSnapshot(Sheet_cache[sheetName])
     return Sheet_cache[sheetName]
 
 
+def journal_value(obj):
+    # Encode values for journal (dates are tagged, so that they are restored as dates)
+    if isinstance(obj, datetime.datetime):
+        return {'_date': sliauth.epoch_ms(obj)}
+    if isinstance(obj, set):
+        return sorted(obj)
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+def journal_object(obj):
+    if '_date' in obj:
+        return createDate(obj['_date'])
+    return obj
+
+def journalPaths(sheetName):
+    # Return (snapshot path, journal path) for sheet
+    journalDir = Settings['journal_dir']
+    if Settings['site_name']:
+        journalDir = os.path.join(journalDir, Settings['site_name'])
+    if not os.path.isdir(journalDir):
+        os.makedirs(journalDir)
+    return os.path.join(journalDir, sheetName+'.snap.json'), os.path.join(journalDir, sheetName+'.journal')
+
+def journalClose(sheet):
+    sheet.journalDeferred = False
+    if sheet.journalFile:
+        sheet.journalFile.close()
+        sheet.journalFile = None
+
+def journalDefer(sheet):
+    # Remove snapshot and journal for sheet with no modifications pending upstream (so that a restart does not restore stale data);
+    # the snapshot is written when the sheet is next modified (see Sheet.journal)
+    journalClose(sheet)
+    if not Settings['journal_dir'] or sheet.readOnly:
+        return
+    for path in journalPaths(sheet.name):
+        if os.path.exists(path):
+            os.remove(path)
+    sheet.journalDeferred = True
+
+def journalSnapshot(sheet, force=False):
+    # Write compacted snapshot of sheet and start new (empty) journal for it
+    # (unless force, only if the sheet has modifications pending upstream; otherwise defer snapshot)
+    journalClose(sheet)
+    if not Settings['journal_dir'] or sheet.readOnly:
+        return
+    if not force and sheet.get_updates() is None:
+        journalDefer(sheet)
+        return
+    snapPath, journalPath = journalPaths(sheet.name)
+    generation = uuid.uuid4().hex
+    snap = {'generation': generation, 'keyHeader': sheet.keyHeader, 'rows': sheet.xrows,
+            'keyMap': [[key, v[0], v[1], v[2]] for key, v in sheet.keyMap.items()],
+            'deletedRowCount': sheet.deletedRowCount, 'modTime': sheet.modTime, 'actions': sheet.actionsRequested,
+            'modifiedHeaders': sheet.modifiedHeaders, 'relatedSheets': sheet.relatedSheets}
+    # Write snapshot atomically; the journal for the previous snapshot is ignored once the generation changes
+    with open(snapPath+'.tmp', 'w') as f:
+        json.dump(snap, f, default=journal_value)
+    os.rename(snapPath+'.tmp', snapPath)
+    sheet.journalFile = open(journalPath, 'w')
+    sheet.journalCount = 0
+    sheet.journalFile.write(json.dumps(['snapshot', generation])+'\n')
+    sheet.journalFile.flush()
+
+def journalLoad(sheetName):
+    # Return sheet restored from snapshot and journal (or None)
+    snapPath, journalPath = journalPaths(sheetName)
+    if not os.path.exists(snapPath):
+        return None
+    try:
+        with open(snapPath) as f:
+            snap = json.load(f, object_hook=journal_object)
+        keyMap = dict( (x[0], [x[1], x[2], set(x[3])]) for x in snap['keyMap'] )
+        sheet = Sheet(sheetName, snap['rows'], keyHeader=snap['keyHeader'], modTime=snap['modTime'], keyMap=keyMap,
+                      actions=','.join(snap['actions']), updated=True, deletedRowCount=snap['deletedRowCount'],
+                      modifiedHeaders=snap['modifiedHeaders'], relatedSheets=snap['relatedSheets'])
+        replayCount = 0
+        if os.path.exists(journalPath):
+            with open(journalPath) as f:
+                if json.loads(f.readline() or 'null') == ['snapshot', snap['generation']]:
+                    for line in f:
+                        if not line.endswith('\n'):
+                            # Incomplete last record
+                            break
+                        sheet.replay(json.loads(line, object_hook=journal_object))
+                        replayCount += 1
+        sheet.reindex()
+    except Exception, excp:
+        print('sdproxy.journalLoad: Error in restoring sheet %s from journal: %s' % (sheetName, excp), file=sys.stderr)
+        journalRemove(sheetName)
+        return None
+
+    print('sdproxy.journalLoad: Restored sheet %s (%d rows, %d journal records)' % (sheetName, len(sheet.xrows)-1, replayCount), file=sys.stderr)
+    # Force update request (to propagate any pending row deletions)
+    sheet.modifiedSheet()
+    journalSnapshot(sheet, force=True)
+    return sheet
+
+def journalRemove(sheetName):
+    if not Settings['journal_dir']:
+        return
+    if sheetName in Sheet_cache:
+        journalClose(Sheet_cache[sheetName])
+    for path in journalPaths(sheetName):
+        if os.path.exists(path):
+            os.remove(path)
+
+def journalClear():
+    # Remove all journal files for site
+    if not Settings['journal_dir']:
+        return
+    journalDir = os.path.dirname(journalPaths('')[0])
+    for fname in os.listdir(journalDir):
+        if fname.endswith('.snap.json') or fname.endswith('.journal'):
+            os.remove(os.path.join(journalDir, fname))
+
+
 class Sheet(object):
     # Implements a simple spreadsheet with fixed number of columns
     @classmethod
@@ -739,6 +1102,15 @@ class Sheet(object):
 
         self.readOnly = isReadOnly(name)
         self.holdSec = CACHE_HOLD_SEC
+        self.memoryEstimate = (None, 0)   # ((modTime, rowCount), bytes) for last memory_usage computation
+        self.derivedInfo = None           # (signature, session row stamps) for derived sheets (_answers etc.) that are updated incrementally
+        self.sessionCache = OrderedDict() # row key -> (session_hidden value, decoded session), least recently used first
+        self.responseTallies = {}         # response column number -> ResponseTally (see getResponseTally)
+
+        # Compact storage: data rows are immutable tuples of interned values, shared between copies of the sheet
+        # (header row is always a list)
+        self.compact = bool(Settings['compact_cache'])
+        self.internMap = {}
 
         self.nCols = len(rows[0])
 
@@ -746,7 +1118,13 @@ class Sheet(object):
             if len(row) != self.nCols:
                 raise Exception('Incorrect number of cols in row %d: expected %d but found %d' % (j+1, self.nCols, len(row)))
 
-        self.xrows = [ row[:] for row in rows ]  # Shallow copy
+        self.xrows = [ rows[0][:] ]
+        for row in rows[1:]:
+            if self.compact and isinstance(row, tuple):
+                # Compact row (already parsed); no need to copy
+                self.xrows.append(row)
+            else:
+                self.xrows.append(list(row))  # Shallow copy
 
         if not self.keyHeader:
             self.keyCol= 0
@@ -757,12 +1135,22 @@ class Sheet(object):
             headers = self.xrows[0]
             self.keyCol = 1 + headers.index(self.keyHeader)
 
-            for j, colName in enumerate(headers):
-                if colName.endswith('Timestamp') or colName.lower().endswith('date') or colName.lower().endswith('time'):
-                    for row in self.xrows[1:]:
-                        if row[j] and not isinstance(row[j], datetime.datetime):
-                            # Parse time string
-                            row[j] = createDate(row[j])
+            dateCols = [j for j, colName in enumerate(headers) if colName.endswith('Timestamp') or colName.lower().endswith('date') or colName.lower().endswith('time')]
+            for k in range(1, len(self.xrows)):
+                row = self.xrows[k]
+                for j in dateCols:
+                    if row[j] and not isinstance(row[j], datetime.datetime):
+                        # Parse time string
+                        if isinstance(row, tuple):
+                            row = self.xrows[k] = list(row)
+                        row[j] = createDate(row[j])
+
+        self.index_columns()
+
+        if self.compact:
+            for j in range(1, len(self.xrows)):
+                if not isinstance(self.xrows[j], tuple):
+                    self.xrows[j] = self.pack_values(self.xrows[j])
 
         self.update_total_formula()
 
@@ -780,11 +1168,25 @@ class Sheet(object):
         if self.keyCol and 1+len(self.keyMap) != len(self.xrows):
             raise Exception('Duplicate key in initial rows for sheet %s: %s' % (self.name, [x[self.keyCol-1] for x in self.xrows[1:]]))
 
+        # Keys of inserted/modified rows (so that updates need not scan all rows)
+        self.dirtyKeys = set(k for k, v in self.keyMap.items() if v[1] or v[2])
+        self.allKeys = None
+
+        self.keyRows = {}   # key->rowNum (keyed sheets only)
+        self.index_rows()
+
+        self.sharedStore = False  # True if row list and key maps are shared with a copy
+        self.ownedKeys = None     # Keys of rows not shared with a copy (None if never copied)
+
+        self.journalFile = None   # Write-ahead journal of modifications (see journalSnapshot)
+        self.journalCount = 0
+        self.journalDeferred = False  # True if snapshot is to be written on next modification (see journalDefer)
+
         if not updated:
             self.modifiedSheet(modTime)
 
-        if self.totalCols and len(self.xrows) > 1:
-            # Recompute total column, and update remote sheet if necessary
+        if self.totalCols and len(self.xrows) > 1 and keyMap is None:
+            # Recompute total column (not needed for copies), and update remote sheet if necessary
             for rowNum in range(2,len(self.xrows)+1):
                 self.update_total(rowNum)  # Will update row and sheet mod times, as needed
 
@@ -806,9 +1208,79 @@ class Sheet(object):
                     self.totalCols.append(j+totalCol+1)
             self.totalColSet = set(self.totalCols)
 
+    def pack_values(self, values, colMin=1):
+        # Return values as tuple, with short string values interned (compact storage)
+        # (values in hidden columns, like session_hidden, and long values are not interned, because superseded
+        #  values would be retained by the intern map)
+        internMap = self.internMap
+        noInternCols = self.noInternCols
+        return tuple(internMap.setdefault(x, x) if (type(x) is unicode and len(x) <= INTERN_MAX_LENGTH and colMin+j not in noInternCols) else x
+                     for j, x in enumerate(values))
+
+    def set_row_values(self, rowNum, colMin, values):
+        # Overwrite values in row, starting at colMin (compact rows are replaced, not modified)
+        row = self.xrows[rowNum-1]
+        if self.compact:
+            self.xrows[rowNum-1] = row[:colMin-1] + self.pack_values(values, colMin) + row[colMin-1+len(values):]
+        else:
+            row[colMin-1:colMin-1+len(values)] = values
+
+    def memory_usage(self):
+        # Return approximate memory (bytes) used by sheet rows and values (shared objects are counted once)
+        seen = set()
+        total = sys.getsizeof(self.xrows)
+        for row in self.xrows:
+            total += sys.getsizeof(row)
+            for value in row:
+                if id(value) not in seen:
+                    seen.add(id(value))
+                    total += sys.getsizeof(value)
+        total += sys.getsizeof(self.internMap)
+        for value in self.internMap:
+            if id(value) not in seen:
+                total += sys.getsizeof(value)
+        return total
+
+    def decoded_session(self, key, session_hidden):
+        # Returns copy of decoded session_hidden value for row, decoding it only if not cached
+        # (cache entries are validated against the session_hidden value, which is unchanged by grading etc.)
+        entry = self.sessionCache.pop(key, None)
+        if not entry or (entry[0] is not session_hidden and entry[0] != session_hidden):
+            entry = (session_hidden, decodeSession(session_hidden))
+            if len(self.sessionCache) >= SESSION_CACHE_MAX:
+                self.sessionCache.popitem(last=False)
+        self.sessionCache[key] = entry
+        return copySession(entry[1])
+
+    def update_tallies(self, rowNum, colMin, rowValues):
+        # Update response tallies for columns being set (before row values are modified)
+        row = self.xrows[rowNum-1]
+        for colNum, tally in self.responseTallies.items():
+            if colNum >= colMin and colNum < colMin+len(rowValues):
+                tally.update(row[self.keyCol-1], row[colNum-1], rowValues[colNum-colMin])
+
+    def memory_estimate(self):
+        # Return memory_usage, recomputing it only if the sheet has been modified since the last estimate
+        if self.memoryEstimate[0] != (self.modTime, len(self.xrows)):
+            self.memoryEstimate = ((self.modTime, len(self.xrows)), self.memory_usage())
+        return self.memoryEstimate[1]
+
+    def index_columns(self):
+        # Index header->colNum (last occurrence of duplicate headers)
+        self.colIndex = dict((header, j+1) for j, header in enumerate(self.xrows[0]))
+        self.noInternCols = set(j+1 for j, header in enumerate(self.xrows[0]) if header.lower().endswith('hidden'))
+
+    def index_rows(self, startRow=2):
+        # Re-index key->rowNum for rows starting at startRow (e.g., after insertion/deletion)
+        if not self.keyCol:
+            return
+        keyCol = self.keyCol
+        for j in range(startRow-1, len(self.xrows)):
+            self.keyRows[self.xrows[j][keyCol-1]] = j+1
+
     def update_total(self, rowNum):
         totalCol = self.totalCols[0]
-        row = self.xrows[rowNum-1]     # Not a copy!
+        row = self.xrows[rowNum-1]
 
         newVal = ''
         if row[self.keyCol-1]:
@@ -826,21 +1298,132 @@ class Sheet(object):
         if row[totalCol-1] == newVal:
             return False
         # Modify total value
-        row[totalCol-1] = newVal
-        modTime = sliauth.epoch_ms()
         key = self.xrows[rowNum-1][self.keyCol-1] if self.keyCol else rowNum+self.deletedRowCount
+        self.unshare()
+        self.own_row(rowNum, key)
+        self.set_row_values(rowNum, totalCol, [newVal])
+        modTime = sliauth.epoch_ms()
         if not self.keyMap[key][1]:
             # Not inserted row; mark total column as modified
             self.keyMap[key][2].add(totalCol)
+            self.dirtyKeys.add(key)
         self.keyMap[key][0] = modTime
+        self.journal_cells(rowNum, [[totalCol, newVal]])
         self.modifiedSheet(modTime)
         return True
 
     def copy(self):
-        # Returns "shallow" copy
-        return Sheet(self.name, self.xrows, keyHeader=self.keyHeader, modTime=self.modTime, accessTime=self.accessTime, keyMap=self.keyMap,
-                     deletedRowCount=self.deletedRowCount, actions=','.join(self.actionsRequested), modifiedHeaders=self.modifiedHeaders,
-                     relatedSheets=self.relatedSheets)
+        # Returns copy-on-write "snapshot" (in constant time)
+        # Both sheets share the row list and key maps until one of them is modified (see unshare);
+        # after that, individual rows and key map entries are shared until modified (see own_row)
+        other = Sheet.__new__(Sheet)
+        other.__dict__.update(self.__dict__)
+        other.holdSec = CACHE_HOLD_SEC
+        other.actionsRequested = self.actionsRequested[:]
+        other.relatedSheets = self.relatedSheets[:]
+        other.journalFile = None
+        other.journalDeferred = False
+        other.responseTallies = {}
+        for sheet in (self, other):
+            sheet.sharedStore = True
+            sheet.ownedKeys = set()
+        return other
+
+    def unshare(self):
+        # Copy row list and key maps shared with a copy of this sheet (before modifying them)
+        if not self.sharedStore:
+            return
+        self.sharedStore = False
+        self.xrows = [self.xrows[0][:]] + self.xrows[1:]
+        self.keyMap = self.keyMap.copy()
+        self.keyRows = self.keyRows.copy()
+        self.dirtyKeys = self.dirtyKeys.copy()
+
+    def own_row(self, rowNum, key):
+        # Copy row and key map entry shared with a copy of this sheet (before modifying them)
+        if self.ownedKeys is None or key in self.ownedKeys:
+            return
+        self.ownedKeys.add(key)
+        modTime, inserted, modCols = self.keyMap[key]
+        self.keyMap[key] = [modTime, inserted, modCols.copy()]
+        if not self.compact:
+            # (Compact rows are immutable)
+            self.xrows[rowNum-1] = self.xrows[rowNum-1][:]
+
+    def journal(self, *record):
+        # Append modification record to journal (if journaling)
+        if not self.journalFile:
+            if self.journalDeferred:
+                # First modification since sheet was last up to date; snapshot includes this modification
+                journalSnapshot(self, force=True)
+            return
+        self.journalFile.write(json.dumps(record, default=journal_value)+'\n')
+        self.journalFile.flush()
+        self.journalCount += 1
+        if self.journalCount >= JOURNAL_MAX_RECORDS:
+            journalSnapshot(self, force=True)
+
+    def journal_row(self, rowNum, op='row'):
+        if not self.journalFile and not self.journalDeferred:
+            return
+        key = self.xrows[rowNum-1][self.keyCol-1] if self.keyCol else rowNum+self.deletedRowCount
+        self.journal(op, rowNum, self.xrows[rowNum-1], self.keyMap[key])
+
+    def journal_cells(self, rowNum, cells):
+        # Journal modified cells ([colNum, value] list) of row
+        if not self.journalFile and not self.journalDeferred:
+            return
+        key = self.xrows[rowNum-1][self.keyCol-1] if self.keyCol else rowNum+self.deletedRowCount
+        self.journal('cells', rowNum, cells, self.keyMap[key])
+
+    def replay(self, record):
+        # Re-apply journal record (row/key indexes are rebuilt afterwards by reindex)
+        op = record[0]
+        if op in ('row', 'insert'):
+            rowNum, values, entry = record[1:]
+            row = self.pack_values(values) if self.compact else values
+            if op == 'insert':
+                self.xrows.insert(rowNum-1, row)
+            else:
+                self.xrows[rowNum-1] = row
+            key = values[self.keyCol-1] if self.keyCol else rowNum+self.deletedRowCount
+            self.keyMap[key] = [entry[0], entry[1], set(entry[2])]
+        elif op == 'cells':
+            rowNum, cells, entry = record[1:]
+            row = list(self.xrows[rowNum-1])
+            for colNum, value in cells:
+                row[colNum-1] = value
+            self.xrows[rowNum-1] = self.pack_values(row) if self.compact else row
+            key = row[self.keyCol-1] if self.keyCol else rowNum+self.deletedRowCount
+            self.keyMap[key] = [entry[0], entry[1], set(entry[2])]
+        elif op == 'delete':
+            del self.keyMap[self.xrows[record[1]-1][self.keyCol-1]]
+            del self.xrows[record[1]-1]
+        elif op == 'deleterows':
+            self.xrows = [self.xrows[0]] + self.xrows[2+record[1]-1:]
+            for j in range(record[1]):
+                del self.keyMap[2+self.deletedRowCount]
+                self.deletedRowCount += 1
+        elif op == 'clear':
+            self.actionsRequested = []
+            self.modifiedHeaders = False
+            for key, entry in self.keyMap.items():
+                self.keyMap[key] = [entry[0], 0, set()]
+        elif op == 'complete':
+            for key, entry in record[1]:
+                self.keyMap[key] = [entry[0], entry[1], set(entry[2])]
+            self.actionsRequested = record[2]
+            self.modifiedHeaders = record[3]
+        elif op == 'actions':
+            self.actionsRequested = record[1]
+        else:
+            raise Exception('Invalid journal record %s for sheet %s' % (op, self.name))
+
+    def reindex(self):
+        self.dirtyKeys = set(k for k, v in self.keyMap.items() if v[1] or v[2])
+        self.allKeys = None
+        self.keyRows = {}
+        self.index_rows()
 
     def expire(self):
         # Delete after any updates are processed
@@ -852,10 +1435,21 @@ class Sheet(object):
             self.actionsRequested += [x.strip() for x in actions.split(',')]
         else:
             self.actionsRequested = []
+        self.journal('actions', self.actionsRequested)
         schedule_update()
 
     def export(self, keepHidden=False, allUsers=False, csvFormat=False, idRename='', altidRename=''):
-        headers = self.xrows[0][:]
+        rows = self.export_rows(keepHidden=keepHidden, allUsers=allUsers, idRename=idRename, altidRename=altidRename)
+        if csvFormat:
+            return ''.join(csvChunks(rows))
+        else:
+            return list(rows)
+
+    def export_rows(self, keepHidden=False, allUsers=False, idRename='', altidRename=''):
+        # Generator for header row followed by exported data rows
+        # (rows are generated from the row list at the time of the call; use a copy of the sheet if it may be modified meanwhile)
+        xrows = self.xrows
+        headers = xrows[0][:]
         if idRename and 'id' in headers:
             headers[headers.index('id')] = idRename
         if altidRename and 'altid' in headers:
@@ -870,27 +1464,15 @@ class Sheet(object):
         if not allUsers and 'name' in headers:
             skipName = headers.index('name')
 
-        dataRows =[]
-        for j in range(len(self.xrows)-1):
+        yield headers
+        for j in range(1, len(xrows)):
             # Ensure all rows have the same number of columns
-            temRow = self.xrows[j+1][:] + ['']*(len(headers)-len(self.xrows[j+1]))
+            temRow = list(xrows[j]) + ['']*(len(headers)-len(xrows[j]))
             if skipName is not None and (not temRow[skipName] or temRow[skipName].startswith('#')):
                 continue
             for k in hideCols:
                 temRow[k] = 'hidden'
-            dataRows.append(temRow)
-
-        if csvFormat:
-            memfile = io.BytesIO()
-            writer = csv.writer(memfile)
-            writer.writerow(headers)
-            for row in dataRows:
-                writer.writerow([backupCell(x) for x in row])
-            content = memfile.getvalue()
-            memfile.close()
-            return content
-        else:
-            return [headers] + dataRows
+            yield temRow
 
     def getLastColumn(self):
         return self.nCols
@@ -900,10 +1482,18 @@ class Sheet(object):
 
     def getHeaders(self):
         return self.xrows[0] if self.xrows else None
+
+    def getColumnIndex(self):
+        # Return header->colNum dict (not a copy!)
+        return self.colIndex
+
+    def getKeyRow(self, keyValue):
+        # Return row number for key value (or 0, if not found)
+        return self.keyRows.get(keyValue, 0)
     
     def getRows(self):
         # Return shallow copy
-        return [ row[:] for row in self.xrows ]
+        return [ list(row) for row in self.xrows ]
 
     def deleteRow(self, rowNum):
         if not self.keyHeader:
@@ -912,8 +1502,16 @@ class Sheet(object):
             raise Exception('Invalid row number %s for deletion in sheet %s' % (rowNum, self.name))
         keyValue = self.xrows[rowNum-1][self.keyCol-1]
         self.check_lock_status(keyValue)
+        if self.responseTallies:
+            self.update_tallies(rowNum, 1, ['']*self.nCols)
+        self.unshare()
         del self.xrows[rowNum-1]
         del self.keyMap[keyValue]
+        self.dirtyKeys.discard(keyValue)
+        self.allKeys = None
+        del self.keyRows[keyValue]
+        self.index_rows(rowNum)
+        self.journal('delete', rowNum)
         self.modifiedSheet()
 
     def deleteRows(self, startRow, nRows):
@@ -924,11 +1522,14 @@ class Sheet(object):
         lastDelRow = 2+nRows-1  # Delete rows starting from row 2
         if lastDelRow > len(self.xrows):
             raise Exception('Invalid delete rows %s for deletion in sheet %s (maxrows=%s)' % (nRows, self.name, len(self.xrows)))
+        self.unshare()
         self.xrows = [self.xrows[0]] + self.xrows[lastDelRow:]
         for j in range(nRows):
             key = 2+self.deletedRowCount
             del self.keyMap[key]
+            self.dirtyKeys.discard(key)
             self.deletedRowCount += 1
+        self.journal('deleterows', nRows)
         self.modifiedSheet()
 
     def insertRowBefore(self, rowNum, keyValue=None):
@@ -948,28 +1549,42 @@ class Sheet(object):
                 raise Exception('Must specify key for row insertion in sheet '+self.name)
             if keyValue in self.keyMap:
                 raise Exception('Duplicate key %s for row insertion in sheet %s' % (keyValue, self.name))
-            newRow[self.keyCol-1] = keyValue
-            self.keyMap[keyValue] = [modTime, 1, set()]
         else:
-            self.keyMap[rowNum+self.deletedRowCount] = [modTime, 1, set()]
+            keyValue = rowNum+self.deletedRowCount
+
+        self.unshare()
+        if self.keyHeader:
+            newRow[self.keyCol-1] = keyValue
+            self.allKeys = None
+        self.keyMap[keyValue] = [modTime, 1, set()]
+        self.dirtyKeys.add(keyValue)
+        if self.ownedKeys is not None:
+            self.ownedKeys.add(keyValue)
 
         if self.totalCols:
             newRow[self.totalCols[0]-1] = 0
             
-        self.xrows.insert(rowNum-1, newRow)
+        self.xrows.insert(rowNum-1, self.pack_values(newRow) if self.compact else newRow)
+        self.index_rows(rowNum)
+        self.journal_row(rowNum, op='insert')
         self.modifiedSheet(modTime)
 
     def appendColumns(self, headers):
         self.check_lock_status()
         if self.modifiedHeaders:
             raise Exception('Cannot append columns now while updating sheet '+self.name)
+        self.unshare()
         self.nCols += len(headers)
         self.xrows[0] += headers
+        blanks = ('',)*len(headers) if self.compact else ['']*len(headers)
         for j in range(1, len(self.xrows)):
-            self.xrows[j] += ['']*len(headers)
+            self.xrows[j] = self.xrows[j] + blanks
 
         self.update_total_formula()
+        self.index_columns()
         self.modifiedHeaders = True
+        if self.journalFile or self.journalDeferred:
+            journalSnapshot(self, force=True)
         self.modifiedSheet()
 
     def trimColumns(self, ncols, delayMods=False):
@@ -978,6 +1593,8 @@ class Sheet(object):
         if self.modifiedHeaders:
             raise Exception('Cannot trim columns now while updating sheet '+self.name)
 
+        self.unshare()
+        self.responseTallies = {}
         modTime = sliauth.epoch_ms()
         self.nCols -= ncols
         trimmedCols = set( range(self.nCols+1, self.nCols+ncols+1) )
@@ -987,12 +1604,18 @@ class Sheet(object):
             if j:
                 key = self.xrows[j][self.keyCol-1] if self.keyCol else j+1+self.deletedRowCount
                 if self.keyMap[key][2]:
-                    self.keyMap[key][2].difference_update(trimmedCols)
+                    rowModTime, inserted, modCols = self.keyMap[key]
+                    self.keyMap[key] = [rowModTime, inserted, modCols.difference(trimmedCols)]
+                    if not self.keyMap[key][1] and not self.keyMap[key][2]:
+                        self.dirtyKeys.discard(key)
 
+        self.index_columns()
         if delayMods:
             return
         self.update_total_formula()
         self.modifiedHeaders = True
+        if self.journalFile or self.journalDeferred:
+            journalSnapshot(self, force=True)
         self.modifiedSheet(modTime)
 
     def checkRange(self, rowMin, colMin, rowCount, colCount):
@@ -1033,6 +1656,8 @@ class Sheet(object):
             # Access time is not updated for read-only files => they will be periodically refreshed
             self.accessTime = sliauth.epoch_ms()
         self.checkRange(rowMin, colMin, rowCount, colCount)
+        if self.compact:
+            return [list(row[colMin-1:colMin+colCount-1]) for row in self.xrows[rowMin-1:rowMin+rowCount-1]]
         return [row[colMin-1:colMin+colCount-1] for row in self.xrows[rowMin-1:rowMin+rowCount-1]]
 
     def check_lock_status(self, keyValue=None):
@@ -1067,6 +1692,7 @@ class Sheet(object):
                 raise Exception('Col count mismatch for _setSheetValues %s in row %d: expected %d but found %d' % (self.name, j+rowMin, colCount, len(rowValues)) )
 
         self.check_lock_status(self.xrows[rowMin-1][self.keyCol-1] if self.keyCol and rowCount==1 else '')
+        self.unshare()
 
         headers = self.xrows[0]
         modTime = 0
@@ -1104,7 +1730,9 @@ class Sheet(object):
                         # Column value not equal; expand set of modified columns
                         updateSheet = True
                         diffCol = icol+colMin
+                        self.own_row(rowNum, keyValue)
                         self.keyMap[keyValue][2].add(diffCol)
+                        self.dirtyKeys.add(keyValue)
                         if diffCol in self.totalColSet:
                             # Column affecting total being updated
                             updateTotal = True
@@ -1112,8 +1740,15 @@ class Sheet(object):
             if updateSheet:
                 # At least one column value not equal or inserted row; update row
                 modTime = sliauth.epoch_ms()
+                self.own_row(rowNum, keyValue)
                 self.keyMap[keyValue][0] = modTime
-                self.xrows[rowNum-1][colMin-1:colMin+colCount-1] = rowValues
+                if self.responseTallies:
+                    self.update_tallies(rowNum, colMin, rowValues)
+                if self.journalFile or self.journalDeferred:
+                    oldValues = self.xrows[rowNum-1][colMin-1:colMin-1+len(rowValues)]
+                self.set_row_values(rowNum, colMin, rowValues)
+                if self.journalFile or self.journalDeferred:
+                    self.journal_cells(rowNum, [[colMin+j, value] for j, value in enumerate(rowValues) if value != oldValues[j]])
 
                 if updateTotal:
                     if self.update_total(rowNum):
@@ -1164,13 +1799,19 @@ class Sheet(object):
         updateElemCount = 0
 
         colSet, colList, curUpdate = None, None, None
-        allKeys = [row[self.keyCol-1] for row in self.xrows[1:] if row[self.keyCol-1]] if self.keyCol else None
+        prevRowNum = 0
 
-        for j, row in enumerate(self.xrows[1:]):
-            rowNum = j+2
-            key = row[self.keyCol-1] if self.keyCol else rowNum+self.deletedRowCount
-            if not key:  # Do not update any non-key rows
-                continue
+        # Delta rows: for rows appended to partial update block, send only modified cells ({colOffset: value})
+        # (partial update blocks also include the id column, so that upstream can check the position of delta rows)
+        deltaRows = Settings['compact_updates'] and Global.updateCompact
+        idCol = self.colIndex.get('id', 0)
+
+        for rowNum, key in self.dirty_rows():
+            row = self.xrows[rowNum-1]
+            if rowNum != prevRowNum+1:
+                # Skipped over unmodified rows; start new update block
+                colSet, colList, curUpdate = None, None, None
+            prevRowNum = rowNum
 
             inserted = self.keyMap[key][1]
             newColSet = self.keyMap[key][2]
@@ -1195,7 +1836,10 @@ class Sheet(object):
                 if colSet is not None and colSet.issuperset(newColSet) and len(colSet)-len(newColSet) <= 2:
                     # Extend "contiguous" block for modified/unmodified row; append to previous row update
                     curUpdate[0].append(key)
-                    subRow = [row[jcol-1] for jcol in colList]
+                    if deltaRows and len(newColSet) < len(colSet):
+                        subRow = dict((j, row[jcol-1]) for j, jcol in enumerate(colList) if jcol in newColSet or jcol == idCol)
+                    else:
+                        subRow = [row[jcol-1] for jcol in colList]
                     curUpdate[2].append(subRow)
 
                 else:
@@ -1203,6 +1847,8 @@ class Sheet(object):
                     updateColSet.update(newColSet)
                     colSet = newColSet
                     colList = list(colSet)
+                    if deltaRows and idCol and idCol not in colSet:
+                        colList.append(idCol)
                     colList.sort()
 
                     subRow = [row[jcol-1] for jcol in colList]
@@ -1227,23 +1873,37 @@ class Sheet(object):
                     # Non-partial or non-keyed; update full rows
                     updateSel.append( [[keyRow], None, [row]] )
 
-        if not insertRows and not updateSel and not actions and not self.modifiedHeaders and (not self.modTime or self.modTime < Global.cacheUpdateTime):
+        if not insertRows and not updateSel and not actions and not self.modifiedHeaders and (not self.modTime or self.modTime < max(Global.cacheUpdateTime, Global.sheetUpdateTimes.get(self.name, 0))):
             # No updates
             return None
 
+        if self.keyCol and self.allKeys is None:
+            # Cached until rows are inserted/deleted
+            self.allKeys = [row[self.keyCol-1] for row in self.xrows[1:] if row[self.keyCol-1]]
+
         # Send updateColList if non-null and non-full row
         updateColList = sorted(list(updateColSet)) if (updateColSet and len(updateColSet) < self.nCols) else None
 
         updateParams = {'incompleteUpdate': incompleteUpdate, 'actions': actions, 'modifiedHeaders': self.modifiedHeaders}
-        return [updateRows, updateParams, headers, self.getLastRow(), allKeys, insertNames, updateColList, insertRows, updateSel]
-                    
+        return [updateRows, updateParams, headers, self.getLastRow(), self.allKeys, insertNames, updateColList, insertRows, updateSel]
+
+    def dirty_rows(self):
+        # Returns sorted list of [rowNum, key] for inserted/modified rows with non-null keys
+        if not self.dirtyKeys:
+            return []
+        if self.keyCol:
+            return sorted([self.keyRows[key], key] for key in self.dirtyKeys if key)
+        else:
+            return sorted([key-self.deletedRowCount, key] for key in self.dirtyKeys)
+
     def clear_update(self):
         self.actionsRequested = []
         self.modifiedHeaders = False
-        for j, row in enumerate(self.xrows[1:]):
-            key = row[self.keyCol-1] if self.keyCol else j+2+self.deletedRowCount
-            if self.keyMap[key][1] or self.keyMap[key][2]:
-                self.keyMap[key][1:3] = [0, set()]
+        self.unshare()
+        for key in self.dirtyKeys:
+            self.keyMap[key] = [self.keyMap[key][0], 0, set()]
+        self.dirtyKeys = set()
+        self.journal('clear')
 
     def complete_update(self, updateRows, updateParams):
         # Update sheet status after remote update has completed
@@ -1260,17 +1920,29 @@ class Sheet(object):
         if not updateParams.get('incompleteUpdate') and updateParams.get('modifiedHeaders'):
             self.modifiedHeaders = False
 
-        for j, row in enumerate(self.xrows[1:]):
-            key = row[self.keyCol-1] if self.keyCol else j+2+self.deletedRowCount
+        self.unshare()
+        for key, updateTime in updateRows.items():
+            if key not in self.keyMap:
+                # Row deleted since update
+                continue
 
-            if key in updateRows:
-                if updateRows[key] == self.keyMap[key][0]:
-                    # Row update completed for row not modified since update
-                    # (Note: Rows that were not updated due request limits being reached will not be subject to this reset)
-                    self.keyMap[key][1:3] = [0, set()]
-                elif not self.keyCol:
-                    # Non-keyed row has been inserted, but modified later
-                    self.keyMap[key][1:3] = [0, set(range(1,self.nCols+1))]
+            if updateTime == self.keyMap[key][0]:
+                # Row update completed for row not modified since update
+                # (Note: Rows that were not updated due request limits being reached will not be subject to this reset)
+                self.keyMap[key] = [updateTime, 0, set()]
+                self.dirtyKeys.discard(key)
+            elif not self.keyCol:
+                # Non-keyed row has been inserted, but modified later
+                self.keyMap[key] = [self.keyMap[key][0], 0, set(range(1,self.nCols+1))]
+                self.dirtyKeys.add(key)
+
+        if self.journalFile:
+            if self.get_updates() is None:
+                # Up to date with upstream; discard snapshot and journal
+                journalDefer(self)
+            else:
+                self.journal('complete', [[key, self.keyMap[key]] for key in updateRows if key in self.keyMap],
+                             self.actionsRequested, self.modifiedHeaders)
 
 
 class Range(object):
@@ -1307,12 +1979,30 @@ def getCacheStatus():
     out += '  Suspend status: <b>%s</b>\n' % Global.suspended
     out += '  No. of updates (retries): %d (%d)\n' % (Global.totalCacheResponseCount, Global.totalCacheRetryCount)
     out += '  Average update time = %.2fs\n\n' % (Global.totalCacheResponseInterval/(1000*max(1,Global.totalCacheResponseCount)) )
-    out += '  Average request bytes = %d\n\n' % (Global.totalCacheRequestBytes/max(1,Global.totalCacheResponseCount) )
+    out += '  Average request bytes = %d (uncompressed %d, compact=%s)\n\n' % (Global.totalCacheRequestBytes/max(1,Global.totalCacheResponseCount),
+                                                                              Global.totalCacheRequestRawBytes/max(1,Global.totalCacheResponseCount),
+                                                                              bool(Settings['compact_updates'] and Global.updateCompact))
     out += '  Average response bytes = %d\n\n' % (Global.totalCacheResponseBytes/max(1,Global.totalCacheResponseCount) )
+    cacheRows, cacheMemory = cacheUsage()
+    out += '  Cache hits/misses: %d/%d, evictions: %d, expirations: %d\n' % (Global.cacheHits, Global.cacheMisses, Global.cacheEvictions, Global.cacheExpirations)
+    out += '  Cache budget: rows %d of %s, memory %dKB of %s\n\n' % (cacheRows, Settings['cache_max_rows'] or 'unlimited',
+                                                                      cacheMemory/1024, '%dMB' % Settings['cache_max_mb'] if Settings['cache_max_mb'] else 'unlimited')
     curTime = sliauth.epoch_ms()
+    pendingSheets = 0
+    pendingRows = 0
+    oldestModTime = curTime
+    for sheet in Sheet_cache.values():
+        if sheet.dirtyKeys:
+            pendingSheets += 1
+            pendingRows += len(sheet.dirtyKeys)
+            oldestModTime = min([oldestModTime] + [sheet.keyMap[key][0] for key in sheet.dirtyKeys])
+    oldestRequestTime = min([curTime] + [updater.cacheRequestTime for updater in Global.updateShards.values()])
+    out += '  Update requests in flight: %d, oldest %.1fs\n' % (len(Global.updateShards), (curTime-oldestRequestTime)/1000.)
+    out += '  Update queue: %d rows in %d sheets, lag %.1fs\n\n' % (pendingRows, pendingSheets, (curTime-oldestModTime)/1000.)
     sitePrefix = Settings['site_name']+'/' if Settings['site_name'] else ''
     keys = list( set(Sheet_cache.keys() + Lock_cache.keys()) )
     keys.sort()
+    totalMemory = 0
     for sheetName in keys:
         sheetStr = ''
         sheet = Sheet_cache.get(sheetName)
@@ -1331,6 +2021,9 @@ def getCacheStatus():
             accessTime = 'accessed:'+str(int((curTime-sheet.accessTime)/1000.))+'s'
             if sheet.modTime:
                 accessTime += '/modified:'+str(int((curTime-sheet.modTime)/1000.))+'s'
+            sheetMemory = sheet.memory_usage()
+            totalMemory += sheetMemory
+            accessTime += ' memory:%dKB' % (sheetMemory/1024)
 
             if Settings['debug']:
                 updates = sheet.get_updates(row_limit=PROXY_UPDATE_ROW_LIMIT)
@@ -1344,6 +2037,8 @@ def getCacheStatus():
 
         out += 'Sheet_cache: %s: %s %s %s\n' % (sheetName, accessTime, sheetStr, updateStr)
     out += '\n'
+    out += 'Sheet_cache memory: %dKB (compact=%s)\n' % (totalMemory/1024, bool(Settings['compact_cache']))
+    out += '\n'
     for sheetName in Miss_cache:
         out += 'Miss_cache: %s, %ds\n' % (sheetName, (curTime-Miss_cache[sheetName])/1000.)
     out += '\n'
@@ -1477,6 +2172,10 @@ def suspend_cache(action=''):
 
 def shutdown_loop():
     print('****Completed IO loop SHUTDOWN', Settings['site_name'], file=sys.stderr)
+    for sheet in Sheet_cache.values():
+        if sheet.journalFile and sheet.get_updates() is None:
+            # Discard snapshot and journal for sheets up to date with upstream
+            journalDefer(sheet)
     for sheetName in sorted(list(Locked_proxy_sheets)):
         try:
             lockUpstreamProxy(sheetName, unlock=True)
@@ -1538,6 +2237,10 @@ def updates_current():
         return
 
     if Global.suspended == 'clear':
+        # Discard journals along with cached sheets
+        for sheet in Sheet_cache.values():
+            journalClose(sheet)
+        journalClear()
         initCache()
         print("Cleared cache", file=sys.stderr)
     elif Global.suspended == 'shutdown':
@@ -1548,6 +2251,7 @@ def updates_current():
 def update_remote_sheets(force=False, synchronous=False):
     # If force, do not enforce minimum time delay restriction
     # If synchronous, wait for update to complete before returning
+    Global.cachePendingUpdate = None
     if synchronous and previewingSession():
         sheet_proxy_error('update_remote_sheets: Exit preview session %s before synchronous updates' % previewingSession())
         return
@@ -1561,28 +2265,38 @@ def update_remote_sheets(force=False, synchronous=False):
         sheet_proxy_error('Unexpected error in update_remote_sheets: %s' % excp)
 
 def update_remote_sheets_aux(force=False, synchronous=False):
-    if Global.cacheUpdateError or (Global.httpRequestId and not synchronous):
-        # Request currently active/disabled
-        # (synchronous request will supersede any active previous request)
+    # Updates are split into requests (shards) for disjoint sets of sheets, sent one at a time
+    # (the web app handles requests under a single lock, so concurrent requests would only wait for each other)
+    if synchronous:
+        # Synchronous request will supersede any active previous requests
+        Global.updateShards.clear()
+
+    if Global.cacheUpdateError or Global.updateShards:
+        # Request currently active/disabled (another update will be scheduled when the request completes)
         return
 
     curTime = sliauth.epoch_ms()
     if not force and not synchronous and (curTime - Global.cacheResponseTime) < 1000*Settings['min_wait_sec']:
-        schedule_update(waitSec=curTime-Global.cacheResponseTime)
+        schedule_update(waitSec=Settings['min_wait_sec']-(curTime-Global.cacheResponseTime)/1000.)
         return
 
     specialMods = []
     sessionMods = []
     sheetUpdateInfo = {}
+    evictable = []
     for sheetName, sheet in Sheet_cache.items():
         # Check each cached sheet for updates
         updates = sheet.get_updates(row_limit=PROXY_UPDATE_ROW_LIMIT)
         if updates is None:
             previewSession = previewingSession()
-            if curTime-sheet.accessTime > 1000*sheet.holdSec and sheetName not in Lock_cache and sheetName not in Global.transactSessions and (not previewSession or sheetName not in (INDEX_SHEET, previewSession)):
-                # Cache entry has expired
-                if Settings['gsheet_url']:
-                    delSheet(sheetName)
+            if sheetName not in Lock_cache and sheetName not in Global.transactSessions and (not previewSession or sheetName not in (INDEX_SHEET, previewSession)):
+                if curTime-sheet.accessTime > 1000*sheet.holdSec:
+                    # Cache entry has expired
+                    if Settings['gsheet_url']:
+                        delSheet(sheetName)
+                        Global.cacheExpirations += 1
+                else:
+                    evictable.append(sheetName)
             continue
 
         # update_rows, update_params
@@ -1596,15 +2310,17 @@ def update_remote_sheets_aux(force=False, synchronous=False):
         else:
             sessionMods.append(modVals)
 
+    if Settings['gsheet_url'] and (Settings['cache_max_rows'] or Settings['cache_max_mb']):
+        evictSheets(evictable)
+
     modRequests = specialMods + sessionMods
 
     if not modRequests:
         # Nothing to update
-        updates_current()
+        if not Global.updateShards:
+            updates_current()
         return
 
-    json_data = json.dumps(modRequests, default=sliauth.json_default)
-
     ##if Settings['debug']:
     ##    print("update_remote_sheets_aux: REQUEST %s partial=%s, log=%s, sheets=%s, ndata=%d" % (sliauth.iso_date(nosubsec=True), Global.updatePartial, Settings['log_call'], sorted(sheetUpdateInfo.keys()), len(json_data)), file=sys.stderr)
 
@@ -1622,8 +2338,68 @@ def update_remote_sheets_aux(force=False, synchronous=False):
         updates_current()
         return
 
-    proxy_updater = ProxyUpdater(sheetUpdateInfo, json_data, modRequests, synchronous=synchronous)
-    proxy_updater.update(curTime)
+    # Split updates into shards of bounded size ('*_slidoc' sheets are in the first shard)
+    shards = []
+    shardBytes = 0
+    for modVals in modRequests:
+        modJson = json.dumps(modVals, default=sliauth.json_default)
+        if not shards or (shardBytes + len(modJson) > PROXY_UPDATE_SHARD_BYTES and not modVals[0].endswith('_slidoc')):
+            shards.append( ([], []) )
+            shardBytes = 0
+        shards[-1][0].append(modVals)
+        shards[-1][1].append(modJson)
+        shardBytes += len(modJson)
+
+    heldShards = False
+    if not synchronous and len(shards) > 1:
+        # Remaining shards will be sent as soon as the first shard (with any '*_slidoc' sheets) completes
+        shards = shards[:1]
+        heldShards = True
+
+    for shardMods, shardJson in shards:
+        shardInfo = dict((modVals[0], sheetUpdateInfo[modVals[0]]) for modVals in shardMods)
+        proxy_updater = ProxyUpdater(shardInfo, '['+', '.join(shardJson)+']', shardMods, synchronous=synchronous)
+        proxy_updater.heldShards = heldShards
+        proxy_updater.update(curTime)
+
+
+def cacheUsage():
+    # Returns (total rows, approximate memory bytes) for cached sheets
+    totalRows = 0
+    totalMemory = 0
+    for sheet in Sheet_cache.values():
+        totalRows += len(sheet.xrows)
+        if Settings['cache_max_mb']:
+            totalMemory += sheet.memory_estimate()
+    return totalRows, totalMemory
+
+def evictSheets(sheetNames):
+    # Evict least recently used sheets, from sheetNames, until cache is within row/memory budget
+    # (sheetNames should only include clean sheets that are not locked, previewed, or transacted)
+    totalRows, totalMemory = cacheUsage()
+    for sheetName in sorted(sheetNames, key=lambda name: Sheet_cache[name].accessTime):
+        if (not Settings['cache_max_rows'] or totalRows <= Settings['cache_max_rows']) and (not Settings['cache_max_mb'] or totalMemory <= 1024*1024*Settings['cache_max_mb']):
+            break
+        sheet = Sheet_cache[sheetName]
+        totalRows -= len(sheet.xrows)
+        if Settings['cache_max_mb']:
+            totalMemory -= sheet.memory_estimate()
+        delSheet(sheetName)
+        Global.cacheEvictions += 1
+        if Settings['debug']:
+            print("DEBUG:evictSheets: Evicted sheet %s (cache rows=%d, memory=%dKB)" % (sheetName, totalRows, totalMemory/1024), file=sys.stderr)
+
+def encodeUpdateData(json_data):
+    # Return gzip-compressed, URL-safe base64-encoded data (for compact proxy updates)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+    return base64.urlsafe_b64encode(compressor.compress(json_data) + compressor.flush())
+
+def decodeUpdateData(data, encoding=''):
+    if not encoding:
+        return data
+    if encoding != 'gzip':
+        raise Exception('Error:PROXY_ENCODING:Unsupported proxy update encoding '+encoding)
+    return zlib.decompress(base64.urlsafe_b64decode(str(data)), 16+zlib.MAX_WBITS)
 
 
 class ProxyUpdater(object):
@@ -1632,6 +2408,7 @@ class ProxyUpdater(object):
         self.json_data = json_data
         self.modRequests = modRequests
         self.synchronous = synchronous
+        self.heldShards = False  # True if further shards are waiting for this request to complete
 
         user = ADMINUSER_ID
         userToken = gen_proxy_token(user, ADMIN_ROLE)
@@ -1640,6 +2417,11 @@ class ProxyUpdater(object):
 
         post_data = { 'proxy': '1', 'allupdates': '1', 'admin': user, 'token': userToken,
                       'data':  self.json_data}
+        self.compact = bool(Settings['compact_updates'] and Global.updateCompact)
+        if self.compact:
+            post_data['encoding'] = 'gzip'
+            post_data['data'] = encodeUpdateData(self.json_data)
+        self.requestBytes = len(post_data['data'])
         post_data['create'] = 'proxy'
         post_data['requestid'] = self.requestId
         if Global.updatePartial:
@@ -1660,12 +2442,13 @@ class ProxyUpdater(object):
         self.cacheWaitTime = 0
 
     def update(self, curTime):
-        Global.httpRequestId = self.requestId
+        Global.updateShards[self.requestId] = self
         self.cacheRequestTime = curTime
-        Global.totalCacheRequestBytes += len(self.json_data)
+        Global.totalCacheRequestBytes += self.requestBytes
+        Global.totalCacheRequestRawBytes += len(self.json_data)
 
         ##if Settings['debug']:
-        ##    print("ProxyUpdater.update: UPDATE requestid=%s, retry=%d" % (Global.httpRequestId, self.cacheRetryCount), file=sys.stderr)
+        ##    print("ProxyUpdater.update: UPDATE requestid=%s, retry=%d" % (self.requestId, self.cacheRetryCount), file=sys.stderr)
 
         if self.synchronous:
             self.handle_proxy_response(self.http_client.fetch(Settings['gsheet_url'], method='POST', headers=None, body=self.body))
@@ -1689,7 +2472,7 @@ class ProxyUpdater(object):
             sheet_proxy_error('Unexpected error in handle_proxy_response: %s' % excp)
 
     def handle_proxy_response_aux(self, response):
-        if self.requestId != Global.httpRequestId:
+        if self.requestId not in Global.updateShards:
             # Cache has been cleared since update request; ignore response
             print("ProxyUpdater.handle_proxy_response_aux: DROPPED response to update request %s" % self.requestId, file=sys.stderr)
             return
@@ -1718,12 +2501,21 @@ class ProxyUpdater(object):
             # Handle update errors
             retry_after = RETRY_WAIT_TIME
             if errMsg.lower().find('timeout') >= 0:
+                # Request timed out, or upstream lock was busy (LOCK_TIMEOUT; update not applied); retry after longer wait
                 retry_after = 5 * retry_after
 
             if errMsg.find('PROXY_PARTIAL') >= 0:
                 # Disable partial row updates
                 Global.updatePartial = False
 
+            if self.compact and Global.updateCompact and (errMsg.find('PROXY_ENCODING') >= 0 or (respObj and errMsg.find('SyntaxError') >= 0)):
+                # Upstream unable to decode compact update (older scripts fail when parsing data); disable compact updates and re-create request
+                print("ProxyUpdater.handle_proxy_response_aux: %s Disabling compact updates: %s" % (Settings['site_name'], errMsg), file=sys.stderr)
+                Global.updateCompact = False
+                del Global.updateShards[self.requestId]
+                next_cache_update()
+                return
+
             if Global.suspended or self.cacheRetryCount >= RETRY_MAX_COUNT:
                 msg = 'Failed to update cache after %d tries: %s' % (RETRY_MAX_COUNT, errMsg)
                 sheet_proxy_error(msg)
@@ -1733,7 +2525,7 @@ class ProxyUpdater(object):
             self.cacheWaitTime += retry_after
             Global.totalCacheRetryCount += 1
 
-            print("ProxyUpdater.handle_proxy_response_aux: %s Update ERROR (tries %d of %d; retry_after=%ss): %s" % (Settings['site_name'], self.cacheRetryCount, RETRY_MAX_COUNT, self.cacheWaitTime, errMsg), file=sys.stderr)
+            print("ProxyUpdater.handle_proxy_response_aux: %s Update ERROR %s (tries %d of %d; retry_after=%ss): %s" % (Settings['site_name'], self.requestId, self.cacheRetryCount, RETRY_MAX_COUNT, self.cacheWaitTime, errMsg), file=sys.stderr)
 
             if Settings['debug'] and self.cacheRetryCount == 1:
                 if errTrace:
@@ -1752,7 +2544,10 @@ class ProxyUpdater(object):
             return
 
         # Update request succeeded
-        Global.cacheUpdateTime = self.cacheRequestTime
+        del Global.updateShards[self.requestId]
+        checkRemoteEncodings(respObj)
+        for sheetName in self.sheetUpdateInfo:
+            Global.sheetUpdateTimes[sheetName] = self.cacheRequestTime
         Global.cacheResponseTime = sliauth.epoch_ms()
 
         Global.totalCacheResponseInterval += (Global.cacheResponseTime - self.cacheRequestTime)
@@ -1793,12 +2588,17 @@ class ProxyUpdater(object):
         ##if Settings['debug']:
         ##    print("ProxyUpdater.handle_proxy_response_aux: UPDATED", sliauth.iso_date(nosubsec=True), file=sys.stderr)
 
-        next_cache_update(0 if (refreshNeeded or Global.suspended) else Settings['min_wait_sec'])
+        if self.heldShards:
+            # Send remaining shards
+            schedule_update(force=True)
+        else:
+            next_cache_update(0 if (refreshNeeded or Global.suspended) else Settings['min_wait_sec'])
 
 def next_cache_update(waitSec=0, resetError=False):
     if resetError:
+        # Restart updates (abandoning any requests in flight)
         Global.cacheUpdateError = ''
-    Global.httpRequestId = ''
+        Global.updateShards.clear()
     schedule_update(waitSec=waitSec)
         
 
@@ -1813,6 +2613,7 @@ def sheetAction(params, notrace=False):
     # admin: admin user name (optional)
     # token: authentication token
     # actions: ''|'discuss_posts'|'answer_stats'|'gradebook' (last two not for proxy)
+    # cursor: cursor returned by previous 'discuss_posts' action (to return only new/modified posts)
     # headers: ['name', 'id', 'email', 'altid', 'Timestamp', 'initTimestamp', 'submitTimestamp', 'field1', ...] (name and id required for sheet creation)
     # name: sortable name, usually 'Last name, First M.' (required if creating a row, and row parameter is not specified)
     # id: unique userID or lowercase email (required if creating or updating a row, and row parameter is not specified)
@@ -2010,7 +2811,7 @@ def sheetAction(params, notrace=False):
 		
         if performActions:
             if performActions == 'discuss_posts':
-                returnValues = getDiscussPosts(sheetName, params.get('discuss', ''), paramId, rosterName)
+                returnValues = getDiscussPosts(sheetName, params.get('discuss', ''), paramId, rosterName, cursor=int(params.get('cursor') or 0))
                 return {"result": "success", "value": returnValues, "headers": returnHeaders,
                         "info": returnInfo, "messages": '\n'.join(returnMessages)}
             elif not all(x in ('answer_stats', 'correct') for x in performActions.split(',')):
@@ -2123,6 +2924,7 @@ def sheetAction(params, notrace=False):
             else:
                 keyHeader = '' if newName.startswith('settings_') or newName.endswith('_log') else 'id'
                 Sheet_cache[newName] = Sheet(newName, modSheet.getRows(), keyHeader=keyHeader)
+                journalSnapshot(Sheet_cache[newName])
         else:
             # Update/access single sheet
             headers = json.loads(params.get('headers','')) if params.get('headers','') else None
@@ -2306,18 +3108,21 @@ def sheetAction(params, notrace=False):
 
             if params.get('getstats',''):
                 try:
-                    temIndexRow = indexRows(modSheet, indexColumns(modSheet)['id'], 2)
+                    timestampRow = lookupRowIndex(TIMESTAMP_ID, modSheet, 2)
+                    maxScoreRow = lookupRowIndex(MAXSCORE_ID, modSheet, 2)
+                    averageRow = lookupRowIndex(AVERAGE_ID, modSheet, 2)
+                    rescaleRow = lookupRowIndex(RESCALE_ID, modSheet, 2)
                     if Settings.get('gradebook_release'):
                         returnInfo['gradebookRelease'] = Settings.get('gradebook_release')
 
-                    if temIndexRow.get(TIMESTAMP_ID) and columnIndex.get('total'):
-                        returnInfo['lastUpdate'] = modSheet.getSheetValues(temIndexRow.get(TIMESTAMP_ID), columnIndex['total'], 1, 1)[0][0]
-                    if temIndexRow.get(MAXSCORE_ID):
-                        returnInfo['maxScores'] = modSheet.getSheetValues(temIndexRow.get(MAXSCORE_ID), 1, 1, len(columnHeaders))[0]
-                    if temIndexRow.get(AVERAGE_ID) and 'average' in gradebookRelease:
-                        returnInfo['averages'] = modSheet.getSheetValues(temIndexRow.get(AVERAGE_ID), 1, 1, len(columnHeaders))[0]
-                    if temIndexRow.get(RESCALE_ID):
-                        returnInfo['rescale'] = modSheet.getSheetValues(temIndexRow.get(RESCALE_ID), 1, 1, len(columnHeaders))[0]
+                    if timestampRow and columnIndex.get('total'):
+                        returnInfo['lastUpdate'] = modSheet.getSheetValues(timestampRow, columnIndex['total'], 1, 1)[0][0]
+                    if maxScoreRow:
+                        returnInfo['maxScores'] = modSheet.getSheetValues(maxScoreRow, 1, 1, len(columnHeaders))[0]
+                    if averageRow and 'average' in gradebookRelease:
+                        returnInfo['averages'] = modSheet.getSheetValues(averageRow, 1, 1, len(columnHeaders))[0]
+                    if rescaleRow:
+                        returnInfo['rescale'] = modSheet.getSheetValues(rescaleRow, 1, 1, len(columnHeaders))[0]
                         if not adminUser and columnIndex.get(STATUS_HEADER):
                             returnInfo['rescale'][columnIndex[STATUS_HEADER]-1] = ''
                 except Exception, err:
@@ -2615,8 +3420,7 @@ def sheetAction(params, notrace=False):
                 sortVals.sort()
 
                 if adminUser or paramId == TESTUSER_ID:
-                    nameMap = getDisplayNames(includeNonRoster=True)
-                    shortMap = makeShortNames(nameMap, first=True) if nameMap else {}
+                    nameMap, shortMap = getDisplayNameMaps(includeNonRoster=True)
                     returnInfo['responders'] = []
                     if teamAttr == 'assign':
                         teamMembers = {}
@@ -2728,7 +3532,7 @@ def sheetAction(params, notrace=False):
                     # Save score for last take
                     lastTake = '0'
                     if computeTotalScore:
-                        userScores = recomputeUserScores(columnHeaders, origVals, questions, sessionAttributes)
+                        userScores = recomputeUserScores(columnHeaders, origVals, questions, sessionAttributes, sheet=modSheet)
                         if userScores:
                             lastTake = str(scores.get('weightedCorrect') or 0)
 
@@ -3010,7 +3814,7 @@ def sheetAction(params, notrace=False):
 
                     if userId != MAXSCORE_ID and scoresCol and computeTotalScore:
                         # Tally user scores after row updates
-                        userScores = recomputeUserScores(columnHeaders, rowValues, questions, sessionAttributes)
+                        userScores = recomputeUserScores(columnHeaders, rowValues, questions, sessionAttributes, sheet=modSheet)
                         if userScores:
                             rowValues[scoresCol-1] = userScores.get('weightedCorrect', '')
 
@@ -3278,8 +4082,8 @@ def sheetAction(params, notrace=False):
     
     return retObj
 
-def recomputeUserScores(columnHeaders, rowValues, questions, sessionAttributes):
-    savedSession = unpackSession(columnHeaders, rowValues)
+def recomputeUserScores(columnHeaders, rowValues, questions, sessionAttributes, sheet=None):
+    savedSession = unpackSession(columnHeaders, rowValues, sheet=sheet)
     if savedSession and len(savedSession.get('questionsAttempted').keys()):
         return tallyScores(questions, savedSession.get('questionsAttempted'), savedSession.get('hintsUsed'), sessionAttributes.get('params'), sessionAttributes.get('remoteAnswers'))
     return None
@@ -3671,6 +4475,138 @@ def updateUserRow(sessionName, headers, updateObj, opts={}, notrace=False):
 
     return sheetAction(params, notrace=notrace)
 
+def putUserResponses(sessionName, qnumber, userResponses, lastSlide=None):
+    # Save interactive responses for question qnumber, with userResponses = OrderedDict(userId -> [response, explain])
+    # Existing unsubmitted rows are updated with a single range write to the session sheet,
+    # applying the full row update rules of sheetAction (Timestamp, share codes, blanked admin columns, scores)
+    # Other rows (and sessions past due date, timed sessions, or team responses) are updated row by row using putUserRow
+    # Returns (dict userId -> error message, list of team modified ids)
+    errors = {}
+    teamModifiedIds = []
+
+    sessionSheet = getSheet(sessionName)
+    if not sessionSheet:
+        for userId in userResponses:
+            errors[userId] = "Error:NOSHEET:Sheet '%s' not found" % sessionName
+        return errors, teamModifiedIds
+
+    columnHeaders = sessionSheet.getHeaders()
+    columnIndex = indexColumns(sessionSheet)
+    responseCol = columnIndex.get('q%d_response' % qnumber)
+    explainCol = columnIndex.get('q%d_explain' % qnumber)
+    lastSlideCol = columnIndex.get('lastSlide')
+    submitTimestampCol = columnIndex.get('submitTimestamp')
+
+    curDate = createDate()
+    curTime = sliauth.epoch_ms(curDate)
+    lockedSite = Settings['site_access'] == SITE_LOCKED or (Settings['lock_date'] and curTime > sliauth.epoch_ms(Settings['lock_date']))
+    expiredSite = not Settings['site_access'] and Settings['end_date'] and curTime > sliauth.epoch_ms(Settings['end_date'])
+
+    batchUpdate = responseCol and 'Timestamp' in columnIndex and getSheet(INDEX_SHEET)
+    batchUpdate = batchUpdate and not (Global.cacheUpdateError or lockedSite or expiredSite or sessionName == previewingSession())
+    if batchUpdate:
+        sessionEntries = lookupValues(sessionName, ['dueDate', 'gradeDate', 'scoreWeight', 'fieldsMin', 'questions', 'attributes'], INDEX_SHEET)
+        sessionAttributes = json.loads(sessionEntries['attributes'])
+        questions = json.loads(sessionEntries['questions'])
+        dueDate = sessionEntries.get('dueDate')
+        fieldsMin = sessionEntries.get('fieldsMin')
+        if (dueDate and curTime > sliauth.epoch_ms(dueDate)) or sessionAttributes['params'].get('timedSec'):
+            # Late token and timer checks
+            batchUpdate = False
+        elif qnumber <= len(questions) and questions[qnumber-1].get('team','') == 'response':
+            # Team copy of responses
+            batchUpdate = False
+
+    batchRows = OrderedDict()
+    rowUpdateIds = []
+    for userId in userResponses:
+        userRow = lookupRowIndex(userId, sessionSheet)
+        if not batchUpdate or not userRow or userId in (TESTUSER_ID, MAXSCORE_ID):
+            rowUpdateIds.append(userId)
+        elif submitTimestampCol and sessionSheet.getSheetValues(userRow, submitTimestampCol, 1, 1)[0][0]:
+            errors[userId] = "Error::Cannot re-submit session for user "+userId+" in sheet '"+sessionName+"'"
+        else:
+            batchRows[userRow] = userId
+
+    if batchRows:
+        computeTotalScore = False
+        if parseNumber(sessionEntries.get('scoreWeight')):
+            if sessionAttributes['params']['features'].get('delay_answers') or sessionAttributes['params']['features'].get('remote_answers'):
+                computeTotalScore = sessionEntries.get('gradeDate')
+            else:
+                computeTotalScore = True
+
+        scoresCol = columnIndex.get('q_scores')
+        adminCols = []
+        shareCols = []
+        for j in range(len(columnHeaders)):
+            hmatch = QFIELD_RE.match(columnHeaders[j])
+            if j >= fieldsMin and (not hmatch or hmatch.group(2) not in ('response', 'explain', 'plugin')):
+                # Non-response/explain/plugin admin column (blanked out when response is updated)
+                adminCols.append(j)
+            if columnHeaders[j].endswith('_share'):
+                shareCols.append(j)
+
+        rowMin = min(batchRows.keys())
+        rowCount = max(batchRows.keys()) - rowMin + 1
+        nCols = len(columnHeaders)
+        try:
+            rowsValues = sessionSheet.getSheetValues(rowMin, 1, rowCount, nCols)
+            for userRow, userId in batchRows.items():
+                rowValues = rowsValues[userRow-rowMin]
+                rowValues[columnIndex['Timestamp']-1] = curDate
+                if lastSlideCol and lastSlide is not None:
+                    rowValues[lastSlideCol-1] = lastSlide
+                for j in adminCols:
+                    rowValues[j] = ''
+                response, explain = userResponses[userId]
+                rowValues[responseCol-1] = response
+                if explainCol:
+                    rowValues[explainCol-1] = explain
+
+                for j in shareCols:
+                    # Generate share value by computing message digest of 'response [: explain]'
+                    if j >= 1 and rowValues[j-1] and rowValues[j-1] != SKIP_ANSWER and columnHeaders[j-1].endswith('_response'):
+                        rowValues[j] = sliauth.digest_hex(normalizeText(rowValues[j-1]))
+                    elif j >= 2 and rowValues[j-1] and columnHeaders[j-1].endswith('_explain') and columnHeaders[j-2].endswith('_response'):
+                        rowValues[j] = sliauth.digest_hex(rowValues[j-1]+': '+normalizeText(rowValues[j-2]))
+                    else:
+                        rowValues[j] = ''
+
+                if scoresCol and computeTotalScore:
+                    userScores = recomputeUserScores(columnHeaders, rowValues, questions, sessionAttributes, sheet=sessionSheet)
+                    if userScores:
+                        rowValues[scoresCol-1] = userScores.get('weightedCorrect', '')
+
+            # Single range update (only modified cells are marked for upstream update)
+            sessionSheet.getRange(rowMin, 1, rowCount, nCols).setValues(rowsValues)
+        except Exception, excp:
+            print('sdproxy.putUserResponses: Error in updating responses for '+sessionName+': '+str(excp), file=sys.stderr)
+            for userId in batchRows.values():
+                errors[userId] = str(excp)
+
+    for userId in rowUpdateIds:
+        rowUpdates = [None]*len(columnHeaders)
+        userRow = lookupRowIndex(userId, sessionSheet)
+        for header in MIN_HEADERS:
+            if header in columnIndex:
+                rowUpdates[columnIndex[header]-1] = sessionSheet.getSheetValues(userRow, columnIndex[header], 1, 1)[0][0] if userRow else None
+        rowUpdates[columnIndex['id']-1] = userId
+        if responseCol:
+            rowUpdates[responseCol-1] = userResponses[userId][0]
+        if explainCol:
+            rowUpdates[explainCol-1] = userResponses[userId][1]
+        if lastSlideCol and lastSlide is not None:
+            rowUpdates[lastSlideCol-1] = lastSlide
+
+        retval = putUserRow(sessionName, userId, rowUpdates)
+        if retval['result'] != 'success':
+            errors[userId] = retval['error']
+        else:
+            teamModifiedIds += retval.get('info', {}).get('teamModifiedIds') or []
+
+    return errors, teamModifiedIds
+
 def makeRosterMap(colName, lowercase=False, unique=False):
     # Return map of other IDs from colName to roster ID
     # If unique, raise exception for duplicated values in colName
@@ -3701,6 +4637,7 @@ def exportAnswers(sessionName):
     allRows = retval['value']
     headerCols = dict((hdr, j+1) for j, hdr in enumerate(headers))
     sessionCol = headerCols['session_hidden']
+    sessionSheet = getSheet(sessionName)
     responseCols = {}
     explainCols = {}
     qmaxCols = 0
@@ -3725,7 +4662,7 @@ def exportAnswers(sessionName):
         qAttempted = None
         session_hidden = rowValues[sessionCol-1]
         if session_hidden:
-            session = loadSession(session_hidden)
+            session = sessionSheet.decoded_session(rowValues[headerCols['id']-1], session_hidden) if sessionSheet else decodeSession(session_hidden)
             qShuffle = session.get('questionShuffle')
             qAttempted = session['questionsAttempted']
             if qAttempted:
@@ -3850,7 +4787,7 @@ def updateTotalScores(modSheet, sessionAttributes, questions, force, startRow=0,
         for k in range(nRows):
             if idVals[k][0] != MAXSCORE_ID and (force or scoreValues[k][0] != ''):
                 temRowVals = modSheet.getSheetValues(startRow+k, 1, 1, len(columnHeaders))[0]
-                savedSession = unpackSession(columnHeaders, temRowVals)
+                savedSession = unpackSession(columnHeaders, temRowVals, sheet=modSheet)
                 newScore = '';
                 if savedSession and savedSession.get('questionsAttempted'):
                     scores = tallyScores(questions, savedSession['questionsAttempted'], savedSession['hintsUsed'], sessionAttributes['params'], sessionAttributes['remoteAnswers'])
@@ -3872,8 +4809,7 @@ def clearQuestionResponses(sessionName, questionNumber, userId=''):
     columnIndex = indexColumns(sessionSheet)
 
     if userId:
-        idRowIndex = indexRows(sessionSheet, columnIndex['id'])
-        startRow = idRowIndex.get(userId)
+        startRow = lookupRowIndex(userId, sessionSheet)
         if not startRow:
             raise Exception('User id '+userId+' not found in session '+sessionName)
         nRows = 1
@@ -3935,9 +4871,7 @@ def deleteSlide(sessionName, slideNumber):
 
     columnHeaders = sessionSheet.getSheetValues(1, 1, 1, sessionSheet.getLastColumn())[0]
     columnIndex = indexColumns(sessionSheet)
-    idRowIndex = indexRows(sessionSheet, columnIndex['id'])
-
-    testRow = idRowIndex.get(TESTUSER_ID)
+    testRow = lookupRowIndex(TESTUSER_ID, sessionSheet)
     if testRow:
         testSubmitted = sessionSheet.getSheetValues(testRow, columnIndex['submitTimestamp'], 1, 1)[0][0]
     else:
@@ -4174,7 +5108,7 @@ def getRowMap(sheetName, colName, regular=False, optional=False, startRow=2):
     sheet = getSheet(sheetName)
     if not sheet:
         raise Exception('Sheet '+sheetName+' not found')
-    colIndex = indexColumns(sheet)
+    colIndex = sheet.getColumnIndex()
     if colName not in colIndex:
         if optional:
             return None
@@ -4204,13 +5138,12 @@ def lookupRoster(field, userId=None, regular=False):
     if not headers or headers[:4] != MIN_HEADERS:
         raise Exception('CUSTOM:Error: Invalid headers in roster_slidoc; first four should be "'+', '.join(MIN_HEADERS)+'", but found "'+', '.join(headers or [])+'"')
 
-    colIndex = indexColumns(rosterSheet)
+    colIndex = rosterSheet.getColumnIndex()
     if not colIndex.get(field):
         return None
 
     if userId:
-        rowIndex = indexRows(rosterSheet, colIndex['id'], 2)
-        if not rowIndex.get(userId):
+        if not lookupRowIndex(userId, rosterSheet, 2):
             return None
         return lookupValues(userId, [field], ROSTER_SHEET, True)[0]
 
@@ -4359,9 +5292,8 @@ def getAttendance(day, new=False):
 def toggleAttendance(day, userId):
     rosterSheet = getSheet(ROSTER_SHEET)
     dayColName = DAY_PREFIX+day
-    colIndex = indexColumns(rosterSheet)
-    dayCol = colIndex.get(dayColName)
-    dayRow = indexRows(rosterSheet, colIndex['id'], 2).get(userId)
+    dayCol = rosterSheet.getColumnIndex().get(dayColName)
+    dayRow = lookupRowIndex(userId, rosterSheet, 2)
     if not dayCol:
         raise Exception('Attendance column %s not found in roster sheet' % dayColName)
     if not dayRow:
@@ -4379,7 +5311,6 @@ def lookupGrades(userId, admin=False):
         return None
 
     colIndex = indexColumns(scoreSheet)
-    rowIndex = indexRows(scoreSheet, colIndex['id'], 2)
     userRow = lookupRowIndex(userId, scoreSheet)
     if not userRow:
         return None
@@ -4388,11 +5319,11 @@ def lookupGrades(userId, admin=False):
 
     headers = scoreSheet.getHeaders()
     nCols = len(headers)
-    lastUpdate = scoreSheet.getSheetValues(rowIndex['_timestamp'], colIndex['total'], 1, 1)[0][0].strip()
+    lastUpdate = scoreSheet.getSheetValues(lookupRowIndex(TIMESTAMP_ID, scoreSheet), colIndex['total'], 1, 1)[0][0].strip()
     userScores = scoreSheet.getSheetValues(userRow, 1, 1, nCols)[0]
-    rescale = scoreSheet.getSheetValues(rowIndex['_rescale'], 1, 1, nCols)[0]
-    average = scoreSheet.getSheetValues(rowIndex['_average'], 1, 1, nCols)[0]
-    maxscore = scoreSheet.getSheetValues(rowIndex['_max_score'], 1, 1, nCols)[0]
+    rescale = scoreSheet.getSheetValues(lookupRowIndex(RESCALE_ID, scoreSheet), 1, 1, nCols)[0]
+    average = scoreSheet.getSheetValues(lookupRowIndex(AVERAGE_ID, scoreSheet), 1, 1, nCols)[0]
+    maxscore = scoreSheet.getSheetValues(lookupRowIndex(MAXSCORE_ID, scoreSheet), 1, 1, nCols)[0]
 
     grades = {}
     sessionGrades = []
@@ -4437,8 +5368,6 @@ def lookupSessions(colNames):
     if not indexSheet:
         return []
 
-    colIndex = indexColumns(indexSheet)
-    rowIndex = indexRows(indexSheet, colIndex['id'], 2)
     idVals = getColumns('id', indexSheet, 1, 2)
     fieldVals = []
     for idVal in idVals:
@@ -4519,14 +5448,13 @@ def colIndexToChar(col):
 
 
 def indexColumns(sheet):
-    columnHeaders = sheet.getSheetValues(1, 1, 1, sheet.getLastColumn())[0]
-    columnIndex = {}
-    for j, columnHeader in enumerate(columnHeaders):
-        columnIndex[columnHeader] = j+1
-    return columnIndex
+    return sheet.getColumnIndex().copy()
 
 
 def indexRows(sheet, indexCol, startRow=2):
+    if sheet.keyCol and indexCol == sheet.keyCol:
+        # Use row index maintained by keyed sheet
+        return dict((key, rowNum) for key, rowNum in sheet.keyRows.items() if rowNum >= startRow)
     rowIndex = {}
     nRows = sheet.getLastRow()-startRow+1
     if nRows > 0:
@@ -4537,7 +5465,7 @@ def indexRows(sheet, indexCol, startRow=2):
 
 
 def getColumns(header, sheet, colCount=1, startRow=2):
-    colIndex = indexColumns(sheet)
+    colIndex = sheet.getColumnIndex()
     if header not in colIndex:
         raise Exception('Column '+header+' not found in sheet '+sheetName)
 
@@ -4585,10 +5513,13 @@ def setColumnMax(sheet, startRow, colNum, maxValue):
 def lookupRowIndex(idValue, sheet, startRow=2):
     # Return row number for idValue in sheet or return 0
     # startRow defaults to 2
+    if sheet.keyHeader == 'id':
+        rowNum = sheet.getKeyRow(idValue)
+        return rowNum if rowNum >= startRow else 0
     nRows = sheet.getLastRow()-startRow+1
     if not nRows:
         return 0
-    rowIds = sheet.getSheetValues(startRow, indexColumns(sheet)['id'], nRows, 1)
+    rowIds = sheet.getSheetValues(startRow, sheet.getColumnIndex()['id'], nRows, 1)
     for j, rowId in enumerate(rowIds):
         if idValue == rowId[0]:
             return j+startRow
@@ -4601,9 +5532,8 @@ def lookupValues(idValue, colNames, sheetName, listReturn=False, blankValues=Fal
     indexSheet = getSheet(sheetName)
     if not indexSheet:
         raise Exception('Lookup sheet '+sheetName+' not found')
-    indexColIndex = indexColumns(indexSheet)
-    indexRowIndex = indexRows(indexSheet, indexColIndex['id'], 2)
-    sessionRow = indexRowIndex.get(idValue)
+    indexColIndex = indexSheet.getColumnIndex()
+    sessionRow = lookupRowIndex(idValue, indexSheet, 2)
     if not sessionRow:
         raise Exception('ID value '+idValue+' not found in index sheet '+sheetName+': '+str(colNames))
     retVals = {}
@@ -4624,9 +5554,8 @@ def setValue(idValue, colName, colValue, sheetName):
     indexSheet = getSheet(sheetName)
     if not indexSheet:
         raise Exception('Index sheet '+sheetName+' not found')
-    indexColIndex = indexColumns(indexSheet)
-    indexRowIndex = indexRows(indexSheet, indexColIndex['id'], 2)
-    sessionRow = indexRowIndex.get(idValue)
+    indexColIndex = indexSheet.getColumnIndex()
+    sessionRow = lookupRowIndex(idValue, indexSheet, 2)
     if not sessionRow:
         raise Exception('ID value '+idValue+' not found in index sheet '+sheetName+': '+colName)
     if colName not in indexColIndex:
@@ -4759,8 +5688,7 @@ def getDiscussionSeed(sessionName, questionNum, discussNum):
     postEntries = discussSheet.getSheetValues(startRow, discussCol, nRows, 1)
     idValues = discussSheet.getSheetValues(startRow, discussColIndex['id'], nRows, 1)
     nameValues = discussSheet.getSheetValues(startRow, discussColIndex['name'], nRows, 1)
-    nameMap = getDisplayNames(includeNonRoster=True)
-    shortMap = makeShortNames(nameMap, first=True) if nameMap else {}
+    nameMap, shortMap = getDisplayNameMaps(includeNonRoster=True)
     subrows = []
     responders = []
     for j in range(nRows):
@@ -4910,6 +5838,11 @@ def flagPost(sessionName, discussNum, postTeam, postNumber, posterId, flaggerId,
         notify_admin(notifyMsg, msgType='flagged')
     setDiscussState(sessionName, discussState)
 
+    index = Discuss_index.get((sessionName+'_discuss', int(discussNum)))
+    if index:
+        # Flagged state is not saved in post; update revision so that post is re-sent
+        index.touch_post(postTeam, postNumber)
+
 def deletePost(prevValue, colValue, userId, userName, adminUser, sessionName, discussNum):
     # Delete post
     newValue = prevValue
@@ -5079,9 +6012,96 @@ def teamSortKey(name):
     tmatch = TEAM_NAME_RE.match(name)
     return '%s%04d' % (tmatch.group(1), int(tmatch.group(2))) if tmatch else name
 
-def getDiscussPosts(sessionName, discussNum, userId, name, postTeams=[], noread=False):
-    # Return sorted list of discussion posts [ closedFlag, teamNames, [ [userTeam, postNum, userId, userName, postTime, unreadFlag, postText] ] ]
+def nextDiscussRevision():
+    # Revisions increase across index rebuilds and server restarts (cursors from an older index return all posts)
+    Global.discussRevision = max(Global.discussRevision+1, sliauth.epoch_ms())
+    return Global.discussRevision
+
+class DiscussIndex(object):
+    # Parsed posts for a discussion in a _discuss sheet, indexed by team
+    # Each post has the revision at which it was last modified, so that reads need only return posts newer than a cursor
+    # (Rows are re-parsed only if the discussion cell value or user name has changed)
+    def __init__(self, sheet, discussNum):
+        self.sheet = sheet
+        self.colName = DISCUSS_COL_FMT % discussNum
+        self.revision = 0
+        self.userValues = {}  # id -> (name, discussion cell value) when last parsed
+        self.userPosts = {}   # id -> set of (team, postNumber)
+        self.teamPosts = defaultdict(dict)  # team -> {(postNumber, id): [revision, id, name, postComps]}
+        self.refresh()
+        self.baseRevision = self.revision  # Cursors older than this return all posts (for new index, or after posts are removed)
+
+    def refresh(self):
+        revision = None
+        removed = False
+        idVals = getColumns('id', self.sheet)
+        nameVals = getColumns('name', self.sheet)
+        colVals = getColumns(self.colName, self.sheet)
+        userIds = set()
+        for idValue, nameValue, colValue in zip(idVals, nameVals, colVals):
+            if not idValue or (idValue.startswith('_') and idValue != TESTUSER_ID):
+                continue
+            userIds.add(idValue)
+            prevValues = self.userValues.get(idValue)
+            if prevValues and prevValues[0] == nameValue and (prevValues[1] is colValue or prevValues[1] == colValue):
+                continue
+            self.userValues[idValue] = (nameValue, colValue)
+            newPosts = {}
+            for userPost in splitPosts(colValue):
+                postComps = parsePost(userPost)
+                if postComps:
+                    newPosts[(postComps['team'], postComps['number'])] = postComps
+            for teamName, postNumber in self.userPosts.get(idValue, set()).difference(newPosts):
+                del self.teamPosts[teamName][(postNumber, idValue)]
+                removed = True
+            for (teamName, postNumber), postComps in newPosts.items():
+                prevPost = self.teamPosts[teamName].get((postNumber, idValue))
+                if prevPost and prevPost[2] == nameValue and prevPost[3] == postComps:
+                    continue
+                if revision is None:
+                    revision = nextDiscussRevision()
+                self.teamPosts[teamName][(postNumber, idValue)] = [revision, idValue, nameValue, postComps]
+            self.userPosts[idValue] = set(newPosts)
+
+        for idValue in set(self.userValues).difference(userIds):
+            # User row deleted
+            for teamName, postNumber in self.userPosts.pop(idValue):
+                del self.teamPosts[teamName][(postNumber, idValue)]
+            del self.userValues[idValue]
+            removed = True
+
+        if removed and revision is None:
+            revision = nextDiscussRevision()
+        if revision is not None:
+            self.revision = revision
+            if removed:
+                self.baseRevision = revision
+
+    def touch_post(self, teamName, postNumber):
+        revision = None
+        for key, post in self.teamPosts.get(teamName, {}).items():
+            if key[0] == postNumber:
+                revision = revision or nextDiscussRevision()
+                post[0] = revision
+        if revision:
+            self.revision = revision
+
+def getDiscussIndex(discussSheet, discussNum):
+    # Return up-to-date index of posts for discussion
+    key = (discussSheet.name, int(discussNum))
+    index = Discuss_index.get(key)
+    if index and index.sheet is discussSheet:
+        index.refresh()
+    else:
+        index = DiscussIndex(discussSheet, int(discussNum))
+        Discuss_index[key] = index
+    return index
+
+def getDiscussPosts(sessionName, discussNum, userId, name, postTeams=[], noread=False, cursor=0):
+    # Return sorted list of discussion posts [ closedFlag, teamNames, [ [userTeam, postNum, userId, userName, postTime, unreadFlag, postText] ], newCursor, partialFlag ]
     # If noread, do not update read stats
+    # If cursor (from a previous call), return only posts added/modified since then, with partialFlag set
+    # (if cursor has expired, all posts are returned, with partialFlag cleared)
     discussNumStr = str(discussNum)
     sessionEntries = lookupValues(sessionName, ['adminPaced', 'attributes'], INDEX_SHEET)
     adminPaced = sessionEntries.get('adminPaced')
@@ -5126,50 +6146,43 @@ def getDiscussPosts(sessionName, discussNum, userId, name, postTeams=[], noread=
     for postTeam in postTeams:
         lastReadPosts[postTeam] = accessDiscussion(sessionName, discussNum, userId, name or '#'+userId, postTeam, noread=noread)
 
-    idVals = getColumns('id', discussSheet)
-    nameVals = getColumns('name', discussSheet)
-    colVals = getColumns(axsColName, discussSheet)
+    index = getDiscussIndex(discussSheet, discussNum)
+    partial = bool(cursor) and cursor >= index.baseRevision
     allPosts = []
-    for j in range(0,len(colVals)):
-        idValue = idVals[j]
-        nameValue = nameVals[j]
-        if not idValue or (idValue.startswith('_') and idValue != TESTUSER_ID):
-            continue
-        flaggedIdPosts = discussState['flagged'].get(idValue,{})
-        modIdValue, modNameValue = aliasDiscussUser(idValue, nameValue, sessionName, teamSettings, selfId=userId)
-        userPosts = splitPosts(colVals[j])
-        for k in range(len(userPosts)):
-            postComps = parsePost(userPosts[k])
-            if postComps and postComps['team'] in postTeams:
-                teamName = postComps['team']
-                postNumber = postComps['number']
-                postState = postComps['state']
-                flagLabel = postLabel(discussNum, teamName, postNumber)
-                flaggerId = flaggedIdPosts.get(flagLabel)
-                if flaggerId:
-                    if userId != idValue and userId != flaggerId and userId != TESTUSER_ID:
-                        # Only display flagged posts to poster/flagger/admin
-                        continue
-                unreadFlag = postNumber > lastReadPosts[teamName] if not noread else False
-                text = postComps['text']+'\n'
-                if postState.get(DELETED_POST):
-                    # Hide text from deleted messages
-                    text = '('+DELETED_POST+')'
-                elif flaggerId:
-                    # Flagged stats is temporary
-                    postState[FLAGGED_POST] = 1
-                    if userId == idValue or userId == TESTUSER_ID:
-                        # Display flagged text to poster and admin
-                        text = '('+FLAGGED_POST+') ' + text
-                    else:
-                        text = '('+FLAGGED_POST+')'
-                elif postState.get(ANSWER_POST):
-                    # Prefix answer post
-                    text = '('+ANSWER_POST+') ' + postComps['answer'] + ': ' + text
-                allPosts.append([teamName, postNumber, postState, modIdValue, modNameValue, postComps['date'], unreadFlag, text])
+    for teamName in set(postTeams):
+        for revision, idValue, nameValue, postComps in index.teamPosts.get(teamName, {}).values():
+            if partial and revision <= cursor:
+                continue
+            flaggedIdPosts = discussState['flagged'].get(idValue,{})
+            modIdValue, modNameValue = aliasDiscussUser(idValue, nameValue, sessionName, teamSettings, selfId=userId)
+            postNumber = postComps['number']
+            postState = postComps['state'].copy()
+            flagLabel = postLabel(discussNum, teamName, postNumber)
+            flaggerId = flaggedIdPosts.get(flagLabel)
+            if flaggerId:
+                if userId != idValue and userId != flaggerId and userId != TESTUSER_ID:
+                    # Only display flagged posts to poster/flagger/admin
+                    continue
+            unreadFlag = postNumber > lastReadPosts[teamName] if not noread else False
+            text = postComps['text']+'\n'
+            if postState.get(DELETED_POST):
+                # Hide text from deleted messages
+                text = '('+DELETED_POST+')'
+            elif flaggerId:
+                # Flagged stats is temporary
+                postState[FLAGGED_POST] = 1
+                if userId == idValue or userId == TESTUSER_ID:
+                    # Display flagged text to poster and admin
+                    text = '('+FLAGGED_POST+') ' + text
+                else:
+                    text = '('+FLAGGED_POST+')'
+            elif postState.get(ANSWER_POST):
+                # Prefix answer post
+                text = '('+ANSWER_POST+') ' + postComps['answer'] + ': ' + text
+            allPosts.append([teamName, postNumber, postState, modIdValue, modNameValue, postComps['date'], unreadFlag, text])
 
     allPosts.sort(key=lambda x: (teamSortKey(x[0]), x[1]))  #  (sorting by team name and then by post number)
-    return [closedFlag, postTeams, allPosts]
+    return [closedFlag, postTeams, allPosts, index.revision, partial]
 
 def addDiscussUser(sessionName, userId, userName=''):
     discussSheet = getSheet(sessionName+'_discuss')
@@ -5703,14 +6716,31 @@ def loadSession(session_json):
             session[attr] = dct
     return session
 
-def unpackSession(headers, row):
+def decodeSession(session_hidden):
+    if session_hidden[0] != '{':
+        session_hidden = base64.b64decode(session_hidden)
+    return loadSession(session_hidden)
+
+def copySession(session):
+    # Copy decoded session, down to the level of individual question attempts (nested values are shared)
+    session = session.copy()
+    for attr in ('questionShuffle', 'hintsUsed'):
+        if isinstance(session.get(attr), dict):
+            session[attr] = session[attr].copy()
+    if isinstance(session.get('questionsAttempted'), dict):
+        session['questionsAttempted'] = dict((qnumber, qAttempted.copy() if isinstance(qAttempted, dict) else qAttempted) for qnumber, qAttempted in session['questionsAttempted'].items())
+    return session
+
+def unpackSession(headers, row, sheet=None):
     # Unpacks hidden session object and adds response/explain fields from sheet row, as needed
+    # If sheet is specified, decoded session is cached for the row (see Sheet.decoded_session)
     session_hidden = row[headers.index('session_hidden')]
     if not session_hidden:
         return None
-    if session_hidden[0] != '{':
-        session_hidden = base64.b64decode(session_hidden)
-    session = loadSession(session_hidden)
+    if sheet and sheet.keyHeader:
+        session = sheet.decoded_session(row[headers.index(sheet.keyHeader)], session_hidden)
+    else:
+        session = decodeSession(session_hidden)
 
     for j in range(len(headers)):
         header = headers[j]
@@ -5813,8 +6843,250 @@ def scoreAnswer(response, qtype, corrAnswer):
     return qscore
 
 
-def tallyScores(questions, questionsAttempted, hintsUsed, params, remoteAnswers):
+NUMPY_EXACT_MAX = 2**52   # Max. magnitude of numeric values for vectorized tolerance checks (float64 results identical to scalar checks)
+
+def compileAnswer(qtype, corrAnswer):
+    # Precompile correct answer for scoring multiple responses (see scoreAnswer)
+    # Returns None (unscored), ['number', value, tolerance], ['text', [[normCorr, hasSpaces], ...]],
+    # or ['error', exception] (raised only when scoring a non-null response, as in scoreAnswer)
+    if not corrAnswer:
+        return None
+    try:
+        if qtype == 'number':
+            corrValue, corrError = splitNumericAnswer(corrAnswer)
+            if corrValue == None:
+                return ['error', Exception('scoreAnswer: Error in correct numeric answer:'+corrAnswer)]
+            elif corrError == None:
+                return ['error', Exception('scoreAnswer: Error in correct numeric error:'+corrAnswer)]
+            return ['number', corrValue, 1.001*corrError]
+
+        correctOptions = list(corrAnswer) if (qtype == 'choice')  else corrAnswer.split(' OR ')
+        normOptions = []
+        for option in correctOptions:
+            normCorr = re.sub(r'\s+', ' ', option.strip().lower())
+            normOptions.append([normCorr, ' ' in normCorr[1:]])
+        return ['text', normOptions]
+    except Exception, excp:
+        return ['error', excp]
+
+def scoreCompiled(response, answerSpec):
+    # Returns same score as scoreAnswer, for precompiled correct answer
+    if not answerSpec:
+        return None
+
+    if not response:
+        return 0
+
+    if answerSpec[0] == 'error':
+        raise answerSpec[1]
+
+    if answerSpec[0] == 'number':
+        respValue = parseNumber(response)
+        if respValue == None:
+            return 0
+        return 1 if (abs(respValue-answerSpec[1]) <= answerSpec[2]) else 0
+
+    normResp = ('' + str(response)).strip().lower()
+    spacedResp = None
+    unspacedResp = None
+    for normCorr, hasSpaces in answerSpec[1]:
+        if hasSpaces:
+            # Correct answer has space(s); compare using normalized spaces
+            if spacedResp is None:
+                spacedResp = re.sub(r'\s+', ' ', normResp)
+            if spacedResp == normCorr:
+                return 1
+        else:
+            # Strip all spaces from response
+            if unspacedResp is None:
+                unspacedResp = re.sub(r'\s+', '', normResp)
+            if unspacedResp == normCorr:
+                return 1
+    return 0
+
+def scoreCompiledValues(responses, answerSpec):
+    # Returns list of scores (or exceptions) for responses
+    if answerSpec and answerSpec[0] == 'number' and numpy is not None:
+        respValues = [parseNumber(response) if response else None for response in responses]
+        numValues = [x for x in respValues if x is not None]
+        if numValues and all(type(x) is float or abs(x) < NUMPY_EXACT_MAX for x in numValues+answerSpec[1:2]):
+            # Vectorized tolerance check (conversion of values to float64 is exact)
+            correct = iter(numpy.abs(numpy.array(numValues, dtype=numpy.float64)-answerSpec[1]) <= answerSpec[2])
+            return [0 if respValue is None else (1 if next(correct) else 0) for respValue in respValues]
+
+    scores = []
+    for response in responses:
+        try:
+            scores.append(scoreCompiled(response, answerSpec))
+        except Exception, excp:
+            scores.append(excp)
+    return scores
+
+def scoreResponses(responses, qtype, corrAnswer):
+    # Score list of responses to a question, compiling the correct answer only once (and scoring identical responses once)
+    # Returns list of scores, identical to scoreAnswer for each response (errors are returned as exceptions, not raised)
+    answerSpec = compileAnswer(qtype, corrAnswer)
+    keys = []
+    distinct = {}   # (type, response) -> offset in distinct responses (type distinguishes 3, 3.0 and '3')
+    for response in responses:
+        try:
+            key = (type(response), response)
+            distinct.setdefault(key, len(distinct))
+        except TypeError:
+            key = None
+        keys.append(key)
+
+    distinctResponses = [None]*len(distinct)
+    for key, offset in distinct.items():
+        distinctResponses[offset] = key[1]
+    distinctScores = scoreCompiledValues(distinctResponses, answerSpec)
+
+    scores = []
+    for key, response in zip(keys, responses):
+        if key is None:
+            # Unhashable response
+            scores.append(scoreCompiledValues([response], answerSpec)[0])
+        else:
+            scores.append(distinctScores[distinct[key]])
+    return scores
+
+class ResponseTally(object):
+    # Running histogram of responses to a session question, updated as response values are set (see Sheet.update_tallies)
+    # Choice responses are counted by letter, numeric responses by bucket (of width twice the tolerance), and text by normalized value
+    def __init__(self, sessionName, qnumber, qtype, correctAns):
+        self.sessionName = sessionName
+        self.qnumber = qnumber
+        self.qtype = qtype
+        self.correctAns = correctAns
+        self.answerSpec = compileAnswer(qtype, correctAns)
+        self.counts = defaultdict(int)
+        self.responded = 0
+        self.correct = 0
+        self.notify = False
+
+    def buckets(self, response):
+        if self.qtype in ('choice', 'multichoice'):
+            return list(unicode(response).upper())
+        elif self.qtype == 'number':
+            value = parseNumber(response)
+            if value is None:
+                return ['?']
+            if self.answerSpec and self.answerSpec[0] == 'number' and self.answerSpec[2]:
+                width = 2*self.answerSpec[2]
+                return ['%.4g' % (self.answerSpec[1] + width*round((value-self.answerSpec[1])/width))]
+            return ['%.3g' % value]
+        return [re.sub(r'\s+', ' ', unicode(response).strip().lower())]
+
+    def add(self, response, incr):
+        if not response or response == SKIP_ANSWER:
+            return
+        self.responded += incr
+        for bucket in self.buckets(response):
+            self.counts[bucket] += incr
+            if not self.counts[bucket]:
+                del self.counts[bucket]
+        try:
+            if scoreCompiled(response, self.answerSpec):
+                self.correct += incr
+        except Exception:
+            # Unscorable response is not counted as correct (summary reports null correct count for invalid correct answer)
+            pass
+
+    def update(self, userId, oldResponse, newResponse):
+        if oldResponse == newResponse or not userId or userId.startswith('_'):
+            # Ignore test user and max score rows
+            return
+        self.add(oldResponse, -1)
+        self.add(newResponse, 1)
+        if self.notify and Global.responseTallyCallback:
+            Global.responseTallyCallback(self.sessionName, self.qnumber, self.summary())
+
+    def summary(self):
+        if self.qtype == 'number':
+            counts = sorted(self.counts.items(), key=lambda x: (x[0] == '?', float(x[0]) if x[0] != '?' else 0))
+        else:
+            counts = sorted(self.counts.items())
+        return {'qnumber': self.qnumber, 'qtype': self.qtype, 'responded': self.responded,
+                'correct': self.correct if self.answerSpec and self.answerSpec[0] != 'error' else None,
+                'counts': counts}
+
+def getResponseTally(sessionName, qnumber):
+    # Returns summary of responses to question: {qnumber:, qtype:, responded:, correct: (null if unscored), counts: [[bucket, count], ...]}
+    # The tally is computed from the session sheet on the first call, and then maintained as responses are modified
+    # (changes are also reported via responseTallyCallback)
+    sessionSheet = getSheet(sessionName)
+    if not sessionSheet:
+        raise Exception('Error::Session sheet not found: '+sessionName)
+    respHeader = 'q%d_response' % qnumber
+    respCol = sessionSheet.getColumnIndex().get(respHeader)
+    if not respCol:
+        raise Exception('Error::No response column for question %d in session %s' % (qnumber, sessionName))
+
+    sessionEntries = lookupValues(sessionName, ['questions', 'attributes'], INDEX_SHEET)
+    questions = json.loads(sessionEntries['questions'])
+    if qnumber < 1 or qnumber > len(questions):
+        raise Exception('Error::Invalid question number %d for session %s' % (qnumber, sessionName))
+    qtype = questions[qnumber-1].get('qtype', '')
+    correctAns = questions[qnumber-1].get('correct', '')
+    if not correctAns:
+        remoteAnswers = json.loads(sessionEntries['attributes']).get('remoteAnswers')
+        if remoteAnswers:
+            correctAns = remoteAnswers[qnumber-1]
+
+    tally = sessionSheet.responseTallies.get(respCol)
+    if not tally or tally.qtype != qtype or tally.correctAns != correctAns:
+        tally = ResponseTally(sessionName, qnumber, qtype, correctAns)
+        for idValue, response in zip(getColumns('id', sessionSheet), getColumns(respHeader, sessionSheet)):
+            tally.update(idValue, '', response)
+        tally.notify = True
+        sessionSheet.responseTallies[respCol] = tally
+    return tally.summary()
+
+def tallyScoresBatch(questions, sessions, params, remoteAnswers):
+    # Returns list of tallyScores results for sessions, scoring responses one question (column) at a time
+    qscoresList = [{} for session in sessions]
+    maxQuestions = [len(questions)]*len(sessions)
+    if params.get('paceLevel') == QUESTION_PACE:
+        # Answers processed only in sequence for question-paced slides
+        for k, session in enumerate(sessions):
+            questionsAttempted = session.get('questionsAttempted')
+            maxQuestions[k] = min([qnumber-1 for qnumber in range(1,len(questions)+1) if not questionsAttempted.get(qnumber)] or [len(questions)])
+
+    for j in range(len(questions)):
+        qnumber = j+1
+        questionAttrs = questions[j]
+        answerGroups = {}   # correctAns -> offsets of sessions
+        for k, session in enumerate(sessions):
+            qAttempted = session.get('questionsAttempted').get(qnumber)
+            if not qAttempted or qAttempted.get('plugin') or qnumber > maxQuestions[k]:
+                continue
+            try:
+                correctAns = qAttempted.get('expect') or questionAttrs.get('correct','')
+                if not correctAns and remoteAnswers and len(remoteAnswers):
+                    correctAns = remoteAnswers[qnumber-1]
+            except Exception, excp:
+                # (Raised only if question is scored by tallyScores)
+                qscoresList[k][qnumber] = excp
+                continue
+            try:
+                answerGroups.setdefault(correctAns, []).append(k)
+            except TypeError:
+                # Unhashable correct answer; score individually
+                qscoresList[k][qnumber] = scoreResponses([qAttempted.get('response')], questionAttrs.get('qtype'), correctAns)[0]
+
+        for correctAns, offsets in answerGroups.items():
+            responses = [sessions[k].get('questionsAttempted')[qnumber].get('response') for k in offsets]
+            for k, qscore in zip(offsets, scoreResponses(responses, questionAttrs.get('qtype'), correctAns)):
+                qscoresList[k][qnumber] = qscore
+
+    return [tallyScores(questions, session.get('questionsAttempted'), session.get('hintsUsed'), params, remoteAnswers, precomputed=qscores) for session, qscores in zip(sessions, qscoresList)]
+
+def tallyScores(questions, questionsAttempted, hintsUsed, params, remoteAnswers, precomputed=None):
+    # precomputed: optional {qnumber: score or exception} (see tallyScoresBatch)
+    precomputed = precomputed or {}
     skipAhead = 'skip_ahead' in params.get('features')
+    questionPaced = params.get('paceLevel') == QUESTION_PACE
+    participationCredit = params.get('participationCredit')
 
     questionsCount = 0
     weightedCount = 0
@@ -5832,7 +7104,7 @@ def tallyScores(questions, questionsAttempted, hintsUsed, params, remoteAnswers)
     for j in range(len(questions)):
         qnumber = j+1
         qAttempted = questionsAttempted.get(qnumber)
-        if not qAttempted and params.get('paceLevel') == QUESTION_PACE:
+        if not qAttempted and questionPaced:
             # Process answers only in sequence for question-paced slides
             break
 
@@ -5845,6 +7117,10 @@ def tallyScores(questions, questionsAttempted, hintsUsed, params, remoteAnswers)
 
         if qAttempted.get('plugin'):
             qscore = parseNumber(qAttempted.get('plugin').get('score'))
+        elif qnumber in precomputed:
+            qscore = precomputed[qnumber]
+            if isinstance(qscore, Exception):
+                raise qscore
         else:
             correctAns = qAttempted.get('expect') or questionAttrs.get('correct','')
             if not correctAns and remoteAnswers and len(remoteAnswers):
@@ -5871,7 +7147,7 @@ def tallyScores(questions, questionsAttempted, hintsUsed, params, remoteAnswers)
         prevQuestionSlide = slideNum
 
         lastSkipRef = ''
-        if correctSequence and params.get('paceLevel') == QUESTION_PACE:
+        if correctSequence and questionPaced:
             skip = questionAttrs.get('skip')
             if skip and skip[0] > slideNum:
                 # Skip ahead
@@ -5890,7 +7166,7 @@ def tallyScores(questions, questionsAttempted, hintsUsed, params, remoteAnswers)
 
         effectiveScore = qscore if (parseNumber(qscore) != None) else 1   # Give full credit to unscored answers
 
-        if params.get('participationCredit'):
+        if participationCredit:
             # Full participation credit simply for attempting question (lateCredit applied in sheet)
             effectiveScore = 1
 
@@ -6000,6 +7276,48 @@ def updateColumnAvg(sheet, colNum, avgRow, startRow, countBlanks=False):
     else:
         avgCell.setValue('')
 
+def sessionRowStamps(sessionSheet, sessionStartRow):
+    # Returns list of (id, hash of row values) for session rows (to detect rows modified since a derived sheet was last updated)
+    nids = sessionSheet.getLastRow()-sessionStartRow+1
+    if nids <= 0:
+        return []
+    idCol = indexColumns(sessionSheet)['id']
+    rows = sessionSheet.getSheetValues(sessionStartRow, 1, nids, sessionSheet.getLastColumn())
+    return [(row[idCol-1], hash(tuple(row))) for row in rows]
+
+def modifiedDerivedRows(derivedSheet, signature, rowStamps, derivedStartRow):
+    # Returns offsets of session rows to be recomputed in derived sheet, or None if derived sheet needs to be rebuilt
+    # (i.e., if sheet is new/re-downloaded, headers/questions have changed, or session rows have been inserted/deleted)
+    if not derivedSheet or not derivedSheet.derivedInfo or derivedSheet.derivedInfo[0] != signature:
+        return None
+    prevStamps = derivedSheet.derivedInfo[1]
+    if derivedSheet.getLastRow() != derivedStartRow+len(rowStamps)-1 or [x[0] for x in prevStamps] != [x[0] for x in rowStamps]:
+        return None
+    return [j for j in range(len(rowStamps)) if rowStamps[j][1] != prevStamps[j][1]]
+
+def copySessionColumns(sessionSheet, sessionStartRow, derivedSheet, derivedStartRow, colHeaders, nids, rowOffsets=None):
+    # Copy columns from session sheet to derived sheet (for all rows, or only for rowOffsets)
+    sessionColIndex = indexColumns(sessionSheet)
+    derivedColIndex = indexColumns(derivedSheet)
+    for colHeader in colHeaders:
+        sessionCol = sessionColIndex[colHeader]
+        derivedCol = derivedColIndex[colHeader]
+        if rowOffsets is None:
+            derivedSheet.getRange(derivedStartRow, derivedCol, nids, 1).setValues(sessionSheet.getSheetValues(sessionStartRow, sessionCol, nids, 1))
+        else:
+            for j in rowOffsets:
+                derivedSheet.getRange(derivedStartRow+j, derivedCol, 1, 1).setValues(sessionSheet.getSheetValues(sessionStartRow+j, sessionCol, 1, 1))
+
+def setDerivedRows(derivedSheet, derivedStartRow, startCol, rowOffsets, rows):
+    # Update modified derived rows, starting at column startCol; returns set of modified column numbers
+    modCols = set()
+    for j, rowVals in zip(rowOffsets, rows):
+        prevVals = derivedSheet.getSheetValues(derivedStartRow+j, startCol, 1, len(rowVals))[0]
+        if prevVals != rowVals:
+            modCols.update(startCol+k for k in range(len(rowVals)) if prevVals[k] != rowVals[k])
+            derivedSheet.getRange(derivedStartRow+j, startCol, 1, len(rowVals)).setValues([rowVals])
+    return modCols
+
 def updateAnswers(sessionName, create):
     try:
         sessionSheet = getSheetCache(sessionName)
@@ -6060,40 +7378,43 @@ def updateAnswers(sessionName, create):
         answerAvgRow = 2
         answerStartRow = 3
 
-        # Session answers headers
-
-        # New answers sheet
-        answerSheet = createSheet(answerSheetName, answerHeaders, True)
-        ansColIndex = indexColumns(answerSheet)
-
-        answerSheet.getRange(str(answerAvgRow)+':'+str(answerAvgRow)).setFontStyle('italic')
-        answerSheet.getRange(answerAvgRow, ansColIndex['id'], 1, 1).setValues([[AVERAGE_ID]])
-        answerSheet.getRange(answerAvgRow, ansColIndex['Timestamp'], 1, 1).setValues([[createDate()]])
-
         avgStartRow = answerStartRow + getNormalUserRow(sessionSheet, sessionStartRow) - sessionStartRow
 
         # Number of ids
         nids = sessionSheet.getLastRow()-sessionStartRow+1
 
-        if nids:
-            # Copy session values
-            for j in range(0,len(sessionCopyCols)):
-                colHeader = sessionCopyCols[j]
-                sessionCol = sessionColIndex[colHeader]
-                ansCol = ansColIndex[colHeader]
-                answerSheet.getRange(answerStartRow, ansCol, nids, 1).setValues(sessionSheet.getSheetValues(sessionStartRow, sessionCol, nids, 1))
-
-        # Get hidden session values
-        hiddenSessionCol = sessionColIndex['session_hidden']
-        hiddenVals = sessionSheet.getSheetValues(sessionStartRow, hiddenSessionCol, nids, 1)
+        # Recompute only modified rows of existing answers sheet, if possible
+        signature = (answerHeaders, avgStartRow, sessionEntries.get('attributes'), sessionEntries.get('questions'))
+        rowStamps = sessionRowStamps(sessionSheet, sessionStartRow)
+        modRows = modifiedDerivedRows(answerSheet, signature, rowStamps, answerStartRow)
+        if modRows is None:
+            # New answers sheet
+            answerSheet = createSheet(answerSheetName, answerHeaders, True)
+            ansColIndex = indexColumns(answerSheet)
+
+            answerSheet.getRange(str(answerAvgRow)+':'+str(answerAvgRow)).setFontStyle('italic')
+            answerSheet.getRange(answerAvgRow, ansColIndex['id'], 1, 1).setValues([[AVERAGE_ID]])
+            answerSheet.getRange(answerAvgRow, ansColIndex['Timestamp'], 1, 1).setValues([[createDate()]])
+
+            if nids:
+                # Copy session values
+                copySessionColumns(sessionSheet, sessionStartRow, answerSheet, answerStartRow, sessionCopyCols, nids)
+        elif modRows:
+            ansColIndex = indexColumns(answerSheet)
+            answerSheet.getRange(answerAvgRow, ansColIndex['Timestamp'], 1, 1).setValues([[createDate()]])
+            copySessionColumns(sessionSheet, sessionStartRow, answerSheet, answerStartRow, sessionCopyCols, nids, modRows)
+        else:
+            return answerSheetName
+
         qRows = []
 
-        for j in range(0,nids):
-            rowValues = sessionSheet.getSheetValues(j+sessionStartRow, 1, 1, len(sessionColHeaders))[0]
-            savedSession = unpackSession(sessionColHeaders, rowValues)
+        rowOffsets = range(0,nids) if modRows is None else modRows
+        savedSessions = [unpackSession(sessionColHeaders, sessionSheet.getSheetValues(j+sessionStartRow, 1, 1, len(sessionColHeaders))[0], sheet=sessionSheet) for j in rowOffsets]
+        allScores = tallyScoresBatch(questions, savedSessions, sessionAttributes.get('params'), sessionAttributes.get('remoteAnswers'))
+
+        for savedSession, scores in zip(savedSessions, allScores):
             qAttempted = savedSession.get('questionsAttempted')
             qHints = savedSession.get('hintsUsed')
-            scores = tallyScores(questions, savedSession.get('questionsAttempted'), savedSession.get('hintsUsed'), sessionAttributes.get('params'), sessionAttributes.get('remoteAnswers'))
 
             rowVals = []
             for k in range(0,len(answerHeaders)):
@@ -6119,12 +7440,16 @@ def updateAnswers(sessionName, create):
                             elif attr in qAttempted[qno]:
                                 rowVals[ansColIndex[qcolName]-1] = '' if (qAttempted[qno][attr]==None)  else qAttempted[qno][attr]
             qRows.append(rowVals[baseCols:])
-        answerSheet.getRange(answerStartRow, baseCols+1, nids, len(answerHeaders)-baseCols).setValues(qRows)
+        if modRows is None:
+            answerSheet.getRange(answerStartRow, baseCols+1, nids, len(answerHeaders)-baseCols).setValues(qRows)
+        else:
+            modCols = setDerivedRows(answerSheet, answerStartRow, baseCols+1, modRows, qRows)
 
         for ansCol in range(baseCols+1,len(answerHeaders)+1):
-            if answerHeaders[ansCol-1][-6:] == '_score':
+            if answerHeaders[ansCol-1][-6:] == '_score' and (modRows is None or ansCol in modCols):
                 answerSheet.getRange(answerAvgRow, ansCol, 1, 1).setNumberFormat('0.###')
                 updateColumnAvg(answerSheet, ansCol, answerAvgRow, avgStartRow)
+        answerSheet.derivedInfo = (signature, rowStamps)
     finally:
         pass
     return answerSheetName
@@ -6169,33 +7494,37 @@ def updateCorrect(sessionName, create):
         # Correct sheet columns
         correctStartRow = 3
 
-        # New correct sheet
-        correctSheet = createSheet(correctSheetName, correctHeaders, True)
-        corrColIndex = indexColumns(correctSheet)
-
-        correctSheet.getRange('2:2').setFontStyle('italic')
-        correctSheet.getRange(2, corrColIndex['id'], 1, 1).setValues([[AVERAGE_ID]])
-        correctSheet.getRange(2, corrColIndex['Timestamp'], 1, 1).setValues([[createDate()]])
-
         # Number of ids
         nids = sessionSheet.getLastRow()-sessionStartRow+1
 
-        # Copy session values
-        for j in range(0,len(sessionCopyCols)):
-            colHeader = sessionCopyCols[j]
-            sessionCol = sessionColIndex[colHeader]
-            corrCol = corrColIndex[colHeader]
-            correctSheet.getRange(correctStartRow, corrCol, nids, 1).setValues(sessionSheet.getSheetValues(sessionStartRow, sessionCol, nids, 1))
+        # Recompute only modified rows of existing correct sheet, if possible
+        signature = (correctHeaders, sessionEntries.get('attributes'), sessionEntries.get('questions'))
+        rowStamps = sessionRowStamps(sessionSheet, sessionStartRow)
+        modRows = modifiedDerivedRows(correctSheet, signature, rowStamps, correctStartRow)
+        if modRows is None:
+            # New correct sheet
+            correctSheet = createSheet(correctSheetName, correctHeaders, True)
+            corrColIndex = indexColumns(correctSheet)
+
+            correctSheet.getRange('2:2').setFontStyle('italic')
+            correctSheet.getRange(2, corrColIndex['id'], 1, 1).setValues([[AVERAGE_ID]])
+            correctSheet.getRange(2, corrColIndex['Timestamp'], 1, 1).setValues([[createDate()]])
+
+            # Copy session values
+            copySessionColumns(sessionSheet, sessionStartRow, correctSheet, correctStartRow, sessionCopyCols, nids)
+        elif modRows:
+            corrColIndex = indexColumns(correctSheet)
+            correctSheet.getRange(2, corrColIndex['Timestamp'], 1, 1).setValues([[createDate()]])
+            copySessionColumns(sessionSheet, sessionStartRow, correctSheet, correctStartRow, sessionCopyCols, nids, modRows)
+        else:
+            return correctSheetName
 
-        # Get hidden session values
-        hiddenSessionCol = sessionColIndex['session_hidden']
-        hiddenVals = sessionSheet.getSheetValues(sessionStartRow, hiddenSessionCol, nids, 1)
         qRows = []
         randomSeeds = []
 
-        for j in range(0,nids):
+        for j in (range(0,nids) if modRows is None else modRows):
             rowValues = sessionSheet.getSheetValues(j+sessionStartRow, 1, 1, len(sessionColHeaders))[0]
-            savedSession = unpackSession(sessionColHeaders, rowValues)
+            savedSession = unpackSession(sessionColHeaders, rowValues, sheet=sessionSheet)
             qAttempted = savedSession.get('questionsAttempted')
             qShuffle = savedSession.get('questionShuffle')
             randomSeeds.append([savedSession.get('randomSeed')])
@@ -6220,8 +7549,13 @@ def updateCorrect(sessionName, create):
                 rowVals.append(correctAns)
             qRows.append(rowVals)
 
-        correctSheet.getRange(correctStartRow, baseCols+1, nids, len(questions)).setValues(qRows)
-        correctSheet.getRange(correctStartRow, corrColIndex['randomSeed'], nids, 1).setValues(randomSeeds)
+        if modRows is None:
+            correctSheet.getRange(correctStartRow, baseCols+1, nids, len(questions)).setValues(qRows)
+            correctSheet.getRange(correctStartRow, corrColIndex['randomSeed'], nids, 1).setValues(randomSeeds)
+        else:
+            setDerivedRows(correctSheet, correctStartRow, baseCols+1, modRows, qRows)
+            setDerivedRows(correctSheet, correctStartRow, corrColIndex['randomSeed'], modRows, randomSeeds)
+        correctSheet.derivedInfo = (signature, rowStamps)
     finally:
         pass
     return correctSheetName
@@ -6274,34 +7608,40 @@ def updateStats(sessionName, create):
 
         avgStartRow = statStartRow + getNormalUserRow(sessionSheet, sessionStartRow) - sessionStartRow
 
-        # New stat sheet
-        statSheet = createSheet(statSheetName, statHeaders, True)
-
-        statSheet.getRange(statAvgRow, len(sessionCopyCols)+1, 1, len(statHeaders)-len(sessionCopyCols)).setNumberFormat('0.###')
-
-        statColIndex = indexColumns(statSheet)
-        statSheet.getRange(statAvgRow, statColIndex['id'], 1, 1).setValues([[AVERAGE_ID]])
-        statSheet.getRange(statAvgRow, statColIndex['Timestamp'], 1, 1).setValues([[createDate()]])
-        statSheet.getRange(str(statAvgRow)+':'+str(statAvgRow)).setFontStyle('italic')
-
-        for j in range(0,len(sessionCopyCols)):
-            colHeader = sessionCopyCols[j]
-            sessionCol = sessionColIndex[colHeader]
-            statCol = statColIndex[colHeader]
-            statSheet.getRange(statStartRow, statCol, nids, 1).setValues(sessionSheet.getSheetValues(sessionStartRow, sessionCol, nids, 1))
+        # Recompute only modified rows of existing stat sheet, if possible
+        signature = (statHeaders, avgStartRow, sessionEntries.get('attributes'), sessionEntries.get('questions'), sessionEntries.get('questionConcepts'))
+        rowStamps = sessionRowStamps(sessionSheet, sessionStartRow)
+        modRows = modifiedDerivedRows(statSheet, signature, rowStamps, statStartRow)
+        if modRows is None:
+            # New stat sheet
+            statSheet = createSheet(statSheetName, statHeaders, True)
+
+            statSheet.getRange(statAvgRow, len(sessionCopyCols)+1, 1, len(statHeaders)-len(sessionCopyCols)).setNumberFormat('0.###')
+
+            statColIndex = indexColumns(statSheet)
+            statSheet.getRange(statAvgRow, statColIndex['id'], 1, 1).setValues([[AVERAGE_ID]])
+            statSheet.getRange(statAvgRow, statColIndex['Timestamp'], 1, 1).setValues([[createDate()]])
+            statSheet.getRange(str(statAvgRow)+':'+str(statAvgRow)).setFontStyle('italic')
+
+            copySessionColumns(sessionSheet, sessionStartRow, statSheet, statStartRow, sessionCopyCols, nids)
+        elif modRows:
+            statColIndex = indexColumns(statSheet)
+            statSheet.getRange(statAvgRow, statColIndex['Timestamp'], 1, 1).setValues([[createDate()]])
+            copySessionColumns(sessionSheet, sessionStartRow, statSheet, statStartRow, sessionCopyCols, nids, modRows)
+        else:
+            return statSheetName
 
-        hiddenSessionCol = sessionColIndex['session_hidden']
-        hiddenVals = sessionSheet.getSheetValues(sessionStartRow, hiddenSessionCol, nids, 1)
         questionTallies = []
         conceptTallies = []
         nullConcepts = []
         for j in range(0,nconcepts):
             nullConcepts.append('')
 
-        for j in range(0,nids):
-            rowValues = sessionSheet.getSheetValues(j+sessionStartRow, 1, 1, len(sessionColHeaders))[0]
-            savedSession = unpackSession(sessionColHeaders, rowValues)
-            scores = tallyScores(questions, savedSession.get('questionsAttempted'), savedSession.get('hintsUsed'), sessionAttributes.get('params'), sessionAttributes.get('remoteAnswers'))
+        rowOffsets = range(0,nids) if modRows is None else modRows
+        savedSessions = [unpackSession(sessionColHeaders, sessionSheet.getSheetValues(j+sessionStartRow, 1, 1, len(sessionColHeaders))[0], sheet=sessionSheet) for j in rowOffsets]
+        allScores = tallyScoresBatch(questions, savedSessions, sessionAttributes.get('params'), sessionAttributes.get('remoteAnswers'))
+
+        for scores in allScores:
 
             questionTallies.append([scores.get('weightedCorrect'), scores.get('questionsCorrect'), scores.get('questionsCount'), scores.get('questionsSkipped')])
 
@@ -6315,12 +7655,19 @@ def updateStats(sessionName, create):
                 conceptTallies.append(missedFraction)
             else:
                 conceptTallies.append(nullConcepts)
-        statSheet.getRange(statStartRow, statQuestionCol, nids, nqstats).setValues(questionTallies)
-        if nconcepts:
-            statSheet.getRange(statStartRow, statConceptsCol, nids, nconcepts).setValues(conceptTallies)
+        if modRows is None:
+            statSheet.getRange(statStartRow, statQuestionCol, nids, nqstats).setValues(questionTallies)
+            if nconcepts:
+                statSheet.getRange(statStartRow, statConceptsCol, nids, nconcepts).setValues(conceptTallies)
+        else:
+            modCols = setDerivedRows(statSheet, statStartRow, statQuestionCol, modRows, questionTallies)
+            if nconcepts:
+                modCols.update(setDerivedRows(statSheet, statStartRow, statConceptsCol, modRows, conceptTallies))
 
         for avgCol in range(len(sessionCopyCols)+1,len(statHeaders)+1):
-            updateColumnAvg(statSheet, avgCol, statAvgRow, avgStartRow)
+            if modRows is None or avgCol in modCols:
+                updateColumnAvg(statSheet, avgCol, statAvgRow, avgStartRow)
+        statSheet.derivedInfo = (signature, rowStamps)
     finally:
         pass
 
@@ -38,16 +38,19 @@ import base64
 import csv
 import datetime
 import functools
+import gc
 import glob
 import importlib
 import io
 import json
 import logging
 import math
+import multiprocessing
 import random
 import subprocess
 import os.path
 import re
+import resource
 import shutil
 import socket
 import sys
@@ -56,10 +59,11 @@ import urllib
 import uuid
 import zipfile
 
-from collections import defaultdict, OrderedDict, namedtuple
+from collections import defaultdict, deque, OrderedDict, namedtuple
 
 import tornado.auth
 import tornado.autoreload
+import tornado.concurrent
 import tornado.gen
 import tornado.escape
 import tornado.httpserver
@@ -96,6 +100,12 @@ Options = {
     'backup_dir': '_DEFAULT_BACKUPS',
     'backup_hhmm': '',
     'backup_options': [],
+    'build_cache_dir': '',
+    'cache_max_mb': 0,
+    'cache_max_rows': 0,
+    'compact_cache': False,
+    'compact_updates': False,
+    'compile_procs': 2,
     'debug': False,
     'dry_run': False,
     'dry_run_file_modify': False,  # If true, allow source/web/plugin file mods even for dry run (e.g., local copy)
@@ -108,6 +118,7 @@ Options = {
     'host': 'localhost',
     'import_params': '',
     'insecure_cookie': False,
+    'journal_dir': '',
     'lock_proxy_url': '',
     'log_call': '',
     'min_wait_sec': 0,
@@ -265,7 +276,8 @@ EXPIRES_DAYS = 30
 BATCH_AGE = 60      # Age of batch cookies (sec)
 
 WS_TIMEOUT_SEC = 1200    # Aggressive websocket timeout OK, since clients can re-connect (with session versioning)
-EVENT_BUFFER_SEC = 3
+EVENT_BUFFER_SEC = 3     # Max. delay before buffered events are flushed (by a single shared timer for all connections)
+INTERACT_BATCH_SEC = 1   # Max. delay before queued interactive (text/twitter) responses are saved
 
 BACKUP_VERSION_FILE = '_version.txt'
 
@@ -436,6 +448,165 @@ def http_sync_post(url, params_dict=None):
         result = {'result': 'error', 'error': 'Error in http_sync_post: result='+str(result)+': '+str(excp)}
     return result
 
+def compileJob(job, http_post_func=None):
+    # Compile session file(s) with slidoc (in worker or server process); returns dict with messages (and HTML if return_html)
+    if job['open_files']:
+        fileHandles = [open(fpath) for fpath in job['file_paths']]
+    else:
+        fileHandles = [io.BytesIO(text) if text is not None else None for text in job['file_texts']]
+
+    configOpts = job['config_opts']
+    if job['toc_text'] is not None:
+        configOpts['toc_header'] = io.BytesIO(job['toc_text'])
+
+    try:
+        retval = slidoc.process_input(fileHandles, job['file_paths'], configOpts, default_args_dict=job['default_opts'], return_html=job['return_html'],
+                                      images_zipdict=job['images_zipdict'], nb_links=job['nb_links'], http_post_func=http_post_func or http_sync_post,
+                                      restricted_sessions_re=sliauth.RESTRICTED_SESSIONS_RE, return_messages=True,
+                                      extra_attributes=job['extra_attributes'])
+    except Exception, excp:
+        if Options['debug']:
+            import traceback
+            traceback.print_exc()
+        # Error return
+        return {'messages': ['Error in compile: '+(excp.message or str(excp))]}
+
+    if job['return_html']:
+        return retval
+    else:
+        # Normal return
+        return {'messages': retval.get('messages', []) if retval else []}
+
+def closeInheritedFiles(keepFds):
+    # Close file descriptors inherited from forking server process (listening/client sockets, IOLoop, pipes of other workers),
+    # so that connections closed by the server are not held open by worker process
+    gc.collect()   # Collect garbage holding inherited descriptors before closing (so that descriptor numbers are not closed again when re-used)
+    for handler in logging.getLogger().handlers:
+        try:
+            keepFds.add(handler.stream.fileno())
+        except Exception:
+            pass
+    if os.path.isdir('/proc/self/fd'):
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd') if fd.isdigit()]
+    else:
+        fds = range(resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+    for fd in fds:
+        if fd > 2 and fd not in keepFds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+def compileWorkerLoop(conn):
+    # Worker process: run compile jobs received over pipe, relaying local proxy requests to server process (which holds the sheet cache)
+    closeInheritedFiles(set([conn.fileno()]))
+    site_prefix = '/'+Options['site_name'] if Options['site_name'] else ''
+    def relay_post(url, params_dict=None):
+        if url != site_prefix+'/_proxy':
+            return http_sync_post(url, params_dict)
+        conn.send(['post', url, params_dict])
+        return conn.recv()
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        startTime = time.time()
+        retval = compileJob(job, http_post_func=relay_post)
+        conn.send(['done', retval, time.time()-startTime])
+
+class CompileWorker(object):
+    # Worker processes for compiling sessions off the IOLoop; jobs are queued and dispatched to idle workers
+    workers = []
+    jobQueue = deque()
+
+    @classmethod
+    def submit(cls, job):
+        # Returns future for compile output
+        future = tornado.concurrent.Future()
+        queueTime = time.time()
+        if not Options['compile_procs']:
+            # Compile in server process
+            future.set_result(compileJob(job))
+            cls.logJob(job, queueTime, queueTime, time.time()-queueTime)
+            return future
+        cls.jobQueue.append([job, future, queueTime])
+        cls.dispatch()
+        return future
+
+    @classmethod
+    def dispatch(cls):
+        while cls.jobQueue:
+            idleWorkers = [worker for worker in cls.workers if not worker.current]
+            if idleWorkers:
+                # Prefer worker that last compiled same session (to re-use slides cached for preview)
+                sameWorkers = [worker for worker in idleWorkers if worker.lastLabel == cls.jobQueue[0][0]['label']]
+                worker = sameWorkers[0] if sameWorkers else idleWorkers[0]
+            elif len(cls.workers) < Options['compile_procs']:
+                worker = cls()
+            else:
+                return
+            worker.current = cls.jobQueue.popleft() + [time.time()]
+            worker.lastLabel = worker.current[0]['label']
+            worker.conn.send(worker.current[0])
+
+    @classmethod
+    def logJob(cls, job, queueTime, startTime, elapsed):
+        print >> sys.stderr, 'sdserver.compile: %s %s, %d files, %.2fs (queued %.2fs)' % (sliauth.iso_date(nosubsec=True), job['label'], len(job['file_paths']), elapsed, startTime-queueTime)
+
+    @classmethod
+    def shutdown(cls):
+        cls.jobQueue.clear()
+        for worker in cls.workers[:]:
+            worker.close()
+
+    def __init__(self):
+        self.current = None   # [job, future, queueTime, startTime]
+        self.lastLabel = ''
+        self.conn, childConn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=compileWorkerLoop, args=(childConn,))
+        self.process.daemon = True
+        self.process.start()
+        childConn.close()
+        IOLoop.current().add_handler(self.conn.fileno(), self.handle_messages, IOLoop.READ)
+        self.workers.append(self)
+
+    def handle_messages(self, fd, events):
+        try:
+            while self.conn.poll():
+                msg = self.conn.recv()
+                if msg[0] == 'post':
+                    # Relayed proxy request
+                    try:
+                        retval = http_sync_post(msg[1], msg[2])
+                    except Exception, excp:
+                        retval = {'result': 'error', 'error': 'Error in compile proxy request: '+str(excp)}
+                    self.conn.send(retval)
+                else:
+                    self.finish_job(msg[1], msg[2])
+        except (EOFError, IOError), excp:
+            print >> sys.stderr, 'sdserver.CompileWorker: ERROR worker process %s exited: %s' % (self.process.pid, excp)
+            self.finish_job({'messages': ['Error in compile: worker process exited']}, 0)
+            self.close()
+        self.dispatch()
+
+    def finish_job(self, retval, elapsed):
+        if not self.current:
+            return
+        job, future, queueTime, startTime = self.current
+        self.current = None
+        self.logJob(job, queueTime, startTime, elapsed)
+        future.set_result(retval)
+
+    def close(self):
+        IOLoop.current().remove_handler(self.conn.fileno())
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(1)
+        self.workers.remove(self)
+
 def discussStats(userId, sessionName=''):
     nameMap = sdproxy.getDisplayNames()
     stats = sdproxy.getDiscussStats(userId, sessionName)
@@ -703,6 +874,7 @@ class BaseHandler(tornado.web.RequestHandler, UserIdMixin):
     site_web_dir = None
     site_data_dir = None
     site_backup_dir = None
+    site_build_dir = None
     site_files_dir = None
     @classmethod
     def setup_dirs(cls, site_name=''):
@@ -711,6 +883,7 @@ class BaseHandler(tornado.web.RequestHandler, UserIdMixin):
         cls.site_web_dir    = Options['web_dir'] + sitePrefix
         cls.site_data_dir   = Options['plugindata_dir'] + sitePrefix + '/' + PLUGINDATA_PATH if Options['plugindata_dir'] else None
         cls.site_backup_dir = Options['backup_dir'] + sitePrefix if Options['backup_dir'] else None
+        cls.site_build_dir  = Options['build_cache_dir'] + sitePrefix if Options['build_cache_dir'] else None
 
         if site_name and Options['restore_backup'] and Options['dry_run'] and not Options['dry_run_file_modify']:
             # Restoring from backup, dry run without file modification; override source/web/data directories with backup directories
@@ -1058,6 +1231,7 @@ class RootActionHandler(BaseHandler):
                     except Exception, err:
                         pass
 
+                WSHandler.flushResponses()
                 sdproxy.suspend_cache('shutdown')
 
         else:
@@ -1236,6 +1410,7 @@ class SiteActionHandler(BaseHandler):
 
 class ActionHandler(BaseHandler):
     previewState = {}
+    compilingPreview = ''   # Session name while compiling upload for preview
     cmd_opts =   { 'base': dict(debug=True),
                    'other': dict(),
                   }
@@ -1367,6 +1542,7 @@ class ActionHandler(BaseHandler):
             raise tornado.web.HTTPError(403)
         return self.postAction(subpath)
 
+    @tornado.gen.coroutine
     def put(self, subpath):
         if Options['debug']:
             print >> sys.stderr, 'DEBUG: putAction', Options['site_number'], subpath, len(self.request.body), self.request.arguments, self.request.headers.get('Content-Type')
@@ -1387,7 +1563,7 @@ class ActionHandler(BaseHandler):
                     fbody1 = sliauth.normalize_newlines(fbody1)
 
             try:
-                errMsg = self.uploadSession(uploadType, sessionNumber, fname1, fbody1, fname2, fbody2, modimages='clear')
+                errMsg = yield self.uploadSession(uploadType, sessionNumber, fname1, fbody1, fname2, fbody2, modimages='clear')
             except Exception, excp:
                 if Options['debug']:
                     import traceback
@@ -1466,7 +1642,7 @@ class ActionHandler(BaseHandler):
                 if not previewingSession:
                     self.displayMessage('Not previewing any session')
                     return
-                self.acceptPreview(modified=modifiedNum, slideId=self.get_argument('slideid', ''))
+                yield self.acceptPreview(modified=modifiedNum, slideId=self.get_argument('slideid', ''))
                 return
 
             elif action == '_edit':
@@ -1487,7 +1663,7 @@ class ActionHandler(BaseHandler):
                     if not self.previewState['modified']:
                         # Clear any unmodified preview
                         self.previewClear()
-                self.editSession(sessionName, sessionType=sessionType, start=True, slideNumber=slideNumber, startPreview=startPreview)
+                yield self.editSession(sessionName, sessionType=sessionType, start=True, slideNumber=slideNumber, startPreview=startPreview)
                 return
 
             elif action == '_closepreview':
@@ -1512,7 +1688,7 @@ class ActionHandler(BaseHandler):
                 postGrades = self.get_argument('gradebook', '')
                 if self.get_argument('submit', ''):
                     yield self.submitSession(sessionName, postGrades=postGrades)
-                self.releaseModule(sessionName, releaseDate=releaseDate)
+                yield self.releaseModule(sessionName, releaseDate=releaseDate)
                 return
 
         if Options['multisite'] and not Options['site_number']:
@@ -1579,7 +1755,7 @@ class ActionHandler(BaseHandler):
             delete = self.get_argument('delete', '')
             download = self.get_argument('download', '')
             newFolder = self.get_argument('newfolder', '')
-            self.browse('_browse', subsubpath, site_admin=self.check_admin_access(), delete=delete, download=download,
+            yield self.browse('_browse', subsubpath, site_admin=self.check_admin_access(), delete=delete, download=download,
                         newFolder=newFolder)
 
         elif action in ('_restore',):
@@ -1679,6 +1855,9 @@ class ActionHandler(BaseHandler):
             for path, user, connections in wsConnections:
                 wsInfo += [(path, user, math.floor(curTime-ws.msgTime), ws.clientVersion) for ws in connections]
             sorted(wsInfo)
+            self.write('\nSessions:\n')
+            for x in WSHandler.get_session_counts():
+                self.write("  %s: %d users, %d admin\n" % x)
             self.write('\nConnections:\n')
             for x in wsInfo:
                 self.write("  %s: %s (idle: %ds, v%s)\n" % x)
@@ -1795,8 +1974,8 @@ class ActionHandler(BaseHandler):
             allUsers = self.get_argument("allusers", '')
             if sessionName.endswith('_discuss'):
                 allUsers = True
-            self.displaySheet(sessionName, download=self.get_argument("download", ''),
-                               allUsers=allUsers, keepHidden=self.get_argument("keephidden", ''))
+            yield self.displaySheet(sessionName, download=self.get_argument("download", ''),
+                                    allUsers=allUsers, keepHidden=self.get_argument("keephidden", ''))
 
         elif action in ('_getcol', '_getrow'):
             subsubpath, sep, label = subsubpath.partition(';')
@@ -1814,7 +1993,7 @@ class ActionHandler(BaseHandler):
                     if action == '_getcol':
                         labelNum = colIndex.get(label, 0) if label else colIndex['id']
                     else:
-                        labelNum = sdproxy.indexRows(sheet, colIndex['id'], 2).get(label, 0) if label else 1
+                        labelNum = sdproxy.lookupRowIndex(label, sheet, 2) if label else 1
                 if action == '_getcol':
                     if labelNum < 1 or labelNum > sheet.getLastColumn():
                         self.write('Column '+label+' not found in cached sheet '+subsubpath)
@@ -1845,12 +2024,12 @@ class ActionHandler(BaseHandler):
                 uploadType, sessionNumber, src_path, web_path, web_images = self.getUploadType(subsubpath)
 
             if action == '_republish':
-                buildMsgs = self.rebuild(uploadType, make='' if republishForce else 'all', log_dict=True)
+                buildMsgs = yield self.rebuild(uploadType, make='' if republishForce else 'all', log_dict=True)
                 # Re-index after complete rebuild
-                indMsgs = self.rebuild(uploadType, indexOnly=True)
+                indMsgs = yield self.rebuild(uploadType, indexOnly=True)
             else:
                 buildMsgs = {}
-                indMsgs = self.rebuild(uploadType, indexOnly=True)
+                indMsgs = yield self.rebuild(uploadType, indexOnly=True)
 
             if action == '_republish' and (1 or any(buildMsgs.values()) or any(indMsgs)):
                 self.displaySessions(buildMsgs, indMsgs, msg='Completed republishing')
@@ -1861,7 +2040,7 @@ class ActionHandler(BaseHandler):
 
         elif action == '_delete':
             reset = bool(self.get_argument('reset',''))
-            errMsgs = self.deleteSession(subsubpath, reset=reset)
+            errMsgs = yield self.deleteSession(subsubpath, reset=reset)
             tocPath = getSessionPath(sessionName, site_prefix=True, toc=True)
             if errMsgs and any(errMsgs):
                 self.displayMessage(errMsgs, back_url=tocPath)
@@ -2028,6 +2207,22 @@ class ActionHandler(BaseHandler):
             self.displayMessage('<h3>Lockdown access token for user %s, session %s</h3><a href="%s" target="_blank"><b>Click or copy this link for locked access</b></a><p></p>%s' % (userId, sessionName, accessURL, img_data_uri) )
             return
 
+        elif action == '_qtally':
+            sessionName, sep, qnumber = sessionName.partition(';')
+            if not qnumber.isdigit():
+                raise tornado.web.HTTPError(403, log_message='CUSTOM:Error: Specify /_qtally/session_name;question_number')
+            tally = sdproxy.getResponseTally(sessionName, int(qnumber))
+            if self.get_argument('json', ''):
+                self.set_header('Content-Type', 'application/json')
+                self.write( json.dumps({'result': 'success', 'tally': tally}) )
+            else:
+                lines = ['Responded: %d' % tally['responded']]
+                if tally['correct'] is not None:
+                    lines.append('Correct:   %d' % tally['correct'])
+                lines.append('')
+                lines += ['%s: %d' % (sliauth.str_encode(bucket), count) for bucket, count in tally['counts']]
+                self.displayMessage(('<h3>%s: responses to question %s</h3>\n' % (sessionName, qnumber)) + preElement('\n'+'\n'.join(lines)+'\n')+'\n')
+
         elif action == '_interactcode':
             interactURL = Options['server_url'] + site_prefix
             if self.get_argument('dest',''):
@@ -2056,6 +2251,7 @@ class ActionHandler(BaseHandler):
             redirURL += '&slideid=' + slideId
         self.redirect(redirURL)
 
+    @tornado.gen.coroutine
     def deleteSession(self, sessionName, reset=False):
         if Options['debug']:
             print >> sys.stderr, 'DEBUG: deleteSession', Options['site_name'], sessionName, reset
@@ -2064,15 +2260,16 @@ class ActionHandler(BaseHandler):
         args = {'sheet': sessionName, 'delsheet': '1', 'admin': user, 'token': userToken}
         retObj = sdproxy.sheetAction(args)
         if retObj['result'] != 'success':
-            return ['Error in deleting sheet '+sessionName+': '+retObj.get('error','')]
+            raise tornado.gen.Return(['Error in deleting sheet '+sessionName+': '+retObj.get('error','')])
 
         if not Options['source_dir'] or (Options['dry_run'] and not Options['dry_run_file_modify']):
-            return []
+            raise tornado.gen.Return([])
 
         uploadType, sessionNumber, src_path, web_path, web_images = self.getUploadType(sessionName)
 
         if reset:
-            return self.rebuild(uploadType, make=sessionName)
+            errMsgs = yield self.rebuild(uploadType, make=sessionName)
+            raise tornado.gen.Return(errMsgs)
 
         if sessionName != 'index':
             if os.path.exists(src_path):
@@ -2087,19 +2284,19 @@ class ActionHandler(BaseHandler):
         filePaths = self.get_md_list(uploadType)
         if filePaths:
             # Rebuild session index
-            errMsgs = self.rebuild(uploadType, indexOnly=True)
+            errMsgs = yield self.rebuild(uploadType, indexOnly=True)
         else:
             # No more sessions of this type; remove session index
             ind_path = os.path.join(os.path.dirname(web_path), 'index.html')
             if os.path.exists(ind_path):
                 os.remove(ind_path)
-            errMsgs = self.rebuild(indexOnly=True)
+            errMsgs = yield self.rebuild(indexOnly=True)
 
         if errMsgs and any(errMsgs):
             msgs = ['Re-indexing after deleting session '+sessionName+':'] + [''] + errMsgs
-            return msgs
+            raise tornado.gen.Return(msgs)
 
-        return []
+        raise tornado.gen.Return([])
 
     def get_session_props(self, buildMsgs={}, indMsgs=[]):
         colNames = ['sessionWeight', 'releaseDate', 'dueDate', 'gradeDate']
@@ -2122,6 +2319,7 @@ class ActionHandler(BaseHandler):
         self.render('modules.html', site_name=Options['site_name'], session_types=SiteProps.session_types(), session_props=session_props, message=msg)
 
 
+    @tornado.gen.coroutine
     def browse(self, url_path, filepath, site_admin=False, delete='', download='', newFolder='', uploadName='', uploadContent=''):
         if Options['debug']:
             print >> sys.stderr, 'DEBUG: browse', Options['site_name'], repr(url_path), repr(filepath), site_admin, delete, download, newFolder, uploadName, len(uploadContent)
@@ -2261,7 +2459,7 @@ class ActionHandler(BaseHandler):
                         if uploadType != TOP_LEVEL:
                             filePaths = self.get_md_list(uploadType)
                             if filePaths:
-                                errMsgs = self.rebuild(uploadType, indexOnly=True)
+                                errMsgs = yield self.rebuild(uploadType, indexOnly=True)
 
                     status = 'Uploaded '+uploadName
                     if file_list:
@@ -2366,6 +2564,7 @@ class ActionHandler(BaseHandler):
         web_prefix = web_dir+SiteProps.private_prefix(uploadType)+'/'+uploadType+'/'+fname
         return uploadType, sessionNumber, src_dir+'/'+uploadType+'/'+fname+'.md', web_prefix+'.html', web_prefix+'_images'
 
+    @tornado.gen.coroutine
     def displaySheet(self, sessionName, download=False, allUsers=False, keepHidden=False):
             sheet = sdproxy.getSheet(sessionName, display=True)
             if not sheet:
@@ -2379,15 +2578,20 @@ class ActionHandler(BaseHandler):
                 except Exception, excp:
                     pass
 
-            rows = sheet.export(csvFormat=download, allUsers=allUsers, keepHidden=keepHidden, idRename=id_col, altidRename=altid_col)
             if download:
+                # Stream CSV in chunks, from a (copy-on-write) snapshot of the sheet
                 self.set_header('Content-Type', 'text/csv')
                 self.set_header('Content-Disposition', 'attachment; filename="%s.csv"' % sessionName)
-                self.write(rows)
+                rows = sheet.copy().export_rows(allUsers=allUsers, keepHidden=keepHidden, idRename=id_col, altidRename=altid_col)
+                for chunk in sdproxy.csvChunks(rows):
+                    self.write(chunk)
+                    yield self.flush()
             else:
+                rows = sheet.export(allUsers=allUsers, keepHidden=keepHidden, idRename=id_col, altidRename=altid_col)
                 self.render('table.html', site_name=Options['site_name'], table_name=sessionName, table_data=rows, table_fixed='fixed',
                             timestamp=timestamp)
 
+    @tornado.gen.coroutine
     def postAction(self, subpath):
         previewingSession = self.previewActive()
         site_prefix = '/'+Options['site_name'] if Options['site_name'] else ''
@@ -2422,12 +2626,14 @@ class ActionHandler(BaseHandler):
             if self.get_argument('rollover',''):
                 # Close all session websockets (forcing reload)
                 IOLoop.current().add_callback(WSHandler.closeSessionConnections, sessionName)
-                return self.rollover(sessionName, slideNumber)
+                yield self.rollover(sessionName, slideNumber)
+                return
 
             if self.get_argument('truncate',''):
                 # Close all session websockets (forcing reload)
                 IOLoop.current().add_callback(WSHandler.closeSessionConnections, sessionName)
-                return self.rollover(sessionName, slideNumber, truncateOnly=True)
+                yield self.rollover(sessionName, slideNumber, truncateOnly=True)
+                return
 
             sessionText = self.get_argument('sessiontext', '')
             fromSession = self.get_argument('fromsession', '')
@@ -2447,8 +2653,9 @@ class ActionHandler(BaseHandler):
                 for ipath in zfile.namelist():
                     zfile.writestr(sessionNext+'_images/'+os.path.basename(ipath), ifile.read(ipath))
 
-            return self.editSession(sessionName, sessionType=sessionType, update=update, sessionText=sessionText, fromSession=fromSession, fromSite=fromSite,
-                                    slideNumber=slideNumber, newNumber=newNumber, deleteSlide=deleteSlide, modify=sessionModify, imageZip=imageZip)
+            yield self.editSession(sessionName, sessionType=sessionType, update=update, sessionText=sessionText, fromSession=fromSession, fromSite=fromSite,
+                                   slideNumber=slideNumber, newNumber=newNumber, deleteSlide=deleteSlide, modify=sessionModify, imageZip=imageZip)
+            return
 
         elif action == '_imageupload':
             if not previewingSession:
@@ -2459,11 +2666,12 @@ class ActionHandler(BaseHandler):
             sessionName = self.get_argument("sessionname")
             imageFile = self.get_argument("imagefile", "")
             autonumber = self.get_argument("autonumber", "")
-            return self.imageUpload(sessionName, imageFile, fname, fbody, autonumber=autonumber)
+            self.imageUpload(sessionName, imageFile, fname, fbody, autonumber=autonumber)
+            return
 
         if action in ('_sheet',):
-            self.displaySheet(sessionName, download=self.get_argument("download", ''),
-                               allUsers=self.get_argument("allusers", ''), keepHidden=self.get_argument("keephidden", ''))
+            yield self.displaySheet(sessionName, download=self.get_argument("download", ''),
+                                    allUsers=self.get_argument("allusers", ''), keepHidden=self.get_argument("keephidden", ''))
             return
 
         if previewingSession:
@@ -2492,7 +2700,7 @@ class ActionHandler(BaseHandler):
             elif action == '_browse':
                 fileinfo = self.request.files['upload'][0]
                 fname = fileinfo['filename']
-                self.browse('_browse', subsubpath, site_admin=self.check_admin_access(), uploadName=fname, uploadContent=fileinfo['body'])
+                yield self.browse('_browse', subsubpath, site_admin=self.check_admin_access(), uploadName=fname, uploadContent=fileinfo['body'])
 
             elif action == '_editroster':
                 headers = sdproxy.getRosterHeaders()
@@ -2728,7 +2936,7 @@ class ActionHandler(BaseHandler):
                 try:
                     if fbody1 and fname1.endswith('.md'):
                         fbody1 = sliauth.normalize_newlines(fbody1)
-                    errMsg = self.uploadSession(uploadType, sessionNumber, fname1, fbody1, fname2, fbody2, modify=sessionModify, create=sessionCreate, modimages='clear')
+                    errMsg = yield self.uploadSession(uploadType, sessionNumber, fname1, fbody1, fname2, fbody2, modify=sessionModify, create=sessionCreate, modimages='clear')
                 except Exception, excp:
                     if Options['debug']:
                         import traceback
@@ -2817,9 +3025,10 @@ class ActionHandler(BaseHandler):
             topnavList = ['index.html'] + topnavList
         return topnavList
 
+    @tornado.gen.coroutine
     def uploadSession(self, uploadType, sessionNumber, fname1, fbody1, fname2='', fbody2='', modify=None, create=False, rollingOver=False, modimages='', deleteSlideNum=0):
         # Return null string on success or error message
-        if self.previewActive():
+        if self.previewActive() or self.compilingPreview:
             raise Exception('Already previewing session')
 
         if Options['debug']:
@@ -2828,7 +3037,7 @@ class ActionHandler(BaseHandler):
         zfile = None
         if fname2:
             if not fname2.endswith('.zip'):
-                return 'Invalid zip archive name %s; must have extension .zip' % fname2
+                raise tornado.gen.Return('Invalid zip archive name %s; must have extension .zip' % fname2)
             try:
                 zfile = zipfile.ZipFile(io.BytesIO(fbody2))
             except Exception, excp:
@@ -2836,7 +3045,7 @@ class ActionHandler(BaseHandler):
 
         if uploadType == RAW_UPLOAD:
             if not zfile:
-                return 'Error: Must provide Zip archive for raw upload'
+                raise tornado.gen.Return('Error: Must provide Zip archive for raw upload')
             try:
                 # Unzip archive to web_dir
                 zfile = zipfile.ZipFile(io.BytesIO(fbody2))
@@ -2851,22 +3060,22 @@ class ActionHandler(BaseHandler):
                     zfile.extractall(self.site_web_dir, src_list)
                 if web_list:
                     zfile.extractall(self.site_web_dir, web_list)
-                msgs = ['Zip archive uploaded']
-                errMsgs = self.rebuild(TOP_LEVEL, indexOnly=True)
-                if errMsgs and any(errMsgs):
-                    msgs += [''] + errMsgs
-                self.displayMessage(msgs)
-                return ''
             except Exception, excp:
                 raise Exception('Error in unzipping raw archive: ' + str(excp))
+            msgs = ['Zip archive uploaded']
+            errMsgs = yield self.rebuild(TOP_LEVEL, indexOnly=True)
+            if errMsgs and any(errMsgs):
+                msgs += [''] + errMsgs
+            self.displayMessage(msgs)
+            raise tornado.gen.Return('')
 
         if not fname1 or not fbody1:
             if not zfile:
-                return 'Error: Must enter text or provide .md/.pptx file for upload'
+                raise tornado.gen.Return('Error: Must enter text or provide .md/.pptx file for upload')
             # Extract Markdown file from zip archive
             topNames = [name for name in zfile.namelist() if name.endswith('.md') or name.endswith('.pptx')]
             if len(topNames) != 1:
-                return 'Error: Expecting single .md/.pptx file in zip archive. ' + ', '.join(topNames)
+                raise tornado.gen.Return('Error: Expecting single .md/.pptx file in zip archive. ' + ', '.join(topNames))
             fname1 = topNames[0]
             fbody1 = zfile.read(fname1)
 
@@ -2922,8 +3131,12 @@ class ActionHandler(BaseHandler):
             if modify:
                 extraOpts['modify_sessions'] = modify
 
-            retval = self.compile(uploadType, src_path=src_path, contentText=fbody1, images_zipdata=images_zipdata, dest_dir=web_dir,
-                                              image_dir=image_dir, extraOpts=extraOpts)
+            ActionHandler.compilingPreview = sessionName
+            try:
+                retval = yield self.compile(uploadType, src_path=src_path, contentText=fbody1, images_zipdata=images_zipdata, dest_dir=web_dir,
+                                            image_dir=image_dir, extraOpts=extraOpts)
+            finally:
+                ActionHandler.compilingPreview = ''
 
             if 'md_params' not in retval:
                 print >> sys.stderr, 'sdserver.uploadSession: Error', uploadType, src_path, len(fbody1), retval
@@ -2978,7 +3191,6 @@ class ActionHandler(BaseHandler):
             self.previewState['overwrite'] = overwrite
             self.previewState['rollover'] = None
             self.previewState['session_responders'] = getResponderCount(sessionName, uploadType)
-            return ''
 
         except Exception, err:
             if Options['debug']:
@@ -2990,7 +3202,9 @@ class ActionHandler(BaseHandler):
             temMsg = err.message+'\n'
             if temMsg.strip() and not temMsg.lower().startswith('error'):
                 temMsg = 'Error:\n' + temMsg
-            return temMsg
+            raise tornado.gen.Return(temMsg)
+
+        raise tornado.gen.Return('')
 
     def createUnmodifiedPreview(self, sessionName, slideId=''):
         uploadType, sessionNumber, src_path, web_path, web_images = self.getUploadType(sessionName)
@@ -3060,10 +3274,12 @@ class ActionHandler(BaseHandler):
         # Broadcast reload event to admin user accessing preview
         WSHandler.sendEvent(previewPath, '', userRole, False, True, [userId, 1, 'ReloadPage', [slideNumber]])
 
+    @tornado.gen.coroutine
     def compile(self, uploadType, src_path='', contentText='', images_zipdata='', dest_dir='', image_dir='', indexOnly=False,
                 make='', extraOpts={}):
         # If src_path, compile single .md file, returning output
         # Else, compile all files of that type, updating index etc.
+        # (Compilation runs in a worker process; proxy requests from slidoc are relayed back to this process)
         images_zipdict = {}
         if src_path:
             sessionName = os.path.splitext(os.path.basename(src_path))[0]
@@ -3082,11 +3298,14 @@ class ActionHandler(BaseHandler):
                                                        session_name=sessionName, image_dir=image_dir, make=make)
 
         configOpts.update(extraOpts)
+        if self.site_build_dir:
+            configOpts['build_cache'] = os.path.join(self.site_build_dir, uploadType)
 
         nb_links = {}
+        tocText = None
         if uploadType != TOP_LEVEL:
             if sessionName == 'index':
-                configOpts['toc_header'] = io.BytesIO(contentText)
+                tocText = contentText
             else:
                 src_dir = os.path.dirname(filePaths[0]) if filePaths else self.site_src_dir + '/' + uploadType
                 ind_path = os.path.join(src_dir, 'index.md')
@@ -3106,38 +3325,26 @@ class ActionHandler(BaseHandler):
                             _, nb_links[sname] = self.viewer_link(NOTEBOOKS_PATH + '/' + nb_name)
 
         if src_path:
-            fileHandles = [io.BytesIO(contentText) if fpath == src_path else None for fpath in filePaths]
-        elif indexOnly:
-            fileHandles = [None for fpath in filePaths]
+            fileTexts = [contentText if fpath == src_path else None for fpath in filePaths]
         else:
-            fileHandles = [open(fpath) for fpath in filePaths]
+            fileTexts = [None for fpath in filePaths]
 
         if Options['debug']:
             print >> sys.stderr, Options['server_url'], 'sdserver.compile: %s type=%s, src=%s, index=%s, server=%s, make=%s, create_toc=%s, topnav=%s, strip=%s:%s, pace=%s:%s, nb=%s, files=%s' % (sliauth.iso_date(nosubsec=True), uploadType, repr(src_path), indexOnly, configOpts.get('server_url'), configOpts.get('make'), configOpts.get('create_toc'), configOpts.get('topnav'), configOpts.get('strip'), defaultOpts.get('strip'), configOpts.get('pace'), defaultOpts.get('pace'), nb_links.keys(), fileNames)
 
         return_html = bool(src_path)
+        job = {'label': uploadType+('/'+sessionName if sessionName else ('/index' if indexOnly else '')),
+               'file_paths': filePaths, 'file_texts': fileTexts, 'open_files': not src_path and not indexOnly, 'toc_text': tocText,
+               'config_opts': configOpts, 'default_opts': defaultOpts, 'return_html': return_html,
+               'images_zipdict': images_zipdict, 'nb_links': nb_links,
+               'extra_attributes': {'privateSession': 1 if SiteProps.private_prefix(uploadType) else 0} }
 
-        try:
-            extra_attributes = {'privateSession': 1 if SiteProps.private_prefix(uploadType) else 0}
-            retval = slidoc.process_input(fileHandles, filePaths, configOpts, default_args_dict=defaultOpts, return_html=return_html,
-                                          images_zipdict=images_zipdict, nb_links=nb_links, http_post_func=http_sync_post,
-                                          restricted_sessions_re=sliauth.RESTRICTED_SESSIONS_RE, return_messages=True,
-                                          extra_attributes=extra_attributes)
-        except Exception, excp:
-            if Options['debug']:
-                import traceback
-                traceback.print_exc()
-            # Error return
-            return {'messages': ['Error in compile: '+(excp.message or str(excp))]}
-            
-        if return_html:
-            if Options['debug'] and retval.get('messages'):
-                print >> sys.stderr, 'sdserver.compile:', src_path, ' '.join(fileNames)+'\n', '\n'.join(retval['messages'])
-            return retval
-        else:
-            # Normal return
-            return {'messages': retval.get('messages', []) if retval else []}
+        retval = yield CompileWorker.submit(job)
+        if return_html and Options['debug'] and retval.get('messages'):
+            print >> sys.stderr, 'sdserver.compile:', src_path, ' '.join(fileNames)+'\n', '\n'.join(retval['messages'])
+        raise tornado.gen.Return(retval)
 
+    @tornado.gen.coroutine
     def rebuild(self, uploadType='', indexOnly=False, make='', log_dict=False):
         if uploadType:
             utypes = [uploadType] if uploadType != TOP_LEVEL else []
@@ -3151,20 +3358,21 @@ class ActionHandler(BaseHandler):
         msg_list = []
         if Options['debug'] :
             print >> sys.stderr, 'sdserver.rebuild:', make, utypes
-        for utype in utypes:
-            retval = self.compile(utype, dest_dir=self.site_web_dir+SiteProps.private_prefix(utype)+'/'+utype, indexOnly=indexOnly, make=make)
+        # Session types are compiled concurrently (as pool workers are available)
+        retvals = yield [self.compile(utype, dest_dir=self.site_web_dir+SiteProps.private_prefix(utype)+'/'+utype, indexOnly=indexOnly, make=make) for utype in utypes]
+        for utype, retval in zip(utypes, retvals):
             msgs = retval.get('messages',[])
             msg_dict[utype] = msgs
             if msgs:
                 msg_list += msgs + ['']
 
-        retval = self.compile(TOP_LEVEL, dest_dir=self.site_web_dir, indexOnly=False, make='')
+        retval = yield self.compile(TOP_LEVEL, dest_dir=self.site_web_dir, indexOnly=False, make='')
         msgs = retval.get('messages',[])
         msg_dict[TOP_LEVEL] = msgs
         if msgs:
             msg_list += msgs
 
-        return msg_dict if log_dict else msg_list
+        raise tornado.gen.Return(msg_dict if log_dict else msg_list)
 
 
     def imageUpload(self, sessionName, imageFile, fname, fbody, autonumber=None):
@@ -3302,6 +3510,7 @@ class ActionHandler(BaseHandler):
         self.write(content)
 
 
+    @tornado.gen.coroutine
     def acceptPreview(self, modified=0, acceptMessages=[], slideId=''):
         # Modified == -1 disables version checking
         if Options['dry_run'] and not Options['dry_run_file_modify']:
@@ -3377,7 +3586,7 @@ class ActionHandler(BaseHandler):
 
         if sessionName != 'index':
             WSHandler.lockSessionConnections(sessionName, 'Session modified. Reload page', reload=True)
-        errMsgs = self.rebuild(uploadType, indexOnly=True)
+        errMsgs = yield self.rebuild(uploadType, indexOnly=True)
 
         msgs = []
         if errMsgs and any(errMsgs):
@@ -3409,20 +3618,21 @@ class ActionHandler(BaseHandler):
             redirPath = getSessionPath(sessionName, site_prefix=True, toc=True)
 
         if rolloverParams:
-            self.truncateSession(rolloverParams, prevSessionName=sessionName, prevMsgs=msgs, rollingOver=True)
+            yield self.truncateSession(rolloverParams, prevSessionName=sessionName, prevMsgs=msgs, rollingOver=True)
         elif previewOnly or (msgs and (logErrors or not slideId)):
             self.displayMessage(msgs, back_url=redirPath)
         else:
             self.redirect(redirPath)
 
 
+    @tornado.gen.coroutine
     def truncateSession(self, truncateParams, prevSessionName='', prevMsgs=[], rollingOver=False):
         # Truncate session (possibly after rollover)
         sessionName = truncateParams['sessionName']
         sessionPath = getSessionPath(sessionName, site_prefix=True)
 
         try:
-            errMsg = self.uploadSession(truncateParams['uploadType'], truncateParams['sessionNumber'], truncateParams['sessionName']+'.md', truncateParams['sessionText'], truncateParams['fname2'], truncateParams['fbody2'], modify='truncate', rollingOver=rollingOver)
+            errMsg = yield self.uploadSession(truncateParams['uploadType'], truncateParams['sessionNumber'], truncateParams['sessionName']+'.md', truncateParams['sessionText'], truncateParams['fname2'], truncateParams['fbody2'], modify='truncate', rollingOver=rollingOver)
 
         except Exception, excp:
             if Options['debug']:
@@ -3495,6 +3705,7 @@ class ActionHandler(BaseHandler):
             raise tornado.web.HTTPError(404, log_message='CUSTOM:'+str(excp))
 
 
+    @tornado.gen.coroutine
     def editSession(self, sessionName, sessionType='', sessionText='', start=False, startPreview=False, update=False, modify=None, fromSession='', fromSite='', slideNumber=None, newNumber=None, deleteSlide='', imageZip=None):
         # sessiontext may be modified text for all slides or just a single slide, depending upon slideNumber
         sessionName, sessionText, fromSession, fromSite = md2md.stringify(sessionName, sessionText, fromSession, fromSite)
@@ -3688,7 +3899,7 @@ class ActionHandler(BaseHandler):
                 fname2 = sessionName+'_images.zip'
 
         try:
-            errMsg = self.uploadSession(uploadType, sessionNumber, sessionName+'.md', sessionText, fname2, fbody2, modify=modify, modimages=modimages, deleteSlideNum=deleteSlideNum)
+            errMsg = yield self.uploadSession(uploadType, sessionNumber, sessionName+'.md', sessionText, fname2, fbody2, modify=modify, modimages=modimages, deleteSlideNum=deleteSlideNum)
         except Exception, excp:
             if Options['debug']:
                 import traceback
@@ -3746,6 +3957,7 @@ class ActionHandler(BaseHandler):
                 print >> sys.stderr, 'ActionHandler:submitSession.SLEEP', j
                 yield tornado.gen.sleep(1)
 
+    @tornado.gen.coroutine
     def releaseModule(self, sessionName, releaseDate=''):
         releaseDate = str(releaseDate)  # Unicode releaseDate contaminates the UTF-8 strings
         if releaseDate and releaseDate != sliauth.FUTURE_DATE and not sliauth.parse_date(releaseDate):
@@ -3787,7 +3999,7 @@ class ActionHandler(BaseHandler):
             print >> sys.stderr, 'ActionHandler:releaseModule', releaseDate, sessionName, slidocOptions
 
         try:
-            errMsg = self.uploadSession(uploadType, sessionNumber, sessionName+'.md', sessionText, '', '')
+            errMsg = yield self.uploadSession(uploadType, sessionNumber, sessionName+'.md', sessionText, '', '')
         except Exception, excp:
             if Options['debug']:
                 import traceback
@@ -3801,8 +4013,9 @@ class ActionHandler(BaseHandler):
                 errMsg += ' (session: '+sessionName+')'
             raise tornado.web.HTTPError(404, log_message='CUSTOM:'+errMsg)
 
-        self.acceptPreview(modified=-1, acceptMessages=['Released module '+sessionName, ''] + self.previewState['messages'])
+        yield self.acceptPreview(modified=-1, acceptMessages=['Released module '+sessionName, ''] + self.previewState['messages'])
 
+    @tornado.gen.coroutine
     def rollover(self, sessionName, slideNumber=None, truncateOnly=False):
         sessionName = md2md.stringify(sessionName)
         if self.previewState:
@@ -3871,7 +4084,7 @@ class ActionHandler(BaseHandler):
             rolloverParams = None
 
         if truncateOnly:
-            self.truncateSession(rolloverParams)
+            yield self.truncateSession(rolloverParams)
             return
 
         # Rollover slides to next session
@@ -3925,7 +4138,7 @@ class ActionHandler(BaseHandler):
             fname2 = sessionNext+'_images.zip'
 
         try:
-            errMsg = self.uploadSession(uploadType, sessionNumber+1, sessionNext+'.md', combineText, fname2, fbody2, modify='overwrite', modimages='clear')
+            errMsg = yield self.uploadSession(uploadType, sessionNumber+1, sessionNext+'.md', combineText, fname2, fbody2, modify='overwrite', modimages='clear')
         except Exception, excp:
             if Options['debug']:
                 import traceback
@@ -4039,7 +4252,7 @@ class UserActionHandler(ActionHandler):
             if subsubpath != 'files' and not subsubpath.startswith('files/'):
                 raise tornado.web.HTTPError(403)
             url_path = '_browse' if admin_access else '_user_browse'
-            self.browse(url_path, subsubpath, site_admin=admin_access, download=self.get_argument('download', ''))
+            yield self.browse(url_path, subsubpath, site_admin=admin_access, download=self.get_argument('download', ''))
             return
 
         elif action in ('_user_discussclose',):
@@ -4483,26 +4696,81 @@ class ConnectionList(list):
 
 class WSHandler(tornado.websocket.WebSocketHandler, UserIdMixin):
     _connections = defaultdict(functools.partial(defaultdict,ConnectionList))
+    _sessionPaths = {}         # Session name -> set of paths with connections (maintained by addConnection/removeConnection)
+    _adminIds = {}             # Path -> set of connected admin user ids
     _interactiveSession = (None, None, None, None)
     _interactiveErrors = {}
     _sessionVersions = {}
+    _pendingFlush = set()      # Connections with non-empty event buffers
+    _flushTimeout = None
+    _eventCount = 0            # Buffer key for events that are not overwritten
+    _pendingResponses = OrderedDict()  # (path, slideId, qnumber, slideNum) -> OrderedDict(userId -> [response, explain]) for interactive responses
+    _responseTimeout = None
 
     @classmethod
     def get_connections(cls, sessionName=''):
         # Return dict((user, connections_list)) if sessionName
         # else return list of tuples [ (path, user, connections) ]
-        lst = []
-        for path, path_dict in cls._connections.items():
-            if sessionName:
-                if cls.get_path_base(path, special=True) == sessionName:
-                    return path_dict
-            else:
-                for user, connections in path_dict.items():
-                    lst.append( (path, user, connections) )
         if sessionName:
+            for path in cls._sessionPaths.get(sessionName, ()):
+                return cls._connections[path]
             return {}
-        else:
-            return lst
+
+        lst = []
+        for path, path_dict in cls._connections.items():
+            for user, connections in path_dict.items():
+                lst.append( (path, user, connections) )
+        return lst
+
+    @classmethod
+    def get_session_counts(cls):
+        # Return list of tuples [ (sessionName, normal_users_count, admin_users_count) ]
+        lst = []
+        for sessionName, paths in cls._sessionPaths.items():
+            nusers = sum(len(cls._connections[path]) for path in paths)
+            nadmins = sum(len(cls._adminIds.get(path, ())) for path in paths)
+            lst.append( (sessionName, nusers-nadmins, nadmins) )
+        return sorted(lst)
+
+    @classmethod
+    def getSessionAdmin(cls, path):
+        # Return id of an admin user connected to path, or null string
+        for userId in cls._adminIds.get(path, ()):
+            return userId
+        return ''
+
+    @classmethod
+    def addConnection(cls, connection):
+        path, userId = connection.pathUser
+        connectionList = cls._connections[path][userId]
+        if not connectionList:
+            connectionList.sd_role = connection.userRole
+            if connectionList.sd_role == sdproxy.ADMIN_ROLE:
+                cls._adminIds.setdefault(path, set()).add(userId)
+            cls._sessionPaths.setdefault(cls.get_path_base(path, special=True), set()).add(path)
+        connectionList.append(connection)
+
+    @classmethod
+    def removeConnection(cls, connection):
+        path, userId = connection.pathUser
+        connectionList = cls._connections.get(path, {}).get(userId)
+        if connectionList is None or connection not in connectionList:
+            return
+        connectionList.remove(connection)
+        if connectionList:
+            return
+        del cls._connections[path][userId]
+        if connectionList.sd_role == sdproxy.ADMIN_ROLE:
+            cls._adminIds[path].discard(userId)
+            if not cls._adminIds[path]:
+                del cls._adminIds[path]
+        if cls._connections[path]:
+            return
+        del cls._connections[path]
+        sessionName = cls.get_path_base(path, special=True)
+        cls._sessionPaths[sessionName].discard(path)
+        if not cls._sessionPaths[sessionName]:
+            del cls._sessionPaths[sessionName]
 
     @classmethod
     def getInteractiveSession(cls):
@@ -4532,6 +4800,8 @@ class WSHandler(tornado.websocket.WebSocketHandler, UserIdMixin):
         elif action in ('rollback', 'end'):
             if not interactiveSession:
                 return
+            # Save queued responses before ending (or rolling back) transaction
+            cls.flushResponses()
             cls._interactiveSession = (None, '', '', None)
             cls._interactiveErrors = {}
             if sdproxy.transactionalSession(interactiveSession):
@@ -4624,13 +4894,8 @@ class WSHandler(tornado.websocket.WebSocketHandler, UserIdMixin):
                 print >> sys.stderr, 'sdserver.processMessage:', msg
             return msg if allStatus else ''
 
-        session_connections = cls._connections.get(path)
-        admin_found = ''
-        if session_connections:
-            for connId, connections in session_connections.items():
-                if connections.sd_role == sdproxy.ADMIN_ROLE:
-                    admin_found = connId
-                    break
+        session_connections = cls._connections.get(path, {})
+        admin_found = cls.getSessionAdmin(path)
 
         if not admin_found:
             cls._interactiveSession = (None, None, None, None)
@@ -4649,41 +4914,82 @@ class WSHandler(tornado.websocket.WebSocketHandler, UserIdMixin):
         for connection in session_connections.get(fromUser,[]):
             connection.close()
 
-        create = source or 'message'
-        opts = {'getheaders': '1', 'create': create}
-        if accessCode:
-            opts['access'] =  str(accessCode)
-        retval = sdproxy.getUserRow(sessionName, fromUser, fromName, opts=opts)
-        if retval['result'] != 'success':
-            msg = 'Error in processing message from '+fromUser+': '+retval['error']
-            print >> sys.stderr, 'sdserver.processMessage:', msg
-            return msg
+        try:
+            sessionSheet = sdproxy.getSheet(sessionName)
+        except Exception:
+            # (Error will be reported by getUserRow)
+            sessionSheet = None
+        if sessionSheet and sdproxy.lookupRowIndex(fromUser, sessionSheet):
+            # Existing user row (saved later, with other queued responses)
+            headers = sessionSheet.getHeaders()
+        else:
+            # Create user row
+            create = source or 'message'
+            opts = {'getheaders': '1', 'create': create}
+            if accessCode:
+                opts['access'] =  str(accessCode)
+            retval = sdproxy.getUserRow(sessionName, fromUser, fromName, opts=opts)
+            if retval['result'] != 'success':
+                msg = 'Error in processing message from '+fromUser+': '+retval['error']
+                print >> sys.stderr, 'sdserver.processMessage:', msg
+                return msg
+            headers = retval['headers']
 
         qnumber = questionAttrs['qnumber']
-        if 'q'+str(qnumber)+'_response' not in retval['headers']:
+        if 'q'+str(qnumber)+'_response' not in headers:
             msg = 'Message from '+fromUser+' discarded. No shared response expected for '+sessionName
             if Options['debug']:
                 print >> sys.stderr, 'sdserver.processMessage:', msg
             return msg
 
-        errMsg = cls.processMessageAux(path, fromUser, retval['value'], retval['headers'], questionAttrs, message)
+        errMsg = cls.processMessageAux(path, fromUser, headers, slideId, questionAttrs, message)
 
         if errMsg:
             cls._interactiveErrors[fromUser] = errMsg
             if Options['debug']:
                 print >> sys.stderr, 'sdserver.processMessage:', errMsg
+            cls.queueResponse(path, fromUser, slideId, questionAttrs, None)
         else:
             if fromUser in cls._interactiveErrors:
                 del cls._interactiveErrors[fromUser]
-        # Send answerNotify event to admin users
-        cls.sendEvent(path, fromUser, sdproxy.ADMIN_ROLE, False, True, ['', 2, 'Share.answerNotify.%d' % sliauth.get_slide_number(slideId), [qnumber, cls._interactiveErrors]])
         return errMsg
 
     @classmethod
-    def processMessageAux(cls, path, fromUser, row, headers, questionAttrs, message):
-        sessionName = cls.get_path_base(path)
+    def queueResponse(cls, path, fromUser, slideId, questionAttrs, userResponse):
+        # Queue [response, explain] (or just an answerNotify event, if None) to be saved in a batch
+        # (later responses from the same user within a batch replace earlier ones)
+        userResponses = cls._pendingResponses.setdefault((path, slideId, questionAttrs['qnumber'], questionAttrs['slide']), OrderedDict())
+        if userResponse:
+            userResponses.pop(fromUser, None)
+            userResponses[fromUser] = userResponse
+        if not cls._responseTimeout:
+            cls._responseTimeout = IOLoop.current().call_later(INTERACT_BATCH_SEC, cls.flushResponses)
+
+    @classmethod
+    def flushResponses(cls):
+        # Save queued responses, with a single answerNotify event to admin users for each question
+        if cls._responseTimeout:
+            IOLoop.current().remove_timeout(cls._responseTimeout)
+            cls._responseTimeout = None
+        pending = cls._pendingResponses
+        cls._pendingResponses = OrderedDict()
+        for (path, slideId, qnumber, slideNum), userResponses in pending.items():
+            if userResponses:
+                # Single update of session sheet for all responses to question
+                errors, teamModifiedIds = sdproxy.putUserResponses(cls.get_path_base(path), qnumber, userResponses, lastSlide=slideNum)
+                for fromUser, errMsg in errors.items():
+                    print >> sys.stderr, 'sdserver.flushResponses:', 'Error in updating response from '+fromUser+': '+errMsg
+                    cls._interactiveErrors[fromUser] = errMsg
+
+                # Close all connections for the team
+                for teamModifiedId in teamModifiedIds:
+                    cls.lockConnections(path, teamModifiedId, 'Team member responded. Reload page', reload=True)
+
+            cls.sendEvent(path, '', sdproxy.ADMIN_ROLE, False, True, ['', 2, 'Share.answerNotify.%d' % sliauth.get_slide_number(slideId), [qnumber, cls._interactiveErrors]])
+
+    @classmethod
+    def processMessageAux(cls, path, fromUser, headers, slideId, questionAttrs, message):
         qnumber = questionAttrs['qnumber']
-        qResponse = 'q'+str(qnumber)+'_response'
         qExplain = 'q'+str(qnumber)+'_explain'
         message = message.strip()
 
@@ -4716,26 +5022,7 @@ class WSHandler(tornado.websocket.WebSocketHandler, UserIdMixin):
                 if offset < 0 or offset >= questionAttrs['choices']:
                     return 'Invalid choice'
                     
-        row[headers.index(qResponse)] = response
-        if qExplain in headers:
-            row[headers.index(qExplain)] = explain
-        row[headers.index('lastSlide')] = questionAttrs['slide']
-
-        for j, header in enumerate(headers):
-            if header.endswith('Timestamp'):
-                row[j] = None
-
-        retval = sdproxy.putUserRow(sessionName, fromUser, row)
-        if retval['result'] != 'success':
-            print >> sys.stderr, 'sdserver.processMessage:', 'Error in updating response from '+fromUser+': '+retval['error']
-            return 'Unknown error'
-
-        teamModifiedIds = retval.get('info', {}).get('teamModifiedIds')
-        if teamModifiedIds:
-            # Close all connections for the team
-            for teamModifiedId in teamModifiedIds:
-                cls.lockConnections(path, teamModifiedId, 'Team member responded. Reload page', reload=True)
-
+        cls.queueResponse(path, fromUser, slideId, questionAttrs, [response, explain])
         return ''
             
     @classmethod
@@ -4754,9 +5041,23 @@ class WSHandler(tornado.websocket.WebSocketHandler, UserIdMixin):
 
         ##if Options['debug'] and not evName.startswith('Timer.clockTick'):
         ##    print >> sys.stderr, 'sdserver.sendEvent: event', path, fromUser, fromRole, toNormal, toAdmin, toUsers, evType, evName
-        pathConnections = cls._connections[path]
-        for connId, connections in pathConnections.items():
-            adminSender = fromRole == sdproxy.ADMIN_ROLE
+        pathConnections = cls._connections.get(path, {})
+        adminSender = fromRole == sdproxy.ADMIN_ROLE
+        if toUsers:
+            # Only specified users (and admin users) can receive event
+            connIds = toUsers.union(cls._adminIds.get(path, ()))
+        elif not adminSender and not evName.startswith('Discuss.activeNotify.'):
+            # Only admin users can receive event
+            connIds = cls._adminIds.get(path, ())
+        else:
+            connIds = pathConnections.keys()
+
+        frame = None
+        recipients = []
+        for connId in connIds:
+            connections = pathConnections.get(connId)
+            if not connections:
+                continue
             adminDestination = connections.sd_role == sdproxy.ADMIN_ROLE
             if fromUser and connId == fromUser:
                 # Do not send to self
@@ -4776,24 +5077,41 @@ class WSHandler(tornado.websocket.WebSocketHandler, UserIdMixin):
                 if not adminDestination and not evName.startswith('Discuss.activeNotify.'):
                     continue
 
-            # Event [source, role, name, arg1, arg2, ...]
-            sendList = [fromUser, fromRole, evName] + evArgs
-            for conn in connections:
+            if frame is None:
+                # Message: [0, 'event', [source, role, name, [arg1, arg2, ...]]] (encoded once, and shared by all recipients)
+                frame = json.dumps([0, 'event', [fromUser, fromRole, evName, evArgs]], default=sliauth.json_default)
                 if evType > 0:
                     # If evType > 0, only the latest occurrence of an event type with same evType name+arguments is buffered
-                    buffered = False
-                    for j in range(len(conn.eventBuffer)):
-                        if conn.eventBuffer[j][2:evType+2] == sendList[2:evType+2]:
-                            conn.eventBuffer[j] = sendList
-                            buffered = True
-                            break
-                    if not buffered:
-                        conn.eventBuffer.append(sendList)
+                    # (overwriting an OrderedDict entry retains its position in the buffer)
+                    bufferKey = json.dumps([evName]+evArgs[:evType-1], default=sliauth.json_default)
                 else:
-                    # evType <= 0
-                    conn.eventBuffer.append(sendList)
-                    if evType == -1:
-                        conn.flushEventBuffer()
+                    cls._eventCount += 1
+                    bufferKey = cls._eventCount
+
+            for conn in connections:
+                conn.eventBuffer[bufferKey] = frame
+                recipients.append(conn)
+
+        if evType == -1:
+            for conn in recipients:
+                conn.flushEventBuffer()
+        elif recipients:
+            cls.scheduleFlush(recipients)
+
+    @classmethod
+    def scheduleFlush(cls, conns):
+        # Buffered events for all connections are flushed together, within EVENT_BUFFER_SEC
+        cls._pendingFlush.update(conns)
+        if not cls._flushTimeout:
+            cls._flushTimeout = IOLoop.current().call_later(EVENT_BUFFER_SEC, cls.flushPendingEvents)
+
+    @classmethod
+    def flushPendingEvents(cls):
+        cls._flushTimeout = None
+        pending = cls._pendingFlush
+        cls._pendingFlush = set()
+        for conn in pending:
+            conn.flushEventBuffer()
 
     @classmethod
     def teamNotify(cls, sessionName, teamIds, teamName):
@@ -4812,6 +5130,12 @@ class WSHandler(tornado.websocket.WebSocketHandler, UserIdMixin):
 
         cls.sendEvent(sessionPath[1:], userId, sdproxy.ADMIN_ROLE, True, True, [teamIds, -1, 'Discuss.postNotify', [discussNum, closed, postMsg, userName, teamName, discussPost]])
 
+    @classmethod
+    def tallyNotify(cls, sessionName, qnumber, tally):
+        # Send updated response tally to admin users (buffered; only the latest tally for each question is sent)
+        sessionPath = getSessionPath(sessionName, site_prefix=True)
+        cls.sendEvent(sessionPath[1:], '', sdproxy.ADMIN_ROLE, False, True, ['', 2, 'ResponseTally', [qnumber, tally]])
+
     def open(self, path=''):
         try:
             self.clientVersion = self.get_argument('version','')
@@ -4823,27 +5147,22 @@ class WSHandler(tornado.websocket.WebSocketHandler, UserIdMixin):
             self.sessionName = self.get_path_base(path) or ''
             self.sessionVersion = self.getSessionVersion(self.sessionName)
             self.userRole = self.get_id_from_cookie(role=True, for_site=Options['site_name'])
-            joined = False
+            joinedUser = None
             activeUsers = None
             if self.sessionName:
-                activeUserIds = []
-                for connId, connections in WSHandler.get_connections(self.sessionName).items():
-                    if connections.sd_role != sdproxy.ADMIN_ROLE:
-                        activeUserIds.append(connId)
-                if self.userId not in activeUserIds and self.userRole != sdproxy.ADMIN_ROLE:
-                    joined = True
-                    activeUserIds.append(self.userId)
-                if joined or self.userRole == sdproxy.ADMIN_ROLE:
-                    nameMap = sdproxy.getDisplayNames(includeNonRoster=True)
-                    shortMap = sdproxy.makeShortNames(nameMap, first=True) if nameMap else {}
-                    activeUsers = [ [nameMap.get(x,x), x, shortMap.get(x,x)] for x in activeUserIds]
+                sessionConnections = WSHandler.get_connections(self.sessionName)
+                if self.userRole == sdproxy.ADMIN_ROLE:
+                    # Full list of active users for admin
+                    nameMap, shortMap = sdproxy.getDisplayNameMaps(includeNonRoster=True)
+                    activeUsers = [ [nameMap.get(x,x), x, shortMap.get(x,x)] for x, connections in sessionConnections.items() if connections.sd_role != sdproxy.ADMIN_ROLE]
                     activeUsers.sort()
+                elif self.userId not in sessionConnections:
+                    # Only joining user is sent to admins
+                    nameMap, shortMap = sdproxy.getDisplayNameMaps(includeNonRoster=True)
+                    joinedUser = [nameMap.get(self.userId,self.userId), self.userId, shortMap.get(self.userId,self.userId)]
 
             # Add connection
-            connectionList = self._connections[self.pathUser[0]][self.pathUser[1]]
-            if not connectionList:
-                connectionList.sd_role = self.userRole
-            connectionList.append(self)
+            WSHandler.addConnection(self)
             self.pluginInstances = {}
             self.awaitBinary = None
 
@@ -4852,9 +5171,7 @@ class WSHandler(tornado.websocket.WebSocketHandler, UserIdMixin):
             if not self.userId:
                 self.close()
 
-            self.eventBuffer = []
-            self.eventFlusher = PeriodicCallback(self.flushEventBuffer, EVENT_BUFFER_SEC*1000)
-            self.eventFlusher.start()
+            self.eventBuffer = OrderedDict()   # buffer key -> encoded event message
 
             interactSessionName, interactSlideId, _ = self.getInteractiveSession()
             if not self.sessionName or self.sessionName != interactSessionName:
@@ -4869,8 +5186,9 @@ class WSHandler(tornado.websocket.WebSocketHandler, UserIdMixin):
             sessionParams['prevSession'] = nextSession(self.sessionName, back=True)
             self.write_message_safe(json.dumps([0, 'session_setup', [self.sessionVersion, sessionParams] ]))
 
-            if joined and self.userRole != sdproxy.ADMIN_ROLE:
-                WSHandler.sendEvent(self.pathUser[0], self.pathUser[1], sdproxy.ADMIN_ROLE, False, True, ['', -1, 'ActiveUsers', [self.pathUser[1], activeUsers]])
+            if joinedUser:
+                # ActiveUsers event args: userId, full list of active users (obsolete), joining user info (or None if leaving)
+                WSHandler.sendEvent(self.pathUser[0], self.pathUser[1], sdproxy.ADMIN_ROLE, False, True, ['', -1, 'ActiveUsers', [self.pathUser[1], None, joinedUser]])
         except Exception, excp:
             if Options['debug']:
                 import traceback
@@ -4880,14 +5198,8 @@ class WSHandler(tornado.websocket.WebSocketHandler, UserIdMixin):
         ##if Options['debug']:
         ##    print >> sys.stderr, "DEBUG: WSon_close", getattr(self, 'pathUser', 'NOT OPENED')
         try:
-            if self.eventFlusher:
-                self.eventFlusher.stop()
-                self.eventFlusher = None
-            self._connections[self.pathUser[0]][self.pathUser[1]].remove(self)
-            if not self._connections[self.pathUser[0]][self.pathUser[1]]:
-                del self._connections[self.pathUser[0]][self.pathUser[1]]
-            if not self._connections[self.pathUser[0]]:
-                del self._connections[self.pathUser[0]]
+            WSHandler._pendingFlush.discard(self)
+            WSHandler.removeConnection(self)
 
             if self._interactiveSession[0] is self:
                 # Disable interactivity associated with this connection
@@ -4896,7 +5208,7 @@ class WSHandler(tornado.websocket.WebSocketHandler, UserIdMixin):
             if self.sessionName:
                 if self.pathUser[1] not in WSHandler.get_connections(self.sessionName):
                     # Notify that user has disconnected
-                    WSHandler.sendEvent(self.pathUser[0], self.pathUser[1], sdproxy.ADMIN_ROLE, False, True, ['', -1, 'ActiveUsers', [self.pathUser[1], None]])
+                    WSHandler.sendEvent(self.pathUser[0], self.pathUser[1], sdproxy.ADMIN_ROLE, False, True, ['', -1, 'ActiveUsers', [self.pathUser[1], None, None]])
 
         except Exception, err:
             pass
@@ -4910,11 +5222,7 @@ class WSHandler(tornado.websocket.WebSocketHandler, UserIdMixin):
 
     def flushEventBuffer(self):
         while self.eventBuffer:
-            # sendEvent: source, role, evName, evArg1, ...
-            sendList = self.eventBuffer.pop(0)
-            # Message: source, role, evName, [args]
-            msg = [0, 'event', [sendList[0], sendList[1], sendList[2], sendList[3:]] ]
-            self.write_message_safe(json.dumps(msg, default=sliauth.json_default))
+            self.write_message_safe(self.eventBuffer.popitem(last=False)[1])
 
     def _close_on_timeout(self):
         if self.ws_connection:
@@ -5921,6 +6229,7 @@ def createApplication():
                       r"/(_manage/[-\w.]+)",
                       r"/(_modules)",
                       r"/(_prefill/[-\w.]+)",
+                      r"/(_qtally/[-\w.;]+)",
                       r"/(_preview/[-\w./]+)",
                       r"/(_refresh/[-\w.]+)",
                       r"/(_reindex/[-\w.]+)",
@@ -6611,6 +6920,7 @@ def shutdown_server():
     if Global.http_server:
         Global.http_server.stop()
         Global.http_server = None
+    CompileWorker.shutdown()
     if Global.server_socket:
         try:
             Global.server_socket.close()
@@ -7165,7 +7475,8 @@ def site_server_setup():
         update_session_settings(Global.site_settings)
 
     sdproxy.initProxy(gradebookActive=('gradebook' in SiteProps.get_site_menu()),
-                      accessCodeCallback=checkAccessCode, teamSetupCallback=WSHandler.teamNotify, discussPostCallback=WSHandler.postNotify)
+                      accessCodeCallback=checkAccessCode, teamSetupCallback=WSHandler.teamNotify, discussPostCallback=WSHandler.postNotify,
+                      responseTallyCallback=WSHandler.tallyNotify)
 
     bak_dir = getBakDir(Options['site_name'])
     if bak_dir:
@@ -7249,6 +7560,12 @@ def main():
     define("auth_type", default=Options["auth_type"], help="none|adminonly|token|@example.com|google|twitter,key,secret,,...")
     define("auth_users", default='', help="filename.txt or [userid]=username[@domain][:role[:site1,site2...];...")
     define("backup", default="", help="=Backup_dir,HH:MM,seven_day,weekly,monthly,exclude_images,no_backup,renew_ssl; End Backup_dir with hyphen to automatically append timestamp")
+    define("build_cache_dir", default=Options["build_cache_dir"], help="Directory for caching rendered session files (re-used if source and configuration are unchanged)")
+    define("cache_max_mb", default=0, help="Memory budget (MB) for cached sheets (least recently used clean sheets are evicted)")
+    define("cache_max_rows", default=0, help="Row budget for cached sheets (total rows; least recently used clean sheets are evicted)")
+    define("compact_cache", default=False, help="Store cached sheets in compact form (less memory, faster copies)")
+    define("compact_updates", default=False, help="Send cache updates to Google Sheets compressed, with only modified cells")
+    define("compile_procs", default=Options["compile_procs"], help="Number of worker processes for compiling sessions (0 to compile in server process)")
     define("config_digest", default="", help="Config file digest (used for secondary server only)")
     define("debug", default=False, help="Debug mode")
     define("dry_proxy_url", default="", help="Dry proxy server URL (used for secondary server only)")
@@ -7261,6 +7578,7 @@ def main():
     define("host", default=Options['host'], help="Server hostname or IP address, specify '' for all (default: localhost)")
     define("import_params", default=Options['import_params'], help="KEY;KEYCOL;SKIP_KEY1,... parameters for importing answers")
     define("insecure_cookie", default=False, help="Insecure cookies (for direct PDF printing)")
+    define("journal_dir", default="", help="Directory for write-ahead journal of cached sheet modifications (restored on restart instead of downloading)")
     define("lock_proxy_url", default="", help="Proxy URL to lock sheet(s), e.g., http://example.com")
     define("min_wait_sec", default=0, help="Minimum time (sec) between Google Sheet updates")
     define("missing_choice", default=Options['missing_choice'], help="Missing choice value (default: *)")
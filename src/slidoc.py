@@ -20,8 +20,10 @@ from __future__ import print_function
 import argparse
 import BaseHTTPServer
 import base64
+import cPickle
 import datetime
 import io
+import multiprocessing
 import os
 import random
 import re
@@ -681,11 +683,14 @@ class MarkdownWithMath(mistune.Markdown):
 
     ## Temporary fix for Unicode errors
     def output(self, text, rules=None):
-        self.tokens = self.block(text, rules)
-        self.tokens.reverse()
+        tokens = self.block(text, rules)
 
         self.inline.setup(self.block.def_links, self.block.def_footnotes)
 
+        return self.output_tokens(tokens)
+
+    def output_tokens(self, tokens):
+        self.tokens = tokens[::-1]
         out = self.renderer.placeholder()
         while self.pop():
             tok = self.tok()
@@ -755,6 +760,12 @@ class MarkdownWithSlidoc(MarkdownWithMath):
     def __init__(self, renderer, **kwargs):
         super(MarkdownWithSlidoc, self).__init__(renderer, **kwargs)
         self.incremental_block_quote = 'incremental_slides' in self.renderer.options['config'].features and 'no_incremental_list' not in self.renderer.options['config'].features
+        self.slide_cache = None   # SlideCache, for re-rendering only modified slides
+
+    def output(self, text, rules=None):
+        if self.slide_cache is None:
+            return super(MarkdownWithSlidoc, self).output(text, rules)
+        return self.slide_cache.output(self, text, rules)
 
     def output_block_quote(self):
         if self.incremental_block_quote:
@@ -936,6 +947,8 @@ class SlidocRenderer(MathRenderer):
         self.sheet_attributes['resubmitAnswers'] = self.options['config'].pace <= BASIC_PACE and self.options['config'].show_correct in ('after_submitting', 'after_grading')
         self.slide_number = 0
         self.slide_images = []
+        self.image_files = []                  # Local image files read (dependencies for build cache)
+        self.image_copies = []                 # Image files copied to dest_dir
 
         self._new_slide()
         self.first_id = self.get_slide_id()
@@ -1305,8 +1318,9 @@ class SlidocRenderer(MathRenderer):
                 if not new_src:
                     raise Exception('NOIMAGE:Image file %s not found in %s%s' % (src, self.options['filedir'], tem_msg))
 
+                filepath = self.options['filedir']+'/'+new_src if self.options['filedir'] else new_src
+                self.image_files.append(filepath)
                 if copy_image:
-                    filepath = self.options['filedir']+'/'+new_src if self.options['filedir'] else new_src
                     img_content = md2md.read_file(filepath)
 
             if self.content_zip:
@@ -1332,6 +1346,7 @@ class SlidocRenderer(MathRenderer):
 
                 if not (from_zip and self.options['config'].preview_mode):
                     # Do not copy image from zip file if in preview mode
+                    self.image_copies.append(out_path)
                     if not os.path.exists(out_dir):
                         os.mkdir(out_dir)
 
@@ -2886,14 +2901,158 @@ HTML_COMMENT_RE =  re.compile(r'^\s*<!--.*-->\s*\n?$')
 SLIDE_BREAK_RE  =  re.compile(r'^ {0,3}(----* *|Slide:|#[^#].*|##[^#].*)\n?$')
 HRULE_BREAK_RE  =  re.compile(r'(\S *\n)( {0,3}----* *(\n|$))')
     
+class SlideCache(object):
+    # HTML fragments and rendering state for each slide (split by explicit slide breaks) of recently rendered files,
+    # so that re-rendering a modified file (for preview) only re-renders the modified slides,
+    # and any following slides until the rendering state (slide numbering, references, questions etc.) is unaffected
+    max_files = 4
+    files = OrderedDict()   # filename -> SlideCache (least recently used first)
+    state_exclude = set(['options', 'images_zipfile', 'images_map', 'content_zip', 'content_zip_bytes'])
+
+    @classmethod
+    def lookup(cls, filename, renderer):
+        options = renderer.options.copy()
+        images_zipdata = options.pop('images_zipdata', None)
+        context = sliauth.digest_hex(json.dumps([options, sliauth.digest_hex(images_zipdata, truncate=None) if images_zipdata else ''],
+                                                sort_keys=True, default=build_key_default), truncate=None)
+        slide_cache = cls.files.pop(filename, None)
+        if not slide_cache or slide_cache.context != context or not slide_cache.images_valid():
+            slide_cache = cls(context)
+        cls.files[filename] = slide_cache
+        while len(cls.files) > cls.max_files:
+            cls.files.popitem(last=False)
+        return slide_cache
+
+    @staticmethod
+    def split_slides(tokens):
+        # Split block tokens at top-level hrule tokens
+        slides = [[]]
+        depth = 0
+        for token in tokens:
+            if token['type'] == 'hrule' and not depth:
+                slides.append([])
+            slides[-1].append(token)
+            if token['type'].endswith('_start'):
+                depth += 1
+            elif token['type'].endswith('_end'):
+                depth -= 1
+        return slides
+
+    def __init__(self, context):
+        self.context = context
+        self.def_links = None
+        self.slides = []          # [tokens, html, messages, pickled state before rendering slide]
+        self.final_state = None
+        self.image_files = {}
+        self.image_copies = []
+
+    def images_valid(self):
+        return all(file_stamp(path) == stamp for path, stamp in self.image_files.items()) and all(os.path.exists(path) for path in self.image_copies)
+
+    def save_state(self, renderer):
+        # Returns pickled rendering state, after replacing the state with its unpickled copy
+        # (so that subsequent rendering is identical, including dict ordering, whether the state is re-used or not)
+        pickled_state = cPickle.dumps((dict((name, value) for name, value in renderer.__dict__.items() if name not in self.state_exclude),
+                                       dict((name, getattr(Global, name)) for name in Render_globals+['chapter_ref_counter'])),
+                                      cPickle.HIGHEST_PROTOCOL)
+        self.set_state(renderer, pickled_state)
+        return pickled_state
+
+    def set_state(self, renderer, pickled_state):
+        renderer_state, global_state = cPickle.loads(pickled_state)
+        for name in renderer.__dict__.keys():
+            if name not in self.state_exclude and name not in renderer_state:
+                delattr(renderer, name)
+        renderer.__dict__.update(renderer_state)
+        for name, value in global_state.items():
+            # Update in place
+            getattr(Global, name).clear()
+            getattr(Global, name).update(value)
+
+    def output(self, parser, text, rules=None):
+        global message
+        tokens = parser.block(text, rules)
+        parser.inline.setup(parser.block.def_links, parser.block.def_footnotes)
+        if parser.block.def_footnotes:
+            # Footnotes are numbered across slides
+            self.files.pop(parser.renderer.options['filename'], None)
+            return parser.output_tokens(tokens)
+
+        renderer = parser.renderer
+        slides = self.split_slides(tokens)
+        prev_slides = self.slides if self.final_state and parser.block.def_links == self.def_links else []
+        prev_count, count = len(prev_slides), len(slides)
+
+        # Unmodified leading and trailing slides
+        nlead = 0
+        while nlead < min(prev_count, count) and slides[nlead] == prev_slides[nlead][0]:
+            nlead += 1
+        ntrail = 0
+        while ntrail < min(prev_count, count)-nlead and slides[count-1-ntrail] == prev_slides[prev_count-1-ntrail][0]:
+            ntrail += 1
+
+        pickled_state = self.save_state(renderer)
+        if nlead and pickled_state != prev_slides[0][3]:
+            # Initial state differs
+            nlead = 0
+
+        prev_message = message
+        def slide_message(*args):
+            new_slides[-1][2].append(args)
+            prev_message(*args)
+
+        def reuse_slides(reused):
+            for slide in reused:
+                for args in slide[2]:
+                    message(*args)
+            new_slides.extend(reused)
+
+        new_slides = []
+        try:
+            if nlead:
+                reuse_slides(prev_slides[:nlead])
+                pickled_state = prev_slides[nlead][3] if nlead < prev_count else self.final_state
+                self.set_state(renderer, pickled_state)
+
+            for j in range(nlead, count):
+                if j >= count-ntrail:
+                    if pickled_state == prev_slides[j+prev_count-count][3]:
+                        # Rendering state has converged; re-use remaining slides
+                        reuse_slides(prev_slides[j+prev_count-count:])
+                        pickled_state = self.final_state
+                        self.set_state(renderer, pickled_state)
+                        break
+
+                new_slides.append([slides[j], None, [], pickled_state])
+                message = slide_message
+                try:
+                    new_slides[-1][1] = parser.output_tokens(slides[j])
+                finally:
+                    message = prev_message
+                pickled_state = self.save_state(renderer)
+        except Exception:
+            self.files.pop(renderer.options['filename'], None)
+            raise
+
+        self.def_links = parser.block.def_links.copy()
+        self.slides = new_slides
+        self.final_state = pickled_state
+        self.image_files = dict((path, file_stamp(path)) for path in renderer.image_files)
+        self.image_copies = renderer.image_copies[:]
+        return renderer.placeholder() + ''.join(slide[1] for slide in new_slides)
+
+
 def md2html(source, filename, config, filenumber=1, filedir='', plugin_defs={}, prev_file='', next_file='', index_id='', qindex_id='',
-            zip_content=False, images_zipdata=None):
-    """Convert a markdown string to HTML using mistune, returning (first_header, file_toc, renderer, md_params, html, zipped_content_images)"""
+            zip_content=False, images_zipdata=None, slide_cache=False):
+    """Convert a markdown string to HTML using mistune, returning (first_header, file_toc, renderer, md_params, html, zipped_content_images)
+    If slide_cache, re-use rendered slides from previous conversion of file (if unmodified)"""
     Global.chapter_ref_counter = defaultdict(int)
 
     renderer = SlidocRenderer(escape=False, filename=filename, config=config, filenumber=filenumber, filedir=filedir, plugin_defs=plugin_defs,
                               images_zipdata=images_zipdata, zip_content=zip_content)
     md_parser_obj = MarkdownWithSlidoc(renderer=renderer)
+    if slide_cache and not zip_content:
+        md_parser_obj.slide_cache = SlideCache.lookup(filename, renderer)
     content_html = md_parser_obj.render(source, index_id=index_id, qindex_id=qindex_id)
 
     if renderer.retry_questions and config.pace < QUESTION_PACE :
@@ -3588,6 +3747,369 @@ def message(*args):
     print(*args, file=sys.stderr)
 
 
+def merge_file_config(fhandle, fname, config, default_args_dict, file_plugin_defs, gd_hmac_key, nfiles):
+    # Merge file header options with command line config, returning (file_config, file_plugin_defs)
+    file_config = parse_merge_args(sliauth.read_header_opts(fhandle)[0], fname, Conf_parser, vars(config), default_args_dict=default_args_dict, verbose=config.verbose)
+    if config.preview_port:
+        if file_config.gsheet_url:
+            file_config.gsheet_url = ''
+
+    if file_config.plugins:
+        # Plugins with same name will override earlier plugins
+        plugin_paths = file_config.plugins.split(',')
+        for plugin_path in plugin_paths:
+            plugin_name, file_plugin_defs[plugin_name] = read_plugin(plugin_path.strip())
+
+    file_config.features = file_config.features or set()
+    if 'grade_response' in file_config.features and gd_hmac_key is None:
+        # No grading without google sheet
+        file_config.features.remove('grade_response')
+    if nfiles == 1:
+        file_config.strip.add('chapters')
+
+    ##if 'slides_only' in file_config.features and config.printable:
+    ##    file_config.features.remove('slides_only')
+    ##    message('slides_only feature suppressed by --printable option')
+
+    if 'keep_extras' in file_config.features and config.gsheet_url:
+        abort('PACE-ERROR: --features=keep_extras incompatible with --gsheet_url')
+
+    if file_config.retakes and file_config.timed:
+        abort('PACE-ERROR: --retakes=... incompatible with --timed=...')
+
+    if file_config.show_correct and file_config.show_correct not in ('after_answering', 'after_submitting', 'after_grading', 'always'):
+        abort('SHOW-ERROR: Must have --show_correct=after_answering OR after_submitting OR after_grading (found %s)' % file_config.show_correct)
+
+    if not file_config.show_correct:
+        if file_config.pace >= QUESTION_PACE:
+            file_config.show_correct = 'after_answering'
+        elif file_config.pace:
+            if gd_hmac_key is None:
+                file_config.show_correct = 'after_answering'
+            elif 'assessment' in file_config.features:
+                file_config.show_correct = 'after_grading'
+            else:
+                file_config.show_correct = 'after_submitting'
+
+    return file_config, file_plugin_defs
+
+def render_file(md_text, fname, fnumber, filepath, file_config, plugin_defs, slide_mods_args, site_name='', images_zipdata=None,
+                prev_file='', next_file='', index_id='', qindex_id='', zip_content=False, slide_cache=False):
+    # Preprocess and render single file, returning (md_text, md_text_modified, fheader, file_toc, renderer, md_params, md_html, zipped_md, math_present)
+    filedir = os.path.dirname(os.path.realpath(filepath))
+
+    # Preprocess line breaks, tabs etc.
+    md_text = preprocess(md_text)
+    loc = md2md.find_non_ascii(md_text)
+    if loc:
+        message('ASCII-WARNING: Possible non-ascii character at position %d could create problems: %s' % (loc, repr(md_text[max(0,loc-10):loc+15])) )
+
+    # Strip annotations (may also break slide editing)
+    md_text = re.sub(r"(^|\n) {0,3}[Aa]nnotation:(.*?)(\n|$)", '', md_text)
+
+    files_url = '/_files'
+    if site_name:
+        files_url = '/' + site_name + files_url
+    slide_parser = md2md.Parser(slide_mods_args, images_zipdata=images_zipdata, files_url=files_url)
+    md_text_modified, _, new_renumber = slide_parser.parse(md_text, filepath)
+
+    if file_config.hide and 'hidden' in file_config.strip:
+        md_text_modified = re.sub(r'(^|\n *\n--- *\n( *\n)+) {0,3}#{2,3}[^#][^\n]*'+file_config.hide+r'.*?(\n *\n--- *\n|$)', r'\1', md_text_modified, flags=re.DOTALL)
+
+    # zipped_md containing will only be created if any images are present (and will also include the original (preprocessed) md_text as content.md)
+    fheader, file_toc, renderer, md_params, md_html, zipped_md = md2html(md_text, filename=fname, config=file_config, filenumber=fnumber,
+                                                    filedir=filedir, plugin_defs=plugin_defs, prev_file=prev_file, next_file=next_file,
+                                                    index_id=index_id, qindex_id=qindex_id, zip_content=zip_content,
+                                                    images_zipdata=images_zipdata, slide_cache=slide_cache)
+    math_present = bool(renderer.render_mathjax or MathInlineGrammar.any_block_math.search(md_text) or MathInlineGrammar.any_inline_math.search(md_text))
+    return md_text, md_text_modified, fheader, file_toc, renderer, md_params, md_html, zipped_md, math_present
+
+
+class RenderedFile(object):
+    # Picklable copy of renderer attributes used after rendering (for files rendered in worker processes)
+    attrs = ('all_functions', 'all_params', 'banners', 'concept_warnings', 'cum_gweights', 'cum_weights', 'grade_fields',
+             'load_python', 'max_fields', 'plugin_defs', 'plugin_embeds', 'plugin_loads', 'plugin_names', 'plugin_tops',
+             'qconcepts', 'question_concepts', 'questions', 'render_markdown', 'render_mathjax', 'sheet_attributes', 'slide_number')
+
+    def __init__(self, renderer):
+        for name in self.attrs:
+            setattr(self, name, getattr(renderer, name))
+        self.options = {'filename': renderer.options['filename'], 'filenumber': renderer.options['filenumber']}
+        self.cur_header = ''
+        self.alt_header = ''
+
+    abort = SlidocRenderer.abort.__func__
+    message = SlidocRenderer.message.__func__
+    check_team_gen = SlidocRenderer.check_team_gen.__func__
+    get_chapter_id = SlidocRenderer.get_chapter_id.__func__
+
+
+# Global state contributed by each rendered file (merged in file order)
+Render_globals = ['primary_tags', 'sec_tags', 'primary_qtags', 'sec_qtags', 'all_tags', 'questions', 'concept_questions',
+                  'ref_tracker', 'ref_counter', 'dup_ref_tracker']
+
+Prerender_jobs = {}
+
+FORWARD_LINK_RE = re.compile(r'''\b(slidoc-ref-[^\s"']+)-forward-link\b''')
+
+def render_isolated(md_text, fname, fnumber, filepath, file_config, plugin_defs, render_args):
+    # Render file with fresh global state, returning picklable result (for parallel build and build cache)
+    global Global, message
+    prev_global, prev_message = Global, message
+    Global = GlobalState()
+    messages = []
+    def append_message(*args):
+        messages.append(''.join(str(x) for x in args))
+    message = append_message
+
+    try:
+        rendered = list(render_file(md_text, fname, fnumber, filepath, file_config, plugin_defs, **render_args))
+        renderer = rendered[4]
+        rendered[4] = RenderedFile(renderer)
+        return {'rendered': rendered, 'messages': messages, 'track_references': 'track_references' in file_config.features,
+                'globals': dict((name, getattr(Global, name)) for name in Render_globals),
+                'image_files': dict((path, file_stamp(path)) for path in renderer.image_files), 'image_copies': renderer.image_copies}
+    except (Exception, SystemExit), excp:
+        return {'error': str(excp)}
+    finally:
+        Global, message = prev_global, prev_message
+
+def render_cached(build_cache, md_text, fname, fnumber, filepath, file_config, plugin_defs, render_args):
+    # Return rendered result from build cache, or render with fresh global state (updating cache)
+    cache_key = build_cache.file_key(md_text, file_config, plugin_defs, render_args)
+    result = build_cache.get(fname, cache_key)
+    if not result:
+        result = render_isolated(md_text, fname, fnumber, filepath, file_config, plugin_defs, render_args)
+        if 'error' not in result:
+            build_cache.put(fname, cache_key, result)
+    return result
+
+def prerender_file(fnumber):
+    # Merge config and render file in worker process, with fresh global state (parallel build)
+    global Global
+    Global = GlobalState()
+    job = Prerender_jobs[fnumber]
+    try:
+        file_config, file_plugin_defs = merge_file_config(io.BytesIO(job['md_text']), job['fname'], job['config'], job['default_args_dict'],
+                                                          job['plugin_defs'].copy(), job['gd_hmac_key'], job['nfiles'])
+    except (Exception, SystemExit), excp:
+        return {'error': str(excp)}
+
+    if job['build_cache']:
+        return render_cached(job['build_cache'], job['md_text'], job['fname'], fnumber, job['filepath'], file_config, file_plugin_defs, job['render_args'])
+    return render_isolated(job['md_text'], job['fname'], fnumber, job['filepath'], file_config, file_plugin_defs, job['render_args'])
+
+def prerender_files(jobs, nprocs):
+    # Render files concurrently in worker processes, returning dict of results (files with errors are re-rendered serially)
+    global Prerender_jobs
+    Prerender_jobs = jobs     # Inherited by forked worker processes
+    pool = multiprocessing.Pool(processes=min(nprocs, len(jobs)))
+    try:
+        fnumbers = sorted(jobs.keys())
+        return dict(zip(fnumbers, pool.map(prerender_file, fnumbers)))
+    finally:
+        pool.close()
+        pool.join()
+        Prerender_jobs = {}
+
+def merge_prerendered(result):
+    # Merge global state contributed by file rendered in worker process, returning rendered output
+    # Returns None, without merging, if rendering would have depended upon state from preceding files (requiring re-rendering)
+    if 'error' in result:
+        return None
+    contrib = result['globals']
+    renderer = result['rendered'][4]
+    md_html = result['rendered'][6]
+    if any(Global.ref_counter.get(key) for key in contrib['ref_counter']):
+        # Reference numbering continues from preceding files
+        return None
+    dup_refs = [ref_id for ref_id in contrib['ref_tracker'] if ref_id in Global.ref_tracker]
+    if dup_refs and (result['track_references'] or any(Global.ref_tracker[ref_id][0] != '??' or Global.ref_tracker[ref_id][2] or
+                                                       'id="%s" class="slidoc-referable' % ref_id in md_html for ref_id in dup_refs)):
+        # Duplicate references, other than unnumbered header references, are renamed or reported
+        return None
+    if any(ref_id in Global.ref_tracker for ref_id in FORWARD_LINK_RE.findall(md_html)):
+        # Links to references in preceding files
+        return None
+    if renderer.concept_warnings and any(tag in Global.primary_tags or tag in Global.sec_tags for tag in set(renderer.qconcepts[0]) | set(renderer.qconcepts[1])):
+        # Concepts covered in preceding files
+        return None
+
+    for name in ('primary_tags', 'sec_tags', 'primary_qtags', 'sec_qtags'):
+        for tag, file_refs in contrib[name].items():
+            getattr(Global, name)[tag].update(file_refs)
+    for tag, tag_str in contrib['all_tags'].items():
+        # Proper case of tag overrides lower case
+        if tag not in Global.all_tags or tag_str != tag:
+            Global.all_tags[tag] = tag_str
+    Global.questions.update(contrib['questions'])
+    for q_concept_id, q_list in contrib['concept_questions'].items():
+        Global.concept_questions[q_concept_id] += q_list
+    for ref_id, ref_value in contrib['ref_tracker'].items():
+        if ref_id in Global.ref_tracker:
+            # Duplicate header reference (first occurrence is retained)
+            Global.dup_ref_tracker.add(ref_id)
+        else:
+            Global.ref_tracker[ref_id] = ref_value
+    Global.ref_counter.update(contrib['ref_counter'])
+    Global.dup_ref_tracker.update(contrib['dup_ref_tracker'])
+
+    for msg in result['messages']:
+        message(msg)
+    return result['rendered']
+
+def file_stamp(path):
+    # Return (modification time, size) of file, or None if not found
+    try:
+        stat = os.stat(path)
+        return (stat.st_mtime, stat.st_size)
+    except OSError:
+        return None
+
+Template_names = ('doc_include.css', 'wcloud.css', 'doc_custom.css',
+                  'doc_include.js', 'wcloud.js', 'doc_google.js', 'md5.js', 'sha256.js', 'doc_test.js',
+                  'doc_include.html', 'doc_template.html', 'reveal_template.html')
+
+File_cache = {}   # path -> (file_stamp, content or parsed content)
+
+def read_cached(path, parse=None):
+    # Return content of template/plugin file (parsed, if parse function is specified), read once per process
+    # (and re-read only if file modification time or size changes)
+    stamp = file_stamp(path)
+    entry = File_cache.get(path)
+    if not entry or entry[0] != stamp:
+        content = md2md.read_file(path)
+        entry = (stamp, parse(content) if parse else content)
+        File_cache[path] = entry
+    return entry[1]
+
+def read_plugin(path):
+    # Return (plugin_name, plugin_def) for plugin file
+    plugin_name, plugin_def = read_cached(path, parse_plugin)
+    return plugin_name, plugin_def.copy()
+
+Highlight_css = None
+
+def get_highlight_css():
+    # Return style definitions for code highlighting (generated once per process)
+    global Highlight_css
+    if Highlight_css is None:
+        Highlight_css = ('\n<style>\n' + HtmlFormatter().get_style_defs('.highlight') + '\n</style>\n') if HtmlFormatter else ''
+    return Highlight_css
+
+Build_stamp = ''
+
+def get_build_stamp():
+    # Return digest of slidoc version, rendering code, templates and plugins (computed once per process)
+    global Build_stamp
+    if not Build_stamp:
+        paths = [scriptdir+'/'+name for name in ('slidoc.py', 'md2md.py', 'sliauth.py')]
+        for subdir in ('templates', 'plugins'):
+            paths += [scriptdir+'/'+subdir+'/'+name for name in sorted(os.listdir(scriptdir+'/'+subdir)) if not name.startswith('.')]
+        Build_stamp = sliauth.digest_hex(sliauth.get_version() + mistune.__version__ + ''.join(md2md.read_file(path) for path in paths), truncate=None)
+    return Build_stamp
+
+def build_key_default(obj):
+    if isinstance(obj, set):
+        return sorted(obj)
+    if hasattr(obj, '__dict__'):
+        return vars(obj)
+    return repr(obj)
+
+class BuildCache(object):
+    # Persistent cache of rendered files (results of render_isolated), keyed by digest of source text, effective file config,
+    # plugin definitions, render arguments and build stamp. Also tracks the config used to create each output file (for make mode)
+    max_entries = 3   # Most recently used entries retained per file
+    make_file = 'make_stamps.json'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.make_stamps = {}
+        self.make_modified = False
+        make_path = os.path.join(cache_dir, self.make_file)
+        if os.path.exists(make_path):
+            try:
+                with open(make_path) as f:
+                    self.make_stamps = json.load(f)
+            except Exception, excp:
+                message('CACHE-WARNING: Error in reading %s: %s' % (make_path, excp))
+
+    def config_key(self, config_dict, default_args_dict):
+        # Key for configuration used to create output files (excluding options not affecting output)
+        config_vars = dict((name, value) for name, value in config_dict.items() if name not in ('build_cache', 'make', 'parallel', 'verbose'))
+        return sliauth.digest_hex(json.dumps([get_build_stamp(), config_vars, default_args_dict], sort_keys=True, default=build_key_default))
+
+    def file_key(self, md_text, file_config, plugin_defs, render_args):
+        render_vars = render_args.copy()
+        images_zipdata = render_vars.pop('images_zipdata', None)
+        render_vars.pop('slide_cache', None)   # Does not affect output
+        md_bytes = md_text.encode('utf8') if isinstance(md_text, unicode) else md_text
+        return sliauth.digest_hex(json.dumps([get_build_stamp(), sliauth.digest_hex(md_bytes, truncate=None), vars(file_config), plugin_defs, render_vars,
+                                              sliauth.digest_hex(images_zipdata, truncate=None) if images_zipdata else ''],
+                                             sort_keys=True, default=build_key_default), truncate=None)
+
+    def entry_path(self, fname, cache_key):
+        return os.path.join(self.cache_dir, fname+'-'+cache_key+'.pickle')
+
+    def get(self, fname, cache_key):
+        cache_path = self.entry_path(fname, cache_key)
+        if not os.path.exists(cache_path):
+            return None
+        try:
+            with open(cache_path, 'rb') as f:
+                result = cPickle.load(f)
+        except Exception, excp:
+            message('CACHE-WARNING: Error in reading build cache entry %s: %s' % (cache_path, excp))
+            return None
+
+        if any(file_stamp(path) != stamp for path, stamp in result['image_files'].items()):
+            # Image files modified
+            return None
+        if not all(os.path.exists(path) for path in result['image_copies']):
+            # Image files need to be copied
+            return None
+        try:
+            os.utime(cache_path, None)
+        except OSError:
+            pass
+        return result
+
+    def put(self, fname, cache_key, result):
+        cache_path = self.entry_path(fname, cache_key)
+        tem_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        try:
+            with open(tem_path, 'wb') as f:
+                cPickle.dump(result, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tem_path, cache_path)  # Atomic (cache may be shared by concurrent processes)
+        except Exception, excp:
+            message('CACHE-WARNING: Error in writing build cache entry %s: %s' % (cache_path, excp))
+            return
+
+        # Discard least recently used entries for file
+        prefix = fname + '-'
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix) and name.endswith('.pickle') and name[len(prefix):-len('.pickle')].isalnum():
+                entries.append( (file_stamp(os.path.join(self.cache_dir, name)), name) )
+        entries.sort(reverse=True)
+        for _, name in entries[self.max_entries:]:
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+    def set_make_stamp(self, outpath, config_key):
+        if self.make_stamps.get(outpath) != config_key:
+            self.make_stamps[outpath] = config_key
+            self.make_modified = True
+
+    def save(self):
+        if self.make_modified:
+            md2md.write_file(os.path.join(self.cache_dir, self.make_file), json.dumps(self.make_stamps, sort_keys=True, indent=1))
+            self.make_modified = False
+
 def process_input(*args, **argv):
     try:
         return process_input_aux(*args, **argv)
@@ -3644,6 +4166,12 @@ def process_input_aux(input_files, input_paths, config_dict, default_args_dict={
         # Process only modified input files
         if config.toc or config.index or config.qindex or config.all:
             abort('OPTION-ERROR: --make option incompatible with indexing or "all" options')
+
+    build_cache = None
+    make_key = ''
+    if config.build_cache:
+        build_cache = BuildCache(config.build_cache)
+        make_key = build_cache.config_key(config_dict, default_args_dict)
         
     site_prefix = '/'+config.site_name if config.site_name else ''
     dest_dir = ''
@@ -3730,6 +4258,9 @@ def process_input_aux(input_files, input_paths, config_dict, default_args_dict={
             # (Always process return_html or index.md file)
             if return_html or fname == 'index' or not (os.path.exists(outpath) and os.path.getmtime(outpath) >= os.path.getmtime(inpath)):
                 fnumbers.append(fnumber)
+            elif build_cache and build_cache.make_stamps.get(outpath) != make_key:
+                # Output file created with different configuration (or slidoc version)
+                fnumbers.append(fnumber)
 
 
 
@@ -3817,10 +4348,8 @@ def process_input_aux(input_files, input_paths, config_dict, default_args_dict={
         default_args_dict['strip'] = md2md.make_arg_set(default_args_dict['strip'], Strip_all)
 
     templates = {}
-    for tname in ('doc_include.css', 'wcloud.css', 'doc_custom.css',
-                  'doc_include.js', 'wcloud.js', 'doc_google.js', 'md5.js', 'sha256.js', 'doc_test.js',
-                  'doc_include.html', 'doc_template.html', 'reveal_template.html'):
-        templates[tname] = md2md.read_file(scriptdir+'/templates/'+tname)
+    for tname in Template_names:
+        templates[tname] = read_cached(scriptdir+'/templates/'+tname)
 
     if config.css.startswith('http:') or config.css.startswith('https:'):
         css_html = '<link rel="stylesheet" type="text/css" href="%s">\n' % config.css
@@ -3831,8 +4360,7 @@ def process_input_aux(input_files, input_paths, config_dict, default_args_dict={
 
     # External CSS replaces doc_custom.css, but not doc_include.css
     css_html += insert_resource('doc_include.css')
-    if HtmlFormatter:
-        css_html += '\n<style>\n' + HtmlFormatter().get_style_defs('.highlight') + '\n</style>\n'
+    css_html += get_highlight_css()
     css_html += insert_resource('wcloud.css')
     test_params = []
     add_scripts = ''
@@ -3897,7 +4425,7 @@ def process_input_aux(input_files, input_paths, config_dict, default_args_dict={
 
     base_plugin_defs = {}
     for plugin_path in plugin_paths:
-        plugin_name, base_plugin_defs[plugin_name] = parse_plugin( md2md.read_file(plugin_path.strip()) )
+        plugin_name, base_plugin_defs[plugin_name] = read_plugin(plugin_path.strip())
 
     comb_plugin_defs = {}
     comb_plugin_loads = set()
@@ -3956,6 +4484,25 @@ def process_input_aux(input_files, input_paths, config_dict, default_args_dict={
     paced_files = set()
     admin_due_date = {}
     out_index = {}
+
+    prerendered = {}
+    if config.parallel > 1 and config.separate and len(fnumbers) > 1 and not return_html:
+        # Render files concurrently in worker processes; output is merged in file order
+        prerender_jobs = {}
+        for fnumber in fnumbers:
+            fhandle = input_files[fnumber-1]
+            file_text = fhandle.read()
+            fhandle.seek(0)
+            prerender_jobs[fnumber] = dict(md_text=file_text, fname=orig_fnames[fnumber-1], filepath=input_paths[fnumber-1],
+                                           config=config, default_args_dict=default_args_dict, plugin_defs=base_plugin_defs,
+                                           gd_hmac_key=gd_hmac_key, nfiles=nfiles, build_cache=build_cache,
+                                           render_args=dict(slide_mods_args=slide_mods_args, site_name=config.site_name,
+                                                            images_zipdata=images_zipdict.get(orig_fnames[fnumber-1]),
+                                                            prev_file='' if fnumber == 1 else orig_flinks[fnumber-2],
+                                                            next_file='' if fnumber == nfiles else orig_flinks[fnumber],
+                                                            index_id=index_id, qindex_id=qindex_id, zip_content=config.preview_port))
+        prerendered = prerender_files(prerender_jobs, config.parallel)
+
     for j, fnumber in enumerate(fnumbers):
         fhandle = input_files[fnumber-1]
         fname = orig_fnames[fnumber-1]
@@ -3971,51 +4518,11 @@ def process_input_aux(input_files, input_paths, config_dict, default_args_dict={
             # Separate files (may also be paced)
 
             # Merge file config with command line
-            file_config = parse_merge_args(sliauth.read_header_opts(fhandle)[0], fname, Conf_parser, vars(config), default_args_dict=default_args_dict, verbose=config.verbose)
-            if config.preview_port:
-                if file_config.gsheet_url:
-                    file_config.gsheet_url = ''
-
-            if file_config.plugins:
-                # Plugins with same name will override earlier plugins
-                plugin_paths = file_config.plugins.split(',')
-                for plugin_path in plugin_paths:
-                    plugin_name, file_plugin_defs[plugin_name] = parse_plugin( md2md.read_file(plugin_path.strip()) )
-
-            file_config.features = file_config.features or set()
-            if 'grade_response' in file_config.features and gd_hmac_key is None:
-                # No grading without google sheet
-                file_config.features.remove('grade_response')
-            if nfiles == 1:
-                file_config.strip.add('chapters')
-
-            ##if 'slides_only' in file_config.features and config.printable:
-            ##    file_config.features.remove('slides_only')
-            ##    message('slides_only feature suppressed by --printable option')
-
-            if 'keep_extras' in file_config.features and config.gsheet_url:
-                abort('PACE-ERROR: --features=keep_extras incompatible with --gsheet_url')
-
-            if file_config.retakes and file_config.timed:
-                abort('PACE-ERROR: --retakes=... incompatible with --timed=...')
-
-            if file_config.show_correct and file_config.show_correct not in ('after_answering', 'after_submitting', 'after_grading', 'always'):
-                abort('SHOW-ERROR: Must have --show_correct=after_answering OR after_submitting OR after_grading (found %s)' % file_config.show_correct)
-
-            if not file_config.show_correct:
-                if file_config.pace >= QUESTION_PACE:
-                    file_config.show_correct = 'after_answering'
-                elif file_config.pace:
-                    if gd_hmac_key is None:
-                        file_config.show_correct = 'after_answering'
-                    elif 'assessment' in file_config.features:
-                        file_config.show_correct = 'after_grading'
-                    else:
-                        file_config.show_correct = 'after_submitting'
+            file_config, file_plugin_defs = merge_file_config(fhandle, fname, config, default_args_dict, file_plugin_defs, gd_hmac_key, nfiles)
 
             file_config_vars = vars(file_config)
             settings_list = []
-            exclude = set(['anonymous', 'auth_key', 'backup_dir', 'config', 'copy_source', 'create_toc', 'dest_dir', 'dry_run', 'google_login', 'gsheet_url', 'make', 'modify_sessions', 'notebook', 'overwrite', 'preview_port', 'proxy_url', 'server_url', 'split_name', 'test_script', 'toc_header', 'topnav', 'verbose', 'file', 'separate', 'toc', 'index', 'qindex'])
+            exclude = set(['anonymous', 'auth_key', 'backup_dir', 'build_cache', 'config', 'copy_source', 'create_toc', 'dest_dir', 'dry_run', 'google_login', 'gsheet_url', 'make', 'modify_sessions', 'notebook', 'overwrite', 'parallel', 'preview_port', 'proxy_url', 'server_url', 'split_name', 'test_script', 'toc_header', 'topnav', 'verbose', 'file', 'separate', 'toc', 'index', 'qindex'])
             arg_names = file_config_vars.keys()
             arg_names.sort()
             for name in arg_names:
@@ -4133,37 +4640,24 @@ def process_input_aux(input_files, input_paths, config_dict, default_args_dict={
             abort('FEATURE-ERROR: Unknown feature(s) in module %s: %s' % (fname,  ','.join(list(file_config.features.difference(set(Features_all)))) ) )
             
         filepath = input_paths[fnumber-1]
-        filedir = os.path.dirname(os.path.realpath(filepath))
         md_text = fhandle.read()
         fhandle.close()
 
-        # Preprocess line breaks, tabs etc.
-        md_text = preprocess(md_text)
-        loc = md2md.find_non_ascii(md_text)
-        if loc:
-            message('ASCII-WARNING: Possible non-ascii character at position %d could create problems: %s' % (loc, repr(md_text[max(0,loc-10):loc+15])) )
-
-        # Strip annotations (may also break slide editing)
-        md_text = re.sub(r"(^|\n) {0,3}[Aa]nnotation:(.*?)(\n|$)", '', md_text)
-
-        files_url = '/_files'
-        if config.site_name:
-            files_url = '/' + config.site_name + files_url
-        slide_parser = md2md.Parser(slide_mods_args, images_zipdata=images_zipdict.get(fname), files_url=files_url)
-        md_text_modified, _, new_renumber = slide_parser.parse(md_text, filepath)
-
-        if file_config.hide and 'hidden' in file_config.strip:
-            md_text_modified = re.sub(r'(^|\n *\n--- *\n( *\n)+) {0,3}#{2,3}[^#][^\n]*'+file_config.hide+r'.*?(\n *\n--- *\n|$)', r'\1', md_text_modified, flags=re.DOTALL)
-
         prev_file = '' if fnumber == 1      else orig_flinks[fnumber-2]
         next_file = '' if fnumber == nfiles else orig_flinks[fnumber]
 
-        # zipped_md containing will only be created if any images are present (and will also include the original (preprocessed) md_text as content.md)
-        fheader, file_toc, renderer, md_params, md_html, zipped_md = md2html(md_text, filename=fname, config=file_config, filenumber=fnumber,
-                                                        filedir=filedir, plugin_defs=file_plugin_defs, prev_file=prev_file, next_file=next_file,
-                                                        index_id=index_id, qindex_id=qindex_id, zip_content=config.preview_port,
-                                                        images_zipdata=images_zipdict.get(fname))
-        math_present = renderer.render_mathjax or MathInlineGrammar.any_block_math.search(md_text) or MathInlineGrammar.any_inline_math.search(md_text)
+        render_args = dict(slide_mods_args=slide_mods_args, site_name=config.site_name, images_zipdata=images_zipdict.get(fname),
+                           prev_file=prev_file, next_file=next_file, index_id=index_id, qindex_id=qindex_id, zip_content=config.preview_port,
+                           slide_cache=return_html)
+
+        # Use output of worker process (parallel build) or build cache, unless rendering depended upon preceding files
+        result = prerendered.pop(fnumber, None)
+        if not result and build_cache:
+            result = render_cached(build_cache, md_text, fname, fnumber, filepath, file_config, file_plugin_defs, render_args)
+        rendered = merge_prerendered(result) if result else None
+        if not rendered:
+            rendered = render_file(md_text, fname, fnumber, filepath, file_config, file_plugin_defs, **render_args)
+        md_text, md_text_modified, fheader, file_toc, renderer, md_params, md_html, zipped_md, math_present = rendered
 
         if len(fnumbers) == 1 and config.separate and config.extract:
             md_extract = md_defaults + ''.join(md_params['md_slides'][config.extract-1:])
@@ -4640,6 +5134,11 @@ def process_input_aux(input_files, input_paths, config_dict, default_args_dict={
                         return {'outpath': outpath, 'out_html':md2md.str_join(Html_header, pre_html, tail, Html_footer), 'toc_html':md2md.stringify(toc_all_html), 'md_params':md_params, 'zipped_md':zipped_md, 'messages': messages}
                     else:
                         write_doc(outpath, pre_html, tail)
+            if build_cache and not return_html:
+                # Record configuration used to create output files (for make mode)
+                for outfile in outfile_buffer:
+                    build_cache.set_make_stamp(outfile[1], make_key)
+                build_cache.save()
             if return_html:
                 # No output files
                 return {'outpath': '', 'out_html':'', 'toc_html':toc_all_html, 'md_params':{}, 'zipped_md':None, 'messages': messages}
@@ -5227,6 +5726,7 @@ Conf_parser.add_argument('--unhide_slides', help='Unhide all slides', action="st
 alt_parser = argparse.ArgumentParser(parents=[Conf_parser], add_help=False)
 alt_parser.add_argument('--anonymous', help='Allow anonymous access (also unset REQUIRE_LOGIN_TOKEN)', action="store_true", default=None)
 alt_parser.add_argument('--auth_key', metavar='DIGEST_AUTH_KEY', help='digest_auth_key (authenticate users with HMAC)')
+alt_parser.add_argument('--build_cache', metavar='DIR', help='Directory for caching rendered files (also tracks configuration for --make)')
 alt_parser.add_argument('--backup_dir', help='Directory to create backup files for last valid version in when dest_dir is specified')
 alt_parser.add_argument('--config', metavar='CONFIG_FILENAME', help='File containing default command line')
 alt_parser.add_argument('--copy_source', help='Create a modified copy (only if dest_dir is specified)', action="store_true", default=None)
@@ -5243,6 +5743,7 @@ alt_parser.add_argument('--make', help='=all OR =filename; enable Make mode, i.e
 alt_parser.add_argument('--modify_sessions', metavar='SESSION1,SESSION2,... OR overwrite OR truncate', help='Module sessions with questions to be modified')
 alt_parser.add_argument('--notebook', help='Create notebook files', action="store_true", default=None)
 alt_parser.add_argument('--overwrite', help='Overwrite source and nb files', action="store_true", default=None)
+alt_parser.add_argument('--parallel', type=int, default=0, metavar='N', help='Render separate files concurrently using N worker processes')
 alt_parser.add_argument('-p', '--preview_port', type=int, default=0, metavar='PORT', help='Preview document in browser using specified localhost port')
 alt_parser.add_argument('--pptx_options', metavar='PPTX_OPTS', default='', help='Powerpoint conversion options (comma-separated)')
 alt_parser.add_argument('--preview_mode', help='Do not copy image files to dest directory', action="store_true", default=None)
@@ -142,6 +142,7 @@ Sliobj.buttonPlugins = null;
 Sliobj.delaySec = null;
 Sliobj.scores = null;
 Sliobj.liveResponses = {};
+Sliobj.responseTallies = {};  // qnumber -> {qnumber:, qtype:, responded:, correct:, counts: [[bucket, count], ...]} (admin only)
 Sliobj.choiceBlockHTML = {};
 Sliobj.gradeStats = null;
 Sliobj.gradeRescale = '';
@@ -3195,17 +3196,24 @@ Sliobj.eventReceiver = function(eventMessage) {
 	}
 
     } else if (adminSender && eventName == 'ActiveUsers') {
+	// eventArgs: userId, full list of active users (older servers), [name, userId, shortName] of joining user (or null if leaving)
 	if (eventArgs[1]) {
 	    // User joining
 	    Sliobj.activeUsers = eventArgs[1];
 	} else if (Sliobj.activeUsers) {
-	    // User leaving
 	    for (var j=0; j<Sliobj.activeUsers.length; j++) {
 		if (Sliobj.activeUsers[j][1] == eventArgs[0]) {
 		    Sliobj.activeUsers.splice(j,1);
 		    break;
 		}
 	    }
+	    if (eventArgs[2]) {
+		// User joining (insert in sorted order)
+		var k = 0;
+		while (k < Sliobj.activeUsers.length && (Sliobj.activeUsers[k][0] < eventArgs[2][0] || (Sliobj.activeUsers[k][0] == eventArgs[2][0] && Sliobj.activeUsers[k][1] < eventArgs[2][1])))
+		    k += 1;
+		Sliobj.activeUsers.splice(k, 0, eventArgs[2]);
+	    }
 	}
 	Slidoc.showActiveUsers(true);
 
@@ -3226,6 +3234,10 @@ Sliobj.eventReceiver = function(eventMessage) {
 	if (Sliobj.closePopup)
 	    Sliobj.closePopup(null, eventName);
 
+    } else if (adminSender && eventName == 'ResponseTally') {
+	// Live response tally for question (requested via /_qtally)
+	Sliobj.responseTallies[eventArgs[0]] = eventArgs[1];
+
     } else if (eventName == 'LiveResponse') {
 	if (!(eventArgs[0] in Sliobj.liveResponses))
 	    Sliobj.liveResponses[eventArgs[0]] = [];
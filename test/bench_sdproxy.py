@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the sdproxy in-memory sheet cache (no Google Sheet access needed)
+
+Usage: python test/bench_sdproxy.py [nrows [ncols]]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+import sdproxy
+
+sdproxy.Settings['gsheet_url'] = ''
+sdproxy.schedule_update = lambda *args, **kwargs: None   # No IOLoop needed
+
+def make_session_sheet(nrows, ncols, filled=False):
+    headers = ['name', 'id', 'email', 'altid', 'Timestamp'] + ['q%d_response' % j for j in range(1, ncols-4)]
+    rows = [headers]
+    for j in range(nrows):
+        if filled:
+            # Typical responses (decoded from JSON, hence unicode)
+            values = [u'choice%d' % ((j+k) % 4) for k in range(ncols-4)]
+        else:
+            values = ['']*(ncols-4)
+        rows.append([u'user%04d, name' % j, u'user%04d' % j, u'', u''] + values)
+    return sdproxy.Sheet('bench', rows, keyHeader='id', updated=True)
+
+def full_scan_get_updates(sheet, row_limit=None):
+    # Previous Sheet.get_updates (for comparison): walk every row to find modified rows and build the update request
+    actions = ','.join(sheet.actionsRequested)
+    headers = sheet.xrows[0]
+    nameCol = 1+headers.index('name') if 'name' in headers else 0
+
+    incompleteUpdate = False
+    updateRows = {}
+    updateColSet = set()
+    insertNames = []
+    insertRows = []
+    updateSel = []
+    updateElemCount = 0
+
+    colSet, colList, curUpdate = None, None, None
+    allKeys = [row[sheet.keyCol-1] for row in sheet.xrows[1:] if row[sheet.keyCol-1]] if sheet.keyCol else None
+
+    for j, row in enumerate(sheet.xrows[1:]):
+        rowNum = j+2
+        key = row[sheet.keyCol-1] if sheet.keyCol else rowNum+sheet.deletedRowCount
+        if not key:
+            continue
+
+        inserted = sheet.keyMap[key][1]
+        newColSet = sheet.keyMap[key][2]
+
+        if not inserted and not newColSet:
+            colSet, colList, curUpdate = None, None, None
+            continue
+
+        if sheet.keyCol and row_limit and (len(insertRows) >= row_limit or updateElemCount >= 10*row_limit):
+            actions = ''
+            incompleteUpdate = True
+            break
+
+        updateRows[key] = sheet.keyMap[key][0]
+
+        if sdproxy.Global.updatePartial and sheet.keyCol and not inserted:
+            if colSet is not None and colSet.issuperset(newColSet) and len(colSet)-len(newColSet) <= 2:
+                curUpdate[0].append(key)
+                curUpdate[2].append([row[jcol-1] for jcol in colList])
+            else:
+                updateColSet.update(newColSet)
+                colSet = newColSet
+                colList = sorted(colSet)
+                curUpdate = [[key], colList, [[row[jcol-1] for jcol in colList]] ]
+                updateSel.append(curUpdate)
+
+            updateElemCount += len(colSet)
+
+        else:
+            colSet, colList, curUpdate = None, None, None
+            keyRow = key if sheet.keyCol else rowNum
+            if inserted:
+                insertNames.append( [row[nameCol-1] if nameCol else '', keyRow] )
+                insertRows.append( row )
+            elif not sheet.keyCol and updateSel and updateSel[-1][0][-1] == keyRow-1:
+                updateSel[-1][0].append(keyRow)
+                updateSel[-1][2].append(row)
+            else:
+                updateSel.append( [[keyRow], None, [row]] )
+
+    if not insertRows and not updateSel and not actions and not sheet.modifiedHeaders and (not sheet.modTime or sheet.modTime < sdproxy.Global.cacheUpdateTime):
+        return None
+
+    updateColList = sorted(list(updateColSet)) if (updateColSet and len(updateColSet) < sheet.nCols) else None
+
+    updateParams = {'incompleteUpdate': incompleteUpdate, 'actions': actions, 'modifiedHeaders': sheet.modifiedHeaders}
+    return [updateRows, updateParams, headers, sheet.getLastRow(), allKeys, insertNames, updateColList, insertRows, updateSel]
+
+def timeit(func, count):
+    startTime = time.time()
+    for j in range(count):
+        func()
+    return 1000.*(time.time()-startTime)/count
+
+def bench_get_updates(nrows=1000, ncols=300, count=200):
+    sheet = make_session_sheet(nrows, ncols)
+    print('Sheet %dx%d: msec per get_updates' % (nrows, ncols))
+    rowLimit = sdproxy.PROXY_UPDATE_ROW_LIMIT
+    for nmod in (0, 1, 10, 100):
+        sheet.clear_update()
+        for j in range(nmod):
+            sheet._setSheetValues(2+(j*nrows)//max(1,nmod), 6, 1, 1, [['answer%d' % j]])
+        assert full_scan_get_updates(sheet, row_limit=rowLimit) == sheet.get_updates(row_limit=rowLimit)
+        print('  %4d modified rows: full scan %.3f, dirty index %.3f' % (nmod, timeit(lambda: full_scan_get_updates(sheet, row_limit=rowLimit), count),
+                                                                     timeit(lambda: sheet.get_updates(row_limit=rowLimit), count)))
+
+def copy_and_modify(sheet):
+    # Snapshot sheet (as for preview) and modify one row of the copy
+    sheet.copy()._setSheetValues(2, 6, 1, 1, [['modified']])
+
+def bench_compact(nrows=1000, ncols=300, count=20):
+    print('Sheet %dx%d: memory and msec per copy' % (nrows, ncols))
+    for compact in (False, True):
+        sdproxy.Settings['compact_cache'] = compact
+        sheet = make_session_sheet(nrows, ncols, filled=True)
+        print('  compact=%-5s: memory %6dKB, copy %.3f, copy+modify %.3f' % (compact, sheet.memory_usage()/1024, timeit(sheet.copy, count),
+                                                                          timeit(lambda: copy_and_modify(sheet), count)))
+    sdproxy.Settings['compact_cache'] = False
+
+def bench_update_size(nrows=1000, ncols=300, nmod=100):
+    print('Sheet %dx%d, %d modified rows: bytes per update request' % (nrows, ncols, nmod))
+    sdproxy.Global.updateCompact = True  # As if reported by upstream
+    for compact in (False, True):
+        sdproxy.Settings['compact_updates'] = compact
+        sheet = make_session_sheet(nrows, ncols, filled=True)
+        for j in range(nmod):
+            sheet._setSheetValues(2+(j*nrows)//nmod, 6+(j % 3), 1, 1, [['answer%d' % j]])
+        json_data = sdproxy.json.dumps(sheet.get_updates(row_limit=sdproxy.PROXY_UPDATE_ROW_LIMIT), default=sdproxy.sliauth.json_default)
+        print('  compact=%-5s: %7d bytes' % (compact, len(sdproxy.encodeUpdateData(json_data)) if compact else len(json_data)))
+    sdproxy.Settings['compact_updates'] = False
+
+def make_sessions(nusers, nquestions):
+    qtypes = ['choice', 'number', 'text']
+    corrects = ['B', '3.5 +/- 0.1', 'hello world OR hi']
+    responses = [['A', 'B', 'C', 'D'], ['3.45', '3.7', '3.5', 'x'], ['hello  world', 'hi', 'bye']]
+    questions = [{'qtype': qtypes[j%3], 'correct': corrects[j%3], 'slide': j+1, 'weight': 1} for j in range(nquestions)]
+    sessions = []
+    for k in range(nusers):
+        attempted = dict((j+1, {'response': responses[j%3][(j+k) % len(responses[j%3])]}) for j in range(nquestions) if (j+k) % 7)
+        sessions.append({'questionsAttempted': attempted, 'hintsUsed': {}})
+    return questions, sessions
+
+def bench_scoring(nusers=500, nquestions=30, count=5):
+    questions, sessions = make_sessions(nusers, nquestions)
+    params = {'features': '', 'paceLevel': 0}
+    print('%d users x %d questions: msec per regrade (numpy=%s)' % (nusers, nquestions, sdproxy.numpy is not None))
+    print('  scalar tallyScores %.1f, tallyScoresBatch %.1f' % (timeit(lambda: [sdproxy.tallyScores(questions, session['questionsAttempted'], session['hintsUsed'], params, []) for session in sessions], count),
+                                                           timeit(lambda: sdproxy.tallyScoresBatch(questions, sessions, params, []), count)))
+
+if __name__ == '__main__':
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    ncols = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    bench_get_updates(nrows, ncols)
+    bench_compact(nrows, ncols)
+    bench_update_size(nrows, ncols)
+    bench_scoring()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Benchmarks for sdserver WebSocket event broadcasts (no network connections needed)
+
+Usage: python test/bench_sdserver.py
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+import sdproxy
+import sdserver
+import sliauth
+
+WSHandler = sdserver.WSHandler
+
+class BenchConnection(object):
+    # Stand-in for WSHandler connection, discarding messages
+    flushEventBuffer = WSHandler.flushEventBuffer.__func__
+
+    def __init__(self, path, userId, userRole):
+        self.pathUser = (path, userId)
+        self.userRole = userRole
+        self.eventBuffer = sdserver.OrderedDict()
+        self.nbytes = 0
+
+    def write_message_safe(self, msg):
+        self.nbytes += len(msg)
+
+def make_connections(path, nconn):
+    for path_dict in WSHandler._connections.values():
+        for connections in path_dict.values():
+            for conn in connections[:]:
+                WSHandler.removeConnection(conn)
+    conns = []
+    for j in range(nconn):
+        conns.append(BenchConnection(path, 'user%04d' % j, sdproxy.ADMIN_ROLE if not j else ''))
+        WSHandler.addConnection(conns[-1])
+    return conns
+
+def previous_broadcast(conns, fromUser, fromRole, evType, evName, evArgs):
+    # Previous approach: buffer event list per connection, with linear scan for overwrites, and encode on flush
+    sendList = [fromUser, fromRole, evName] + evArgs
+    for conn in conns:
+        if evType > 0:
+            for j in range(len(conn.eventBuffer)):
+                if conn.eventBuffer[j][2:evType+2] == sendList[2:evType+2]:
+                    conn.eventBuffer[j] = sendList
+                    break
+            else:
+                conn.eventBuffer.append(sendList)
+        else:
+            conn.eventBuffer.append(sendList)
+
+def previous_flush(conns):
+    for conn in conns:
+        while conn.eventBuffer:
+            sendList = conn.eventBuffer.pop(0)
+            msg = [0, 'event', [sendList[0], sendList[1], sendList[2], sendList[3:]] ]
+            conn.write_message_safe(json.dumps(msg, default=sliauth.json_default))
+
+def timeit(func, count):
+    startTime = time.time()
+    for j in range(count):
+        func()
+    return 1000.*(time.time()-startTime)/count
+
+def bench_broadcast(nevents=20, count=5):
+    # Admin broadcasts nevents overwritable events (evType=2) followed by one immediate event, to all users
+    path = 'bench'
+    evArgs = [['slide%02d' % j, {'choices': ['A', 'B', 'C', 'D'], 'counts': [j, 2*j, 3*j, 4*j]}] for j in range(nevents)]
+    sdserver.IOLoop.current().call_later = lambda *args: True   # Shared flush timer not needed
+    print('Broadcast of %d buffered + 1 immediate event: msec per broadcast' % nevents)
+    for nconn in (50, 500, 2000):
+        def previous():
+            conns = make_connections(path, nconn)
+            for conn in conns:
+                conn.eventBuffer = []
+            for j in range(nevents):
+                previous_broadcast(conns, '', sdproxy.ADMIN_ROLE, 2, 'Slide.update', evArgs[j])
+            previous_broadcast(conns, '', sdproxy.ADMIN_ROLE, -1, 'Slide.go', ['slide01'])
+            previous_flush(conns)
+
+        def current():
+            make_connections(path, nconn)
+            for j in range(nevents):
+                WSHandler.sendEvent(path, '', sdproxy.ADMIN_ROLE, True, False, ['', 2, 'Slide.update', evArgs[j]])
+            WSHandler.sendEvent(path, '', sdproxy.ADMIN_ROLE, True, False, ['', -1, 'Slide.go', ['slide01']])
+
+        print('  %4d connections: per-connection encoding %.1f, serialize once %.1f' % (nconn, timeit(previous, count), timeit(current, count)))
+    make_connections(path, 0)
+    WSHandler._pendingFlush.clear()
+    WSHandler._flushTimeout = None
+
+if __name__ == '__main__':
+    bench_broadcast()
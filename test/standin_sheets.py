@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Google Sheets web app (scripts/slidoc_sheets.js), implementing only the
+proxy get/allupdates requests used by sdproxy, with sheets held in memory (no authentication)
+
+Usage: python test/standin_sheets.py [port]
+       sdserver.py --gsheet_url=http://localhost:port/ ...
+
+GET /_stats returns request counts and sizes (JSON)
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+
+import tornado.ioloop
+import tornado.web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+import sdproxy
+import sliauth
+
+Sheets = {}   # sheetName -> list of rows (first row is headers)
+Stats = {'requests': 0, 'updates': 0, 'data_bytes': 0, 'raw_bytes': 0}
+
+def apply_updates(data, create=False):
+    for sheetName, updateParams, headers, lastRow, allKeys, insertNames, updateCols, insertRows, updateSel in data:
+        if sheetName not in Sheets:
+            if not create:
+                raise Exception('Error:PROXY_MISSING_SHEET:Sheet not found: '+sheetName)
+            Sheets[sheetName] = [headers[:]]
+        rows = Sheets[sheetName]
+        if updateParams.get('modifiedHeaders'):
+            rows[0] = headers[:]
+            for j in range(1, len(rows)):
+                rows[j] = (rows[j] + ['']*len(headers))[:len(headers)]
+        elif headers != rows[0]:
+            raise Exception('Error:PROXY_HEADER_NAMES:Column header mismatch in sheet '+sheetName)
+
+        if allKeys is None:
+            # Non-keyed sheet: rows are deleted from the top; last row number is valid
+            excessRows = len(rows)+len(insertRows)-lastRow
+            if excessRows > 0:
+                del rows[1:1+excessRows]
+            rows += [['']*len(headers) for j in range(lastRow-len(rows))]
+            for rowNums, cols, rowSel in updateSel:
+                for rowNum, row in zip(rowNums, rowSel):
+                    rows[rowNum-1] = row[:]
+            rows[lastRow-len(insertRows):lastRow] = [row[:] for row in insertRows]
+            continue
+
+        idCol = headers.index('id')
+        nameCol = headers.index('name') if 'name' in headers else idCol
+        keySet = set(allKeys)
+        rows[1:] = [row for row in rows[1:] if row[idCol] in keySet]
+        rowIndex = dict((row[idCol], j) for j, row in enumerate(rows) if j)
+        for row in insertRows:
+            if row[idCol] in rowIndex:
+                rows[rowIndex[row[idCol]]] = row[:]
+            else:
+                rows.append(row[:])
+        rows[1:] = sorted(rows[1:], key=lambda row: (row[nameCol], row[idCol]))
+        if [row[idCol] for row in rows[1:]] != allKeys:
+            raise Exception('Error:PROXY_UPDATE_MISMATCH:Mismatched row ids in sheet '+sheetName)
+
+        rowIndex = dict((row[idCol], j) for j, row in enumerate(rows) if j)
+        for rowIds, cols, rowSel in updateSel:
+            cols = cols or range(1, len(headers)+1)
+            checkIdOffset = cols.index(idCol+1) if idCol+1 in cols else -1
+            for rowId, newRow in zip(rowIds, rowSel):
+                row = rows[rowIndex[rowId]]
+                if checkIdOffset >= 0:
+                    newId = newRow.get(str(checkIdOffset)) if isinstance(newRow, dict) else newRow[checkIdOffset]
+                    if newId != row[idCol]:
+                        raise Exception('Error:PROXY_PARTIAL_UPDATE: New id %s differs from old id %s in sheet %s' % (newId, row[idCol], sheetName))
+                if isinstance(newRow, dict):
+                    # Delta row (modified cells only)
+                    for offset, value in newRow.items():
+                        row[cols[int(offset)]-1] = value
+                else:
+                    for j, colNum in enumerate(cols):
+                        row[colNum-1] = newRow[j]
+
+
+class StandinHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write(Stats)
+
+    def post(self):
+        args = dict((name, self.get_argument(name)) for name in self.request.arguments)
+        Stats['requests'] += 1
+        retObj = {'result': 'success', 'value': [], 'info': {'version': sliauth.get_version(), 'proxyEncodings': ['gzip'], 'refreshSheets': [], 'updateErrors': []}}
+        try:
+            if args.get('allupdates'):
+                jsonData = sdproxy.decodeUpdateData(args['data'], args.get('encoding', ''))
+                Stats['updates'] += 1
+                Stats['data_bytes'] += len(args['data'])
+                Stats['raw_bytes'] += len(jsonData)
+                apply_updates(json.loads(jsonData), create=bool(args.get('create')))
+            elif args.get('get') and args.get('all'):
+                retObj['value'] = Sheets.get(args.get('sheet'), [])
+            else:
+                raise Exception('Only proxy get/allupdates supported by stand-in')
+        except Exception, excp:
+            retObj = {'result': 'error', 'error': str(excp)}
+        self.write(json.dumps(retObj, default=sliauth.json_default))
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    tornado.web.Application([(r'/_stats', StandinHandler), (r'/', StandinHandler)]).listen(port)
+    print('Stand-in sheets listening on port', port, file=sys.stderr)
+    tornado.ioloop.IOLoop.current().start()